@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/3.2/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -144,3 +145,100 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 CORS_ALLOW_CREDENTIALS = True
 CORS_ORIGIN_WHITELIST = ('http://localhost:3000',)
+
+# FastCI scheduler
+
+# How the scheduler finds out that something has changed:
+#   'poll' - step all of the pipelines every FASTCI_POLL_INTERVAL_SECS (celery beat)
+#   'events' - step a pipeline as soon as docker reports that one of its containers started or died
+#              (run `python manage.py watch_docker_events` next to the worker), and sweep all of the
+#              pipelines every FASTCI_RECONCILE_INTERVAL_SECS just in case we missed something
+FASTCI_SCHEDULER_MODE = 'poll'
+FASTCI_POLL_INTERVAL_SECS = 0.5
+FASTCI_RECONCILE_INTERVAL_SECS = 30
+
+# If True, the pipelines are stepped by `python manage.py run_scheduler` instead of the beat ticks. It steps them in a
+# loop that never overlaps with itself, sleeping FASTCI_SCHEDULER_MIN_SLEEP_SECS while there's work to do and backing off
+# up to the interval of the mode above when there isn't
+FASTCI_SCHEDULER_DAEMON = False
+FASTCI_SCHEDULER_MIN_SLEEP_SECS = 0.05
+
+# Any number of workers can step the pipelines at once, each one takes the leases of at most FASTCI_LEASE_BATCH_SIZE
+# pipelines per tick. The lease of a dead worker is taken over after FASTCI_LEASE_TTL_SECS, so it must be longer than it
+# takes to step one pipeline (the leases of a batch are renewed while it's being stepped)
+FASTCI_LEASE_BATCH_SIZE = 50
+FASTCI_LEASE_TTL_SECS = 60
+# how often we check if the lease of a single pipeline is free, when we want to change it
+FASTCI_LEASE_RETRY_SECS = 0.05
+
+# How the scheduler talks to the docker:
+#   'sync' - the docker SDK, one call after another
+#   'asyncio' - the running jobs of all the pipelines being stepped are inspected (and their logs fetched) at once, at
+#               most FASTCI_DOCKER_CONCURRENCY calls in flight. Starting and stopping the containers still goes through
+#               the SDK
+FASTCI_DOCKER_BACKEND = 'sync'
+FASTCI_DOCKER_SOCKET = '/var/run/docker.sock'
+FASTCI_DOCKER_CONCURRENCY = 32
+
+# How many containers are created at once when a pipeline is submitted. The docker client keeps at most 10 connections
+FASTCI_CREATE_CONTAINER_THREADS = 8
+
+# The missing images of a pipeline are pulled in parallel when it's submitted
+FASTCI_PULL_IMAGE_THREADS = 4
+# How much disk the images pulled by us may take, the least recently used ones are removed above that. The images that
+# were already there (i.e. built locally) aren't counted and are never removed
+FASTCI_IMAGE_CACHE_BUDGET_BYTES = 20 * 1024 * 1024 * 1024
+FASTCI_IMAGE_GC_INTERVAL_SECS = 300
+
+# Warm pool - already started containers for the recently used images, so the short jobs don't wait for the docker to
+# create and start their containers. Only the jobs without any volumes can use it. 0 == disabled
+#
+# WARN: Both sizes are per worker process, every process of the prefork pool keeps its own idle containers. So the host
+#       may end up with FASTCI_WARM_POOL_SIZE times the --concurrency of the worker (the number of the cpus by default)
+#       idle containers
+FASTCI_WARM_POOL_SIZE = 0
+FASTCI_WARM_POOL_SIZE_PER_IMAGE = 4
+# both for the idle containers and for the images that aren't used anymore
+FASTCI_WARM_POOL_IDLE_TTL_SECS = 600
+FASTCI_WARM_POOL_DIR = BASE_DIR / 'warm_pool'
+
+# Where the output of the jobs is stored
+FASTCI_LOGS_DIR = BASE_DIR / 'logs'
+
+# Where the results of the jobs with `cache` are stored, see job_cache
+FASTCI_JOB_CACHE_DIR = BASE_DIR / 'job_cache'
+# The entries that are still being put together after this long were abandoned (the worker died), and are removed
+FASTCI_JOB_CACHE_TMP_TTL_SECS = 60 * 60
+FASTCI_JOB_CACHE_GC_INTERVAL_SECS = 300
+
+# Bare mirrors of the repositories of the pipelines in the repo mode, see repo_cache
+FASTCI_REPO_MIRROR_DIR = BASE_DIR / 'repo_mirrors'
+
+# Admission control - the ready jobs are started only while their runner can take them, the rest are QUEUED, see
+# admission. These are for the local docker, the remote runners announce their own. None == all of the host's
+# cpus/memory. The jobs can ask for their own `cpus` and `memory` in the pipeline, those are also the limits of their
+# containers. The ones that don't are counted as the defaults below (and aren't limited)
+FASTCI_MAX_RUNNING_JOBS = 4 * (os.cpu_count() or 1)
+FASTCI_HOST_CPUS = None
+FASTCI_HOST_MEMORY_BYTES = None
+FASTCI_DEFAULT_JOB_CPUS = 0.0
+FASTCI_DEFAULT_JOB_MEMORY_BYTES = 0
+
+# Remote runners, see runners. Each agent announces itself every FASTCI_RUNNER_HEARTBEAT_SECS, and its runner is gone
+# (and its unfinished jobs fail) if it doesn't for FASTCI_RUNNER_TTL_SECS
+FASTCI_RUNNER_HEARTBEAT_SECS = 5
+FASTCI_RUNNER_TTL_SECS = 20
+# the jobs with `runner_labels` can only run on the local docker if it has all of them
+FASTCI_LOCAL_RUNNER_LABELS = []
+# The docker of each remote runner is talked to directly (see runners), so only over TLS: the CA that signed the
+# certificates of the runners' dockers (`dockerd --tlsverify`), and our client certificate and key they trust. Without
+# them the remote runners are ignored
+FASTCI_RUNNER_TLS_CA_CERT = None
+FASTCI_RUNNER_TLS_CLIENT_CERT = None
+FASTCI_RUNNER_TLS_CLIENT_KEY = None
+
+# How long the outcome of the tasks enqueued by the action endpoints can be asked for, see reports
+FASTCI_TASK_REPORT_TTL_SECS = 24 * 60 * 60
+# A pipeline is saved before its containers are created, and it's deleted if that fails. The ones that still don't have
+# any jobs after this long were left behind by a worker that died in the middle, and are deleted by the scheduler
+FASTCI_ABANDONED_PIPELINE_SECS = 60 * 60
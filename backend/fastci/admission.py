@@ -0,0 +1,148 @@
+from typing import Union
+
+from django.conf import settings
+from django.db.models import Count, Sum, Value
+from django.db.models.functions import Coalesce
+
+from . import models
+from . import runners
+
+# The ready jobs are started only if their runner can take them, see Capacity. The ones that don't fit are QUEUED and
+# wait until some of the running ones are done
+#
+# WARN: Each worker counts what's running at the start of its tick, so the workers stepping at the same time might
+#       overshoot the capacity by a bit. That's fine, the point is to not start hundreds of containers at once
+
+MEMORY_UNITS = {'b': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
+
+
+def parse_memory(value: Union[int, str]) -> int:
+    """
+    Args:
+        value: bytes, or the same thing the docker accepts, i.e. '512m' or '2g'
+
+    Raises: ValueError if it's neither
+
+    Returns: the number of bytes
+    """
+    if isinstance(value, bool) or not isinstance(value, (int, str)):
+        raise ValueError(f'Not a memory size: {value}')
+
+    if isinstance(value, str) and value and value[-1].lower() in MEMORY_UNITS:
+        memory_bytes = int(value[:-1]) * MEMORY_UNITS[value[-1].lower()]
+    else:
+        memory_bytes = int(value)
+
+    if memory_bytes <= 0:
+        raise ValueError(f'Not a memory size: {value}')
+
+    return memory_bytes
+
+
+def requested_cpus(job: models.Job) -> float:
+    return job.cpus if job.cpus is not None else settings.FASTCI_DEFAULT_JOB_CPUS
+
+
+def requested_memory_bytes(job: models.Job) -> int:
+    return job.memory_bytes if job.memory_bytes is not None else settings.FASTCI_DEFAULT_JOB_MEMORY_BYTES
+
+
+class Usage:
+    """
+    What the running jobs take from one runner
+    """
+    __slots__ = ('running_count', 'cpus', 'memory_bytes')
+
+    running_count: int
+    cpus: float
+    memory_bytes: int
+
+    def __init__(self, running_count: int = 0, cpus: float = 0.0, memory_bytes: int = 0):
+        self.running_count = running_count
+        self.cpus = cpus
+        self.memory_bytes = memory_bytes
+
+
+class Capacity:
+    """
+    What the running jobs take from each runner, kept up to date during a tick as the jobs are started and finished
+    """
+    # the ones that are alive right now
+    runner_infos: dict[str, runners.RunnerInfo]
+    usage: dict[str, Usage]
+    # started (or about to be) during this tick
+    admitted_ids: set[int]
+    # true <=> something was freed during this tick, so the queued jobs might fit now
+    released: bool
+
+    def __init__(self, runner_infos: dict[str, runners.RunnerInfo], usage: dict[str, Usage]):
+        self.runner_infos = runner_infos
+        self.usage = {name: usage.get(name, Usage()) for name in runner_infos}
+        self.admitted_ids = set()
+        self.released = False
+
+    @classmethod
+    def current(cls, runner_infos: dict[str, runners.RunnerInfo]) -> 'Capacity':
+        """
+        Takes 1 query, no matter how many jobs are running
+        """
+        rows = models.Job.objects.filter(status=models.JobStatus.RUNNING).order_by().values('runner').annotate(
+            count=Count('pk'),
+            cpus=Sum(Coalesce('cpus', Value(float(settings.FASTCI_DEFAULT_JOB_CPUS)))),
+            memory_bytes=Sum(Coalesce('memory_bytes', Value(settings.FASTCI_DEFAULT_JOB_MEMORY_BYTES)))
+        )
+
+        return cls(runner_infos, {row['runner']: Usage(row['count'], row['cpus'] or 0.0, row['memory_bytes'] or 0)
+                                  for row in rows})
+
+    def fits(self, job: models.Job) -> bool:
+        if job.runner not in self.runner_infos:
+            return False
+
+        info = self.runner_infos[job.runner]
+        usage = self.usage[job.runner]
+
+        # Otherwise a job that asks for more than the whole runner would never start
+        if usage.running_count == 0:
+            return True
+
+        if info.max_running_jobs is not None and usage.running_count >= info.max_running_jobs:
+            return False
+
+        return usage.cpus + requested_cpus(job) <= info.cpus \
+            and usage.memory_bytes + requested_memory_bytes(job) <= info.memory_bytes
+
+    def admit(self, job: models.Job) -> bool:
+        """
+        Takes the job's share of its runner if it fits. Can be called again for the same job during the tick
+
+        Returns: True if the job may be started
+        """
+        if job.pk in self.admitted_ids:
+            return True
+
+        if not self.fits(job):
+            return False
+
+        usage = self.usage[job.runner]
+        self.admitted_ids.add(job.pk)
+        usage.running_count += 1
+        usage.cpus += requested_cpus(job)
+        usage.memory_bytes += requested_memory_bytes(job)
+
+        return True
+
+    def release(self, job: models.Job):
+        """
+        Gives back the share of a job that has stopped running (or didn't manage to start)
+        """
+        self.released = True
+        self.admitted_ids.discard(job.pk)
+
+        if job.runner not in self.usage:
+            return
+
+        usage = self.usage[job.runner]
+        usage.running_count = max(0, usage.running_count - 1)
+        usage.cpus = max(0.0, usage.cpus - requested_cpus(job))
+        usage.memory_bytes = max(0, usage.memory_bytes - requested_memory_bytes(job))
@@ -0,0 +1,133 @@
+import asyncio
+import json
+import struct
+from typing import Optional
+from urllib.parse import urlencode, quote
+
+import docker.errors
+import requests
+
+
+class AsyncDockerClient:
+    """
+    Just enough of the Docker Engine API to look at many containers at once, talks to the unix socket directly with
+    asyncio. At most `concurrency` requests are in flight, the rest wait for their turn
+
+    WARN: The semaphore is bound to the event loop it's first used in, so create a new client for each asyncio.run
+    """
+    socket_path: str
+    semaphore: asyncio.Semaphore
+
+    def __init__(self, socket_path: str, concurrency: int):
+        self.socket_path = socket_path
+        self.semaphore = asyncio.Semaphore(concurrency)
+
+    async def _request(self, method: str, path: str, params: Optional[dict] = None) -> bytes:
+        """
+        Raises: docker.errors.NotFound or docker.errors.APIError, same as the docker SDK
+
+        Returns: the body of the response
+        """
+        if params:
+            path = f'{path}?{urlencode(params)}'
+
+        async with self.semaphore:
+            reader, writer = await asyncio.open_unix_connection(self.socket_path)
+
+            try:
+                # a new connection for each request, it's just a unix socket, so it's cheap, and there's no pool to keep
+                writer.write(f'{method} {path} HTTP/1.1\r\nHost: docker\r\nConnection: close\r\n\r\n'.encode('ascii'))
+                await writer.drain()
+                status, headers = await self._read_head(reader)
+
+                if headers.get('transfer-encoding') == 'chunked':
+                    body = await self._read_chunked(reader)
+                elif 'content-length' in headers:
+                    body = await reader.readexactly(int(headers['content-length']))
+                else:
+                    body = await reader.read()
+            finally:
+                writer.close()
+
+        if status >= 400:
+            # the errors come as {"message": "..."}
+            try:
+                message = json.loads(body)['message']
+            except (ValueError, KeyError):
+                message = body.decode('utf-8', errors='replace')
+
+            # the callers look at e.status_code, which comes from the response
+            response = requests.Response()
+            response.status_code = status
+            response._content = body
+
+            if status == 404:
+                raise docker.errors.NotFound(message, response=response, explanation=message)
+
+            raise docker.errors.APIError(message, response=response, explanation=message)
+
+        return body
+
+    @staticmethod
+    async def _read_head(reader: asyncio.StreamReader) -> tuple[int, dict[str, str]]:
+        status_line = await reader.readline()
+        # HTTP/1.1 200 OK
+        status = int(status_line.split()[1])
+        headers = dict()
+
+        while (line := await reader.readline()) not in (b'\r\n', b''):
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        return status, headers
+
+    @staticmethod
+    async def _read_chunked(reader: asyncio.StreamReader) -> bytes:
+        parts = []
+
+        while size := int((await reader.readline()).split(b';')[0], 16):
+            parts.append(await reader.readexactly(size))
+            # the \r\n after each chunk
+            await reader.readline()
+
+        return b''.join(parts)
+
+    async def start_container(self, container_id: str):
+        await self._request('POST', f'/containers/{quote(container_id)}/start')
+
+    async def inspect_container(self, container_id: str) -> dict:
+        """
+        Returns: the same thing as docker.models.containers.Container.attrs
+        """
+        return json.loads(await self._request('GET', f'/containers/{quote(container_id)}/json'))
+
+    async def container_logs(self, container_id: str, stdout: bool, stderr: bool, timestamps: bool,
+                             since: Optional[float] = None) -> bytes:
+        """
+        Returns: the same thing as docker.models.containers.Container.logs
+        """
+        params = {'stdout': int(stdout), 'stderr': int(stderr), 'timestamps': int(timestamps)}
+
+        if since is not None:
+            params['since'] = since
+
+        body = await self._request('GET', f'/containers/{quote(container_id)}/logs', params)
+        return demultiplex(body)
+
+
+def demultiplex(body: bytes) -> bytes:
+    """
+    Strips the frame headers the docker puts around the output of the containers without a tty (i.e. all of ours)
+
+    Returns: just the output, in the order it was sent
+    """
+    parts = []
+    offset = 0
+
+    # each frame is [stream type, 0, 0, 0, size (4 bytes, big endian)] and then the data
+    while offset + 8 <= len(body):
+        _, size = struct.unpack_from('>BxxxL', body, offset)
+        parts.append(body[offset + 8:offset + 8 + size])
+        offset += 8 + size
+
+    return b''.join(parts)
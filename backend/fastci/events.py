@@ -0,0 +1,101 @@
+import json
+import threading
+from typing import Optional
+
+from . import models
+
+# What has changed is collected while the pipelines are being stepped and published all at once by
+# tasks.notify_of_change. So the clients can patch what they show, instead of fetching everything again. See
+# websocket_consumers for how they subscribe
+#
+# Only the real changes are here (status, exit code, the container being cleaned up), not the uptime ticking while the
+# job is running
+
+CHANNEL = 'pipeline-job-state-change'
+
+# per thread, since each one steps its own pipelines, see leases
+pending = threading.local()
+
+
+def get_pending() -> tuple[dict[int, dict], dict[int, dict]]:
+    if not hasattr(pending, 'pipelines'):
+        pending.pipelines = dict()
+        pending.jobs = dict()
+        # see versions
+        pending.status_changed_pipeline_ids = set()
+        # see reports
+        pending.tasks = dict()
+        # the ones whose creation has failed, see tasks.do_create_pipeline
+        pending.deleted_pipeline_ids = set()
+
+    return pending.pipelines, pending.jobs
+
+
+def pipeline_changed(pipeline: models.Pipeline, status_changed: bool = True):
+    """
+    Args:
+        status_changed: false if it's only the summary or something else that its jobs don't show
+    """
+    if status_changed:
+        get_pending()
+        pending.status_changed_pipeline_ids.add(pipeline.pk)
+
+    get_pending()[0][pipeline.pk] = {'id': pipeline.pk, 'status': pipeline.status, 'job_counts': pipeline.job_counts,
+                                     'failed_exit_count': pipeline.failed_exit_count,
+                                     'total_uptime_secs': pipeline.total_uptime_secs,
+                                     'created_secs': pipeline.created_secs, 'started_secs': pipeline.started_secs,
+                                     'finished_secs': pipeline.finished_secs}
+
+
+def pipeline_deleted(pipeline_id: int):
+    get_pending()[0].pop(pipeline_id, None)
+    pending.deleted_pipeline_ids.add(pipeline_id)
+
+
+def job_changed(job: models.Job):
+    get_pending()[1][job.pk] = {'id': job.pk, 'pipeline_id': job.pipeline_id, 'status': job.status,
+                                'exit_code': job.exit_code, 'uptime_secs': job.uptime_secs,
+                                'container_id': job.container_id}
+
+
+def changed_pipeline_ids() -> set[int]:
+    """
+    Returns: the pipelines that have changed themselves (or are gone) or whose jobs have, since the last time
+    """
+    pipelines, jobs = get_pending()
+    return set(pipelines) | pending.deleted_pipeline_ids | {job['pipeline_id'] for job in jobs.values()}
+
+
+def task_finished(report: dict):
+    get_pending()
+    pending.tasks[report['id']] = report
+
+
+def changed_job_ids() -> set[int]:
+    return set(get_pending()[1])
+
+
+def status_changed_pipeline_ids() -> set[int]:
+    get_pending()
+    return set(pending.status_changed_pipeline_ids)
+
+
+def take() -> Optional[str]:
+    """
+    Returns: the message with everything that has changed since the last time, None if nothing has
+    """
+    pipelines, jobs = get_pending()
+
+    if not pipelines and not jobs and not pending.tasks and not pending.deleted_pipeline_ids:
+        return None
+
+    message = json.dumps({'pipelines': list(pipelines.values()), 'jobs': list(jobs.values()),
+                          'tasks': list(pending.tasks.values()),
+                          'deleted_pipelines': sorted(pending.deleted_pipeline_ids)})
+    pipelines.clear()
+    jobs.clear()
+    pending.status_changed_pipeline_ids.clear()
+    pending.tasks.clear()
+    pending.deleted_pipeline_ids.clear()
+
+    return message
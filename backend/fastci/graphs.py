@@ -0,0 +1,222 @@
+from typing import Optional
+
+from django.db.models import Avg
+
+from . import models
+
+
+class JobNode:
+    """
+    What the scheduler needs to know about a job, without dragging the whole model around
+    """
+    __slots__ = ('id', 'status', 'exit_code', 'children', 'parents_left', 'dependency_failed', 'priority')
+
+    id: int
+    status: models.JobStatus
+    exit_code: Optional[int]
+    children: list['JobNode']
+    # how many parents haven't succeeded yet
+    parents_left: int
+    # true <=> at least one parent has failed
+    dependency_failed: bool
+    # how long (in expected seconds) the longest chain of jobs from this one to the end of the pipeline is, see
+    # compute_priorities
+    priority: float
+
+    def __init__(self, id: int, status: models.JobStatus, exit_code: Optional[int]):
+        self.id = id
+        self.status = status
+        self.exit_code = exit_code
+        self.children = []
+        self.parents_left = 0
+        self.dependency_failed = False
+        self.priority = 0.0
+
+    # @CopyPaste - keep in sync with models.Job
+    def is_failed(self) -> bool:
+        return self.is_complete() and not self.is_successfull()
+
+    def is_successfull(self) -> bool:
+        return self.status == models.JobStatus.FINISHED and self.exit_code == 0
+
+    def is_complete(self) -> bool:
+        return self.status not in (models.JobStatus.NOT_STARTED, models.JobStatus.QUEUED, models.JobStatus.RUNNING)
+
+
+def expected_durations(pipeline: models.Pipeline, names: dict[int, str]) -> dict[int, float]:
+    """
+    Takes 1 query
+
+    Args:
+        names: job id -> name, for the jobs of the pipeline
+
+    Returns: job id -> the average uptime of the jobs with the same name that have succeeded before. The ones that have
+             never been run are expected to take as long as the others on average
+    """
+    # the ones from the cache haven't really run
+    history = dict(models.Job.objects.filter(name__in=set(names.values()), status=models.JobStatus.FINISHED,
+                                             exit_code=0, cache_hit=False)
+                   .exclude(pipeline=pipeline).order_by().values('name').annotate(average=Avg('uptime_secs'))
+                   .values_list('name', 'average'))
+    default = sum(history.values()) / len(history) if history else 1.0
+
+    return {job_id: history.get(name, default) for job_id, name in names.items()}
+
+
+class PipelineGraph:
+    """
+    The dependency graph of a pipeline together with the statuses of its jobs. Lets the scheduler look only at the
+    jobs that can actually change instead of scanning all of them (and their parents) on every tick.
+
+    The structure of the graph never changes after the pipeline is created, so the graph can be built once and then
+    kept up to date via `job_changed`
+    """
+    nodes: dict[int, JobNode]
+    # not started (or queued), and all of the parents have succeeded (or there are none)
+    ready: set[int]
+    running: set[int]
+    # not started, but at least one of the parents has failed
+    doomed: set[int]
+    incomplete_count: int
+
+    def __init__(self, nodes: dict[int, JobNode], edges: list[tuple[int, int]]):
+        self.nodes = nodes
+        self.ready = set()
+        self.running = set()
+        self.doomed = set()
+        self.incomplete_count = 0
+
+        for child_id, parent_id in edges:
+            child, parent = nodes[child_id], nodes[parent_id]
+            parent.children.append(child)
+
+            if parent.is_failed():
+                child.dependency_failed = True
+            elif not parent.is_successfull():
+                child.parents_left += 1
+
+        for node in nodes.values():
+            if not node.is_complete():
+                self.incomplete_count += 1
+
+            self._classify(node)
+
+    @classmethod
+    def build(cls, pipeline: models.Pipeline) -> Optional['PipelineGraph']:
+        """
+        Takes 3 queries, no matter how big the pipeline is - the jobs, the edges and the history, see expected_durations
+
+        Returns: None if the pipeline doesn't have any jobs (yet)
+        """
+        rows = list(models.Job.objects.filter(pipeline=pipeline).values_list('pk', 'status', 'exit_code', 'name'))
+
+        if not rows:
+            return None
+
+        nodes = {pk: JobNode(pk, status, exit_code) for pk, status, exit_code, _ in rows}
+        # from_job is the one who has the parents
+        edges = list(models.Job.parents.through.objects.filter(from_job__pipeline=pipeline)
+                     .values_list('from_job_id', 'to_job_id'))
+
+        graph = cls(nodes, edges)
+        graph.compute_priorities(expected_durations(pipeline, {pk: name for pk, _, _, name in rows}))
+
+        return graph
+
+    def compute_priorities(self, durations: dict[int, float]):
+        """
+        The critical path first - the ready jobs with the longest chains after them are started before the others, so
+        the pipeline as a whole is done sooner when not everything can run at once
+
+        Args:
+            durations: job id -> how long the job is expected to take
+        """
+        parents = {node.id: [] for node in self.nodes.values()}
+        children_left = {node.id: len(node.children) for node in self.nodes.values()}
+
+        for node in self.nodes.values():
+            for child in node.children:
+                parents[child.id].append(node)
+
+        # the leaves first, then the ones whose children are all done, and so on
+        to_visit = [node for node in self.nodes.values() if not node.children]
+
+        while to_visit:
+            node = to_visit.pop()
+            node.priority = durations[node.id] + max((child.priority for child in node.children), default=0.0)
+
+            for parent in parents[node.id]:
+                children_left[parent.id] -= 1
+
+                if children_left[parent.id] == 0:
+                    to_visit.append(parent)
+
+        # WARN: The jobs in a cycle are never visited and keep 0. They will never start anyway
+
+    def by_priority(self, job_ids: set[int]) -> list[int]:
+        """
+        Returns: the ids in the order in which the jobs should be stepped - the running ones first, since they might
+                 free some capacity for the others, and then the most critical ones
+        """
+        return sorted(job_ids, key=lambda job_id: (job_id not in self.running, -self.nodes[job_id].priority, job_id))
+
+    def _classify(self, node: JobNode):
+        self.ready.discard(node.id)
+        self.running.discard(node.id)
+        self.doomed.discard(node.id)
+
+        if node.status == models.JobStatus.RUNNING:
+            self.running.add(node.id)
+        elif node.status == models.JobStatus.NOT_STARTED or node.status == models.JobStatus.QUEUED:
+            if node.dependency_failed:
+                self.doomed.add(node.id)
+            elif node.parents_left == 0:
+                self.ready.add(node.id)
+
+    def active_ids(self) -> set[int]:
+        """
+        Returns: ids of the jobs that the scheduler has to look at - all the others can't change by themselves
+        """
+        return self.ready | self.running | self.doomed
+
+    def job_changed(self, job: models.Job):
+        """
+        Updates the state of the graph after the job's status might have changed, releasing the children if needed
+        """
+        node = self.nodes[job.pk]
+        was_complete = node.is_complete()
+        node.status = job.status
+        node.exit_code = job.exit_code
+        self._classify(node)
+
+        if was_complete or not node.is_complete():
+            return
+
+        self.incomplete_count -= 1
+
+        for child in node.children:
+            if node.is_successfull():
+                child.parents_left -= 1
+            else:
+                child.dependency_failed = True
+
+            self._classify(child)
+
+    def is_complete(self) -> bool:
+        return self.incomplete_count == 0
+
+    def final_status(self) -> models.PipelineStatus:
+        """
+        Returns: status of a pipeline whose jobs are all complete
+        """
+        assert self.is_complete(), 'Pipeline is not complete yet!'
+        nodes = self.nodes.values()
+
+        # all jobs are either cancelled, transitively cancelled or successfull
+        if all(node.status == models.JobStatus.CANCELLED or node.status == models.JobStatus.DEPENDENCY_FAILED or
+               node.is_successfull() for node in nodes) and any(not node.is_successfull() for node in nodes):
+            return models.PipelineStatus.CANCELLED
+        elif any(node.is_failed() for node in nodes):
+            return models.PipelineStatus.FAILED
+        else:
+            return models.PipelineStatus.FINISHED
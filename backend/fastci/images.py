@@ -0,0 +1,94 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import docker.errors
+import docker.models.images
+from django.conf import settings
+from django.db import IntegrityError
+
+from . import models
+
+logger = logging.getLogger('fastci')
+
+
+def get_or_pull_image(client: docker.DockerClient, name: str) -> tuple[docker.models.images.Image, bool]:
+    """
+    Returns: the image and whether we had to pull it
+    """
+    try:
+        return client.images.get(name), False
+    except docker.errors.ImageNotFound:
+        logger.info(f'Pulling {name}')
+        # without a tag it pulls :latest, same as `docker pull`
+        return client.images.pull(name), True
+
+
+def resolve_images(client: docker.DockerClient, names: set[str], remember: bool = True) -> dict[str, str]:
+    """
+    Makes sure that all of the images are present, pulling the missing ones in parallel, and remembers that they were
+    just used, see collect_garbage
+
+    Args:
+        remember: False for the dockers of the remote runners, they have to look after their own disks
+
+    Raises: docker.errors.APIError if any of the images can't be found or pulled
+
+    Returns: image name -> its id (sha256:...), which doesn't change if someone moves the tag later
+    """
+    with ThreadPoolExecutor(max_workers=settings.FASTCI_PULL_IMAGE_THREADS) as executor:
+        results = dict(zip(names, executor.map(lambda name: get_or_pull_image(client, name), names)))
+
+    now = time.time()
+
+    for name, (image, pulled) in results.items() if remember else []:
+        try:
+            image_model, _ = models.Image.objects.get_or_create(name=name)
+        except IntegrityError:
+            # another worker has pulled the same image at the same time
+            image_model = models.Image.objects.get(name=name)
+
+        # Not saved as a whole, so the other workers don't overwrite it with what they've read before. Once pulled, it
+        # can always be pulled again
+        models.Image.objects.filter(pk=image_model.pk).update(digest=image.id, size_bytes=image.attrs.get('Size', 0),
+                                                              last_used_secs=now, **({'pulled': True} if pulled else {}))
+
+    return {name: image.id for name, (image, _) in results.items()}
+
+
+def collect_garbage(client: docker.DockerClient, budget_bytes: int) -> list[str]:
+    """
+    Removes the least recently used images until the ones we've pulled fit into the budget. The images that were
+    already there (i.e. built locally) are never removed, since we have no way of getting them back. Neither are the
+    ones that some of the not yet cleaned up jobs still use
+
+    Returns: names of the removed images
+    """
+    pulled = list(models.Image.objects.filter(pulled=True).order_by('last_used_secs'))
+    total_bytes = sum(image_model.size_bytes for image_model in pulled)
+    in_use = set(models.Job.objects.filter(container_id__isnull=False).values_list('image_digest', flat=True))
+    removed = []
+
+    for image_model in pulled:
+        if total_bytes <= budget_bytes:
+            break
+
+        if image_model.digest in in_use:
+            continue
+
+        try:
+            # Not forced, so the docker refuses if anything else still uses it. By the id, since the name might point to
+            # another image by now
+            client.images.remove(image_model.digest)
+        except docker.errors.ImageNotFound:
+            # someone has removed it behind our back, it doesn't take any space anyway
+            pass
+        except docker.errors.APIError as e:
+            logger.warning(f'Could not remove image {image_model.name}: {e}')
+            continue
+
+        total_bytes -= image_model.size_bytes
+        image_model.delete()
+        removed.append(image_model.name)
+
+    return removed
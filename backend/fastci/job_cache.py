@@ -0,0 +1,195 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+from pathlib import Path
+from typing import Optional
+
+from django.conf import settings
+
+from . import logs
+from . import models
+
+# Inside <FASTCI_JOB_CACHE_DIR>/<key>
+OUTPUTS_DIR_NAME = 'outputs'
+LOGS_DIR_NAME = 'logs'
+# The entries are put together in <FASTCI_JOB_CACHE_DIR>/<TMP_PREFIX>..., see collect_garbage
+TMP_PREFIX = '.tmp-'
+
+
+def static_key(image_digest: str, command: str, volumes: list[str], commit_hash: Optional[str]) -> str:
+    """
+    The part of the key that is known when the pipeline is submitted
+    """
+    return hashlib.sha256(json.dumps([image_digest, command, volumes, commit_hash]).encode()).hexdigest()
+
+
+def hash_path(digest: 'hashlib._Hash', path: Path):
+    """
+    Feeds the contents of a file or of a whole directory (and the names of the files) into the digest
+    """
+    if path.is_symlink():
+        digest.update(b'l' + os.readlink(path).encode())
+    elif path.is_file():
+        # the exec bit matters for the scripts
+        digest.update(b'x' if os.access(path, os.X_OK) else b'f')
+
+        with open(path, 'rb') as f:
+            while chunk := f.read(1024 * 1024):
+                digest.update(chunk)
+    elif path.is_dir():
+        digest.update(b'd')
+
+        for child in sorted(path.iterdir()):
+            digest.update(child.name.encode() + b'\0')
+            hash_path(digest, child)
+    else:
+        digest.update(b'-')
+
+
+def compute_key(cache_spec: dict, pipeline_dir: Optional[Path]) -> str:
+    """
+    Args:
+        cache_spec: Job.cache_spec
+        pipeline_dir: where the inputs are, must be there if there are any
+
+    Returns: the key of the job's result, can only be computed once the parents are done, since they make the inputs
+    """
+    digest = hashlib.sha256(cache_spec['static_key'].encode())
+
+    for input_path in sorted(cache_spec['inputs']):
+        digest.update(b'\0' + input_path.encode() + b'\0')
+        hash_path(digest, pipeline_dir / input_path)
+
+    return digest.hexdigest()
+
+
+def entry_dir(key: str) -> Path:
+    return Path(settings.FASTCI_JOB_CACHE_DIR) / key
+
+
+def copy_path(source: Path, destination: Path):
+    destination.parent.mkdir(parents=True, exist_ok=True)
+
+    if source.is_dir() and not source.is_symlink():
+        shutil.copytree(source, destination, symlinks=True, dirs_exist_ok=True)
+    elif source.exists() or source.is_symlink():
+        shutil.copy2(source, destination, follow_symlinks=False)
+
+
+def store(key: str, job_model: models.Job, pipeline_dir: Optional[Path]):
+    """
+    Saves the outputs and the logs of a job that has just succeeded
+    """
+    if models.CacheEntry.objects.filter(key=key).exists():
+        return
+
+    root = Path(settings.FASTCI_JOB_CACHE_DIR)
+    root.mkdir(parents=True, exist_ok=True)
+    # put together on the side (on the same filesystem, so it can be moved in place at once), so nobody sees half of an
+    # entry. If we die in the middle, collect_garbage takes care of the leftovers
+    tmp_dir = Path(tempfile.mkdtemp(prefix=TMP_PREFIX, dir=root))
+
+    try:
+        for output_path in job_model.cache_spec['outputs']:
+            copy_path(pipeline_dir / output_path, tmp_dir / OUTPUTS_DIR_NAME / output_path)
+
+        log_store = logs.JobLogStore(job_model.pk)
+        (tmp_dir / LOGS_DIR_NAME).mkdir()
+
+        for stream in logs.STREAMS:
+            with open(tmp_dir / LOGS_DIR_NAME / stream, 'wb') as f:
+                for offset in range(0, log_store.size(stream), logs.CHUNK_SIZE):
+                    f.write(log_store.read(stream, offset, min(offset + logs.CHUNK_SIZE, log_store.size(stream))))
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+    try:
+        os.replace(tmp_dir, entry_dir(key))
+    except OSError:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+        # Someone else has stored the same thing in the meantime, or we died before recording it last time. Either way
+        # it's the same result, so it just has to be recorded
+        if not entry_dir(key).is_dir():
+            raise
+
+    now = time.time()
+    models.CacheEntry.objects.get_or_create(key=key, defaults={'exit_code': job_model.exit_code, 'created_secs': now,
+                                                               'last_used_secs': now})
+
+
+def restore_outputs(key: str, cache_spec: dict, pipeline_dir: Optional[Path]) -> Optional[models.CacheEntry]:
+    """
+    Puts the outputs back into the pipeline dir. Doesn't need the job itself, so it can be done before the job is
+    created, see restore_logs
+
+    Returns: None if there's nothing under the key
+    """
+    entry = models.CacheEntry.objects.filter(key=key).first()
+
+    if entry is None or not entry_dir(key).exists():
+        return None
+
+    for output_path in cache_spec['outputs']:
+        copy_path(entry_dir(key) / OUTPUTS_DIR_NAME / output_path, pipeline_dir / output_path)
+
+    entry.last_used_secs = time.time()
+    entry.save()
+
+    return entry
+
+
+def restore_logs(key: str, job_id: int):
+    """
+    Puts the logs into the job's log store, the entry must be there, see restore_outputs
+    """
+    log_store = logs.JobLogStore(job_id)
+
+    for stream in logs.STREAMS:
+        with open(entry_dir(key) / LOGS_DIR_NAME / stream, 'rb') as f:
+            while chunk := f.read(logs.CHUNK_SIZE):
+                log_store.append(stream, chunk)
+
+
+def restore(key: str, job_model: models.Job, pipeline_dir: Optional[Path]) -> Optional[models.CacheEntry]:
+    """
+    Puts the outputs back into the pipeline dir and the logs into the job's log store
+
+    Returns: None if there's nothing under the key
+    """
+    entry = restore_outputs(key, job_model.cache_spec, pipeline_dir)
+
+    if entry is not None:
+        restore_logs(key, job_model.pk)
+
+    return entry
+
+
+def collect_garbage() -> list[Path]:
+    """
+    Removes the entries that were never finished, i.e. whoever was storing them has died
+
+    Returns: the removed directories
+    """
+    root = Path(settings.FASTCI_JOB_CACHE_DIR)
+    removed = []
+
+    if not root.is_dir():
+        return removed
+
+    for path in root.glob(TMP_PREFIX + '*'):
+        try:
+            stale = time.time() - path.stat().st_mtime > settings.FASTCI_JOB_CACHE_TMP_TTL_SECS
+        except FileNotFoundError:
+            # just finished
+            continue
+
+        if stale:
+            shutil.rmtree(path, ignore_errors=True)
+            removed.append(path)
+
+    return removed
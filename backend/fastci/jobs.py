@@ -1,16 +1,29 @@
+import calendar
+import heapq
 import logging
 import time
 from datetime import datetime
+from pathlib import Path
 from typing import Optional
 
 import docker.errors
 import docker.models.containers
 
+from . import aiodocker
+from . import events
+from . import logs
 from . import models
+from . import warm_pool
 
 logging.basicConfig()
 logger = logging.getLogger('fastci')
 
+# Every container we create is labelled with MANAGED_LABEL, so we can find all of them at once. And the ones created for
+# a job also get the other two, unless they were taken from the warm pool
+MANAGED_LABEL = 'fastci'
+PIPELINE_LABEL = 'fastci.pipeline'
+JOB_LABEL = 'fastci.job'
+
 
 def docker_timestamp_to_seconds(s: str) -> float:
     # stupid shit... (just for the record - the year part won't parse with datetime, because the min year it supports
@@ -25,38 +38,248 @@ def docker_timestamp_to_seconds(s: str) -> float:
     return datetime.strptime(base_part, '%Y-%m-%dT%H:%M:%S.').timestamp() + extra_secs
 
 
+def parse_log_timestamp(s: str) -> tuple[int, int]:
+    """
+    Parses the timestamps that docker puts in front of the log lines, i.e. 2022-01-12T02:28:17.123456789Z
+
+    Returns: (seconds since epoch in UTC, nanoseconds), so they can be compared exactly
+    """
+    # the fractional part is omitted completely if it's zero
+    base_part, _, nanosecs_part = s.rstrip('Z').partition('.')
+    secs = calendar.timegm(time.strptime(base_part, '%Y-%m-%dT%H:%M:%S'))
+    return secs, int(nanosecs_part.ljust(9, '0'))
+
+
+def log_cursor_to_since(cursor: str) -> Optional[float]:
+    """
+    Returns: what to pass as `since` to the docker to get the lines printed after the cursor (and a bit more, see
+             DockerJob.fetch_new_lines)
+    """
+    if not cursor:
+        return None
+
+    secs, nanosecs = parse_log_timestamp(cursor)
+    # `since` is inclusive, but only has the precision of a float, so go back a bit and skip the lines we've already seen
+    return secs + nanosecs / 1e9 - 1e-6
+
+
+def parse_new_lines(logs: bytes, cursor: str) -> list[tuple[tuple[int, int], str, bytes]]:
+    """
+    Args:
+        logs: what the docker gave us, with the timestamps
+
+    Returns: (parsed timestamp, timestamp, line) for every line that was printed after the cursor
+    """
+    parsed_cursor = parse_log_timestamp(cursor) if cursor else None
+    lines = logs.split(b'\n')
+    new_lines = []
+
+    # WARN: docker splits lines longer than 16k into several entries, and if that happens, the next timestamp ends up in
+    #       the middle of our "line". Whatever, it's only a bit of garbage in the output
+    for i, line in enumerate(lines):
+        if not line:
+            continue
+
+        timestamp, _, message = line.partition(b' ')
+        timestamp = timestamp.decode('ascii')
+        parsed_timestamp = parse_log_timestamp(timestamp)
+
+        if parsed_cursor is not None and parsed_timestamp <= parsed_cursor:
+            continue
+
+        # the last line might not have been terminated yet
+        if i != len(lines) - 1:
+            message += b'\n'
+
+        new_lines.append((parsed_timestamp, timestamp, message))
+
+    return new_lines
+
+
+class PrefetchedContainer:
+    """
+    What DockerJob would do with the docker during a step, done ahead of time, see prefetch_container
+    """
+    __slots__ = ('attrs', 'logs', 'started_secs', 'start_error')
+
+    # everything the docker knows about the container, if we needed to know. Otherwise (it's running) we don't
+    attrs: Optional[dict]
+    # 'stdout'/'stderr' -> the logs since the corresponding cursor of the job
+    logs: dict[str, bytes]
+    # if the container was started, when it was done, or why it couldn't be
+    started_secs: Optional[float]
+    start_error: Optional[docker.errors.APIError]
+
+    def __init__(self, attrs: Optional[dict], logs: dict[str, bytes], started_secs: Optional[float] = None,
+                 start_error: Optional[docker.errors.APIError] = None):
+        self.attrs = attrs
+        self.logs = logs
+        self.started_secs = started_secs
+        self.start_error = start_error
+
+
+async def prefetch_container(client: aiodocker.AsyncDockerClient, model: models.Job, container_state: Optional[str],
+                             start: bool = False) -> Optional[PrefetchedContainer]:
+    """
+    Args:
+        container_state: see DockerJob
+        start: start the container first, for the jobs that are about to be started anyway. Not for the pooled ones
+
+    Returns: None if the container is gone, then DockerJob will find out about it by itself
+    """
+    started_secs = None
+
+    if start:
+        try:
+            await client.start_container(model.container_id)
+        except docker.errors.APIError as e:
+            # DockerJob.start deals with it
+            return PrefetchedContainer(None, dict(), start_error=e)
+
+        started_secs = time.time()
+
+    try:
+        # The inspection goes first, so if the container has already exited, the logs are complete
+        attrs = None if container_state == 'running' and not start \
+            else await client.inspect_container(model.container_id)
+        stdout = await client.container_logs(model.container_id, stdout=True, stderr=False, timestamps=True,
+                                             since=log_cursor_to_since(model.stdout_log_cursor))
+        stderr = await client.container_logs(model.container_id, stdout=False, stderr=True, timestamps=True,
+                                             since=log_cursor_to_since(model.stderr_log_cursor))
+    except docker.errors.APIError as e:
+        logger.error(e)
+        # if it was started, DockerJob still has to know
+        return None if started_secs is None else PrefetchedContainer(None, dict(), started_secs)
+
+    return PrefetchedContainer(attrs, {'stdout': stdout, 'stderr': stderr}, started_secs)
+
+
 class DockerJob:
     container: docker.models.containers.Container
+    # last known state of the container, i.e. 'created', 'running', 'exited'
+    container_state: str
+    # true <=> container.attrs hold everything docker knows about the container, not just the id
+    inspected: bool
     timeout_secs: Optional[float]
     status: models.JobStatus
     host_start_time_secs: float
+    stdout_log_cursor: str
+    stderr_log_cursor: str
+    # stream -> logs that were fetched ahead of time, used up by fetch_new_lines
+    prefetched_logs: dict[str, bytes]
+    # see PrefetchedContainer, for start
+    started_secs: Optional[float]
+    start_error: Optional[docker.errors.APIError]
     job_model: models.Job
 
-    def __init__(self, client: docker.DockerClient, model: models.Job):
-        self.container = client.containers.get(model.container_id)
+    def __init__(self, client: docker.DockerClient, model: models.Job, container_state: Optional[str] = None,
+                 prefetched: Optional[PrefetchedContainer] = None):
+        """
+        container_state - the state of the container from a fresh containers.list (see PIPELINE_LABEL). If given, we
+                          don't ask the docker about this container until we really need something
+        prefetched - see prefetch_container, must have been fetched for the same state and cursors
+        """
+        self.prefetched_logs = dict()
+        self.started_secs = None
+        self.start_error = None
+
+        if prefetched is not None:
+            self.prefetched_logs = dict(prefetched.logs)
+            self.started_secs = prefetched.started_secs
+            self.start_error = prefetched.start_error
+
+        if prefetched is not None and prefetched.attrs is not None:
+            self.container = client.containers.prepare_model(prefetched.attrs)
+            self.container_state = self.container.attrs['State']['Status']
+            self.inspected = True
+        elif container_state is None:
+            self.container = client.containers.get(model.container_id)
+            self.container_state = self.container.attrs['State']['Status']
+            self.inspected = True
+        else:
+            self.container = client.containers.prepare_model({'Id': model.container_id})
+            self.container_state = container_state
+            self.inspected = False
+
         self.timeout_secs = model.timeout_secs
         self.status = model.status
         self.host_start_time_secs = model.host_start_time_secs
+        self.stdout_log_cursor = model.stdout_log_cursor
+        self.stderr_log_cursor = model.stderr_log_cursor
         self.job_model = model
 
+    def inspect(self):
+        self.container.reload()
+        self.container_state = self.container.attrs['State']['Status']
+        self.inspected = True
+
     def get_error(self) -> str:
         return self.container.attrs['State']['Error']
 
     def get_exit_code(self) -> int:
         return self.container.attrs['State']['ExitCode']
 
-    def get_output(self) -> bytes:
-        # FIXME: very inefficient
-        # Using logs because attach sometimes doesn't work for some reason...
-        return self.container.logs()
+    def fetch_new_lines(self, stream: str, cursor: str) -> list[tuple[tuple[int, int], str, bytes]]:
+        """
+        Fetches only the lines of the stream ('stdout' or 'stderr') that were printed after the cursor
+
+        Returns: (parsed timestamp, timestamp, line) for every new line
+        """
+        if stream in self.prefetched_logs:
+            logs = self.prefetched_logs.pop(stream)
+        else:
+            # Using logs because attach sometimes doesn't work for some reason...
+            logs: bytes = self.container.logs(stdout=stream == 'stdout', stderr=stream == 'stderr', timestamps=True,
+                                              since=log_cursor_to_since(cursor))
+
+        return parse_new_lines(logs, cursor)
+
+    def capture_new_output(self):
+        """
+        Appends everything that was printed since the last time to the log store and moves the cursors
+        """
+        if self.host_start_time_secs == 0:
+            # never started => nothing to read
+            return
+
+        stdout_lines = self.fetch_new_lines('stdout', self.stdout_log_cursor)
+        stderr_lines = self.fetch_new_lines('stderr', self.stderr_log_cursor)
+
+        if stdout_lines:
+            self.stdout_log_cursor = stdout_lines[-1][1]
+
+        if stderr_lines:
+            self.stderr_log_cursor = stderr_lines[-1][1]
+
+        store = logs.JobLogStore(self.job_model.pk)
+        store.append('stdout', b''.join(line for _, _, line in stdout_lines))
+        store.append('stderr', b''.join(line for _, _, line in stderr_lines))
+        # interleave them back by the timestamps
+        store.append('all', b''.join(line for _, _, line in heapq.merge(stdout_lines, stderr_lines,
+                                                                         key=lambda entry: entry[0])))
 
     def start(self):
         self.status = models.JobStatus.RUNNING
 
         try:
-            self.container.start()
-            self.container.reload()
-            self.host_start_time_secs = time.time()
+            if self.job_model.pool_slot is not None:
+                # it's already running and only waits for our signal
+                warm_pool.start_claimed(Path(self.job_model.pool_slot))
+            elif self.start_error is not None:
+                # it was started ahead of time and we only have to deal with the outcome
+                raise self.start_error
+            elif self.started_secs is None:
+                self.container.start()
+
+            # the attrs from the constructor are fresh enough if it was started ahead of time
+            if self.started_secs is None or not self.inspected:
+                self.inspect()
+
+            self.host_start_time_secs = self.started_secs or time.time()
+        except OSError as e:
+            # the pooled container has died while waiting
+            logger.error(e)
+            self.status = models.JobStatus.FAILED_TO_START
         except docker.errors.APIError as e:
             logger.error(e)
 
@@ -69,13 +292,18 @@ class DockerJob:
                 raise
 
     def save(self):
+        old_state = (self.job_model.status, self.job_model.exit_code)
         self.job_model.status = self.status
-        # TODO: Handle stdout/stderr. Also this is slow
-        self.job_model.output = self.get_output().decode('utf-8')
+        self.capture_new_output()
 
         self.job_model.host_start_time_secs = self.host_start_time_secs
         self.job_model.uptime_secs = self.uptime()
-        self.job_model.error = self.get_error()
+
+        if self.inspected:
+            self.job_model.error = self.get_error()
+
+        self.job_model.stdout_log_cursor = self.stdout_log_cursor
+        self.job_model.stderr_log_cursor = self.stderr_log_cursor
 
         # TODO: maybe set in other cases as well?
         if self.status == models.JobStatus.FINISHED:
@@ -86,39 +314,53 @@ class DockerJob:
 
         self.job_model.save()
 
+        if (self.job_model.status, self.job_model.exit_code) != old_state:
+            events.job_changed(self.job_model)
+
     def uptime(self) -> float:
-        if self.status == models.JobStatus.FAILED_TO_START or self.status == models.JobStatus.NOT_STARTED:
+        if self.host_start_time_secs == 0:
+            # never started
             return 0
 
+        if not self.inspected:
+            # we only skip the inspection if the container is still running, see update
+            return time.time() - self.host_start_time_secs
+
         # This whole thing is shit, but I don't want to deal with timezones @Robustness
         finished_time = docker_timestamp_to_seconds(self.container.attrs['State']['FinishedAt'])
 
-        if finished_time != 0:
+        if finished_time != 0 and self.job_model.pool_slot is not None:
+            # the container was started long before the job, so we have to use our own start time
+            finished_secs, finished_nanosecs = parse_log_timestamp(self.container.attrs['State']['FinishedAt'])
+            return finished_secs + finished_nanosecs / 1e9 - self.host_start_time_secs
+        elif finished_time != 0:
             # if finished => compare finished and started times, which are definitely in the same timezone
             started_time = docker_timestamp_to_seconds(self.container.attrs['State']['StartedAt'])
             return finished_time - started_time
-        elif self.status == models.JobStatus.CANCELLED or self.status == models.JobStatus.DEPENDENCY_FAILED:
-            # we were cancelled even before getting started
-            return 0
         else:
             # not finished => running => we can compare our times, which are also in the same timezone
             return time.time() - self.host_start_time_secs
 
     def clean_up(self):
         self.update()
-        self.container.remove()
+        # force, because the pooled containers are still running if the job has never started
+        self.container.remove(force=True)
+
+        if self.job_model.pool_slot is not None:
+            warm_pool.remove_slot(Path(self.job_model.pool_slot))
 
     def cancel(self):
-        if self.status == models.JobStatus.NOT_STARTED:
+        if self.status == models.JobStatus.NOT_STARTED or self.status == models.JobStatus.QUEUED:
             self.status = models.JobStatus.CANCELLED
         elif self.status == models.JobStatus.RUNNING:
             try:
                 self.container.kill()
                 self.status = models.JobStatus.CANCELLED
-                self.container.reload()
+                self.inspect()
             except docker.errors.APIError as e:
                 if e.status_code == 409:
                     logger.warning('Trying to cancel an already stopped container')
+                    self.inspect()
                     self.update()
                 else:
                     raise
@@ -130,22 +372,26 @@ class DockerJob:
         if self.status != models.JobStatus.RUNNING:
             return
 
-        try:
-            self.container.reload()
-        except docker.errors.APIError as e:
-            logger.error(e)
+        # If we already know that it's still running, there's nothing new to ask about
+        if self.container_state != 'running':
+            try:
+                # the fresh attrs we've got in the constructor are good enough
+                if not self.inspected:
+                    self.inspect()
+            except docker.errors.APIError as e:
+                logger.error(e)
 
-            if e.status_code == 400:
-                self.status = models.JobStatus.DOCKER_ERROR
-                return
-            elif e.status_code == 404:
-                self.status = models.JobStatus.NOT_FOUND
-                raise
-            else:
-                raise
+                if e.status_code == 400:
+                    self.status = models.JobStatus.DOCKER_ERROR
+                    return
+                elif e.status_code == 404:
+                    self.status = models.JobStatus.NOT_FOUND
+                    raise
+                else:
+                    raise
 
-        if self.container.attrs['State']['Status'] == 'exited':
-            self.status = models.JobStatus.FINISHED
+            if self.container_state == 'exited':
+                self.status = models.JobStatus.FINISHED
 
         if self.timeout_secs is not None and self.uptime() > self.timeout_secs:
             if self.status == models.JobStatus.FINISHED:
@@ -0,0 +1,131 @@
+import os
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterable
+
+from django.conf import settings
+from django.db.models import Case, When, QuerySet
+
+from . import models
+
+
+# Leases on the pipelines, so any number of workers (processes or threads) can step and change them at the same time.
+# Whoever holds the lease is the only one who may change the pipeline and its jobs. The leases are held only for as long
+# as it takes to do something with the pipeline, and expire by themselves if the worker dies in the meantime.
+#
+# The last owner stays in the row after the lease is released, so a worker can tell that nobody else has touched the
+# pipeline since its own last lease, and that whatever it has cached about it is still valid
+
+
+def worker_id() -> str:
+    # not cached, since the celery forks after importing us
+    return f'{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}'
+
+
+def try_acquire(pipeline_ids: Iterable[int]) -> dict[int, bool]:
+    """
+    Takes the leases of the pipelines that aren't leased by anyone right now
+
+    Returns: pipeline id -> whether someone else has held it after us, for the acquired ones
+    """
+    pipeline_ids = list(pipeline_ids)
+    me = worker_id()
+    now = time.time()
+    expires = now + settings.FASTCI_LEASE_TTL_SECS
+    free = models.Pipeline.objects.filter(pk__in=pipeline_ids, lease_expires_secs__lte=now)
+
+    # Conditional, so if someone else gets there first they keep it. Split in two so we know which ones changed hands
+    free.filter(lease_owner=me).update(lease_expires_secs=expires)
+    kept = set(models.Pipeline.objects.filter(pk__in=pipeline_ids, lease_owner=me, lease_expires_secs=expires)
+               .values_list('pk', flat=True))
+    free.exclude(lease_owner=me).update(lease_owner=me, lease_expires_secs=expires)
+    acquired = models.Pipeline.objects.filter(pk__in=pipeline_ids, lease_owner=me, lease_expires_secs=expires) \
+        .values_list('pk', flat=True)
+
+    return {pipeline_id: pipeline_id not in kept for pipeline_id in acquired}
+
+
+def claim_batch(queryset: QuerySet, limit: int) -> dict[int, bool]:
+    """
+    Takes up to `limit` free leases among the pipelines in the queryset. Prefers the ones we've held the last time, and
+    then the ones that have waited the longest
+
+    Returns: see try_acquire
+    """
+    candidates = queryset.filter(lease_expires_secs__lte=time.time()) \
+        .order_by(Case(When(lease_owner=worker_id(), then=0), default=1), 'lease_expires_secs') \
+        .values_list('pk', flat=True)[:limit]
+
+    return try_acquire(candidates)
+
+
+def renew(pipeline_ids: Iterable[int]) -> set[int]:
+    """
+    Extends our leases, so nobody takes them over while we are still busy with the pipelines
+
+    Returns: the ones that are still ours, i.e. nobody has taken them over after they had expired
+    """
+    pipeline_ids = list(pipeline_ids)
+    mine = models.Pipeline.objects.filter(pk__in=pipeline_ids, lease_owner=worker_id())
+    mine.update(lease_expires_secs=time.time() + settings.FASTCI_LEASE_TTL_SECS)
+
+    return set(mine.values_list('pk', flat=True))
+
+
+def release(pipeline_ids: Iterable[int]):
+    # the release time is used to find the ones that have waited the longest, see claim_batch
+    models.Pipeline.objects.filter(pk__in=list(pipeline_ids), lease_owner=worker_id()) \
+        .update(lease_expires_secs=time.time())
+
+
+@contextmanager
+def wait_for(pipeline_id: int):
+    """
+    Waits until the pipeline is ours (at most for another lease to expire) and releases it afterwards
+
+    Raises: TimeoutError if someone keeps taking it before us
+
+    Yields: see try_acquire
+    """
+    deadline = time.time() + 2 * settings.FASTCI_LEASE_TTL_SECS
+
+    while not (acquired := try_acquire([pipeline_id])):
+        if time.time() > deadline:
+            raise TimeoutError(f'Could not get the lease of pipeline {pipeline_id}')
+
+        time.sleep(settings.FASTCI_LEASE_RETRY_SECS)
+
+    try:
+        yield acquired[pipeline_id]
+    finally:
+        release([pipeline_id])
+
+
+@contextmanager
+def wait_for_all(pipeline_ids: Iterable[int]):
+    """
+    Same as wait_for, but for many pipelines at once. Each one is taken as soon as it's free, so a busy one doesn't
+    hold up the rest
+
+    WARN: The pipelines must exist, or they are waited for until the deadline
+
+    Yields: see try_acquire, without the ones that someone kept taking before us
+    """
+    pipeline_ids = set(pipeline_ids)
+    deadline = time.time() + 2 * settings.FASTCI_LEASE_TTL_SECS
+    acquired = dict()
+
+    try:
+        while True:
+            acquired.update(try_acquire(pipeline_ids - set(acquired)))
+
+            if len(acquired) == len(pipeline_ids) or time.time() > deadline:
+                break
+
+            time.sleep(settings.FASTCI_LEASE_RETRY_SECS)
+
+        yield acquired
+    finally:
+        release(acquired)
@@ -0,0 +1,169 @@
+import mmap
+import os
+import shutil
+from pathlib import Path
+
+from django.conf import settings
+
+# The chunks are always filled up to this size before the next one is started, so finding the chunk that holds a given
+# offset is just a division
+CHUNK_SIZE = 4 * 1024 * 1024
+# That's the most we're willing to hand out in one request
+MAX_READ_SIZE = 1024 * 1024
+# 'all' is both stdout and stderr interleaved in the order they were printed
+STREAMS = ('all', 'stdout', 'stderr')
+
+
+class JobLogStore:
+    """
+    Append-only log of a job, stored as a bunch of chunk files: <FASTCI_LOGS_DIR>/<job id>/<stream>/<chunk index>
+    """
+    root: Path
+
+    def __init__(self, job_id: int):
+        self.root = Path(settings.FASTCI_LOGS_DIR) / str(job_id)
+
+    def _stream_dir(self, stream: str) -> Path:
+        assert stream in STREAMS, f'Unknown stream {stream}'
+        return self.root / stream
+
+    def _chunk_path(self, stream: str, index: int) -> Path:
+        return self._stream_dir(stream) / f'{index:08d}'
+
+    def _chunk_count(self, stream: str) -> int:
+        stream_dir = self._stream_dir(stream)
+        return len(os.listdir(stream_dir)) if stream_dir.exists() else 0
+
+    def size(self, stream: str) -> int:
+        chunk_count = self._chunk_count(stream)
+
+        if chunk_count == 0:
+            return 0
+
+        return (chunk_count - 1) * CHUNK_SIZE + self._chunk_path(stream, chunk_count - 1).stat().st_size
+
+    def append(self, stream: str, data: bytes):
+        if not data:
+            return
+
+        self._stream_dir(stream).mkdir(parents=True, exist_ok=True)
+        offset = self.size(stream)
+
+        while data:
+            index, chunk_offset = divmod(offset, CHUNK_SIZE)
+            part = data[:CHUNK_SIZE - chunk_offset]
+
+            with open(self._chunk_path(stream, index), 'ab') as f:
+                f.write(part)
+
+            offset += len(part)
+            data = data[len(part):]
+
+    def _chunk_ranges(self, stream: str, start: int, end: int):
+        """
+        Yields: (chunk index, start inside the chunk, end inside the chunk) covering [start, end)
+        """
+        while start < end:
+            index, chunk_start = divmod(start, CHUNK_SIZE)
+            chunk_end = min(CHUNK_SIZE, chunk_start + end - start)
+            yield index, chunk_start, chunk_end
+            start += chunk_end - chunk_start
+
+    def read(self, stream: str, start: int, end: int) -> bytes:
+        """
+        Returns: bytes [start, end) of the stream, the caller must make sure that they exist
+        """
+        parts = []
+
+        for index, chunk_start, chunk_end in self._chunk_ranges(stream, start, end):
+            with open(self._chunk_path(stream, index), 'rb') as f, \
+                    mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                parts.append(m[chunk_start:chunk_end])
+
+        return b''.join(parts)
+
+    def _find_newline_forward(self, stream: str, start: int, end: int) -> int:
+        """
+        Returns: offset of the first newline in [start, end) or -1
+        """
+        for index, chunk_start, chunk_end in self._chunk_ranges(stream, start, end):
+            with open(self._chunk_path(stream, index), 'rb') as f, \
+                    mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                found = m.find(b'\n', chunk_start, chunk_end)
+
+            if found != -1:
+                return index * CHUNK_SIZE + found
+
+        return -1
+
+    def _find_newline_backward(self, stream: str, start: int, end: int) -> int:
+        """
+        Returns: offset of the last newline in [start, end) or -1
+        """
+        for index, chunk_start, chunk_end in reversed(list(self._chunk_ranges(stream, start, end))):
+            with open(self._chunk_path(stream, index), 'rb') as f, \
+                    mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                found = m.rfind(b'\n', chunk_start, chunk_end)
+
+            if found != -1:
+                return index * CHUNK_SIZE + found
+
+        return -1
+
+    def read_range(self, stream: str, offset: int, length: int) -> tuple[int, int]:
+        """
+        Cuts the range at the last complete line if there is one, so the text doesn't get split in the middle of a
+        character
+
+        Returns: [start, end) that should be read
+        """
+        start = min(offset, self.size(stream))
+        end = min(start + min(length, MAX_READ_SIZE), self.size(stream))
+        last_newline = self._find_newline_backward(stream, start, end)
+
+        if last_newline != -1:
+            end = last_newline + 1
+
+        return start, end
+
+    def head(self, stream: str, line_count: int, offset: int = 0) -> tuple[int, int]:
+        """
+        Returns: [start, end) that holds at most line_count lines starting at offset
+        """
+        size = self.size(stream)
+        start = end = min(offset, size)
+        limit = min(size, start + MAX_READ_SIZE)
+
+        for _ in range(line_count):
+            newline = self._find_newline_forward(stream, end, limit)
+
+            if newline == -1:
+                # the last line that wasn't terminated yet
+                end = limit
+                break
+
+            end = newline + 1
+
+        return start, end
+
+    def tail(self, stream: str, line_count: int, end: int = None) -> tuple[int, int]:
+        """
+        Returns: [start, end) that holds at most line_count lines ending at end (by default - at the end of the log)
+        """
+        size = self.size(stream)
+        end = size if end is None else min(end, size)
+        limit = max(0, end - MAX_READ_SIZE)
+        # don't count the newline that terminates the last line
+        newline = end - 1
+
+        for _ in range(line_count):
+            newline = self._find_newline_backward(stream, limit, newline) if newline > limit else -1
+
+            if newline == -1:
+                return limit, end
+
+        # we are standing on the newline of the previous line
+        return newline + 1, end
+
+    def remove(self):
+        shutil.rmtree(self.root, ignore_errors=True)
@@ -0,0 +1,99 @@
+import logging
+import signal
+import threading
+import time
+
+import celery
+import docker
+import docker.errors
+import redis
+import requests
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from fastci import admission
+from fastci import jobs
+from fastci import runners
+
+logger = logging.getLogger('fastci')
+
+# @CopyPaste - keep in sync with fastci.tasks.step_pipeline
+STEP_PIPELINE_TASK = 'fastci.tasks.step_pipeline'
+
+
+def watch_docker_events(docker_client: docker.DockerClient, app: celery.Celery, stopping: threading.Event):
+    """
+    Same as fastci.tasks.watch_docker_events, but for the docker of this host
+    """
+    since = None
+
+    while not stopping.is_set():
+        try:
+            for event in docker_client.events(since=since, decode=True,
+                                              filters={'type': 'container', 'event': ['start', 'die', 'oom'],
+                                                       'label': jobs.PIPELINE_LABEL}):
+                # in case we reconnect, so we don't miss anything in between
+                since = event['time']
+                app.send_task(STEP_PIPELINE_TASK, args=(int(event['Actor']['Attributes'][jobs.PIPELINE_LABEL]),))
+        except (docker.errors.APIError, docker.errors.DockerException, requests.exceptions.RequestException) as e:
+            logger.warning(f'Lost the docker events, reconnecting: {e}')
+            time.sleep(1)
+
+
+class Command(BaseCommand):
+    help = 'Offers the docker of this host to the scheduler as a runner, see fastci.runners. The scheduler must be ' \
+           'able to reach it at --docker-url, over TLS'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--name', default=runners.default_name())
+        parser.add_argument('--docker-url', required=True,
+                            help='How the scheduler reaches the docker of this host, i.e. tcp://10.0.0.2:2376. The '
+                                 'docker must be run with --tlsverify, see FASTCI_RUNNER_TLS_* in the settings')
+        parser.add_argument('--redis-url', default='redis://', help='The redis of the scheduler, also the broker')
+        parser.add_argument('--labels', default='', help='Comma separated, see `runner_labels` of the jobs')
+        parser.add_argument('--max-running-jobs', type=int, default=settings.FASTCI_MAX_RUNNING_JOBS)
+        parser.add_argument('--cpus', type=float, default=None, help='Default - all of them')
+        parser.add_argument('--memory', default=None, help='i.e. 16g. Default - all of it')
+        parser.add_argument('--shares-paths', action='store_true',
+                            help='This host sees the same files at the same paths as the scheduler, i.e. via NFS')
+        parser.add_argument('--events', action='store_true',
+                            help='Step the pipelines as soon as their containers here start or die, for '
+                                 'FASTCI_SCHEDULER_MODE = \'events\'')
+
+    def handle(self, *args, **options):
+        if not runners.is_tls_url(options['docker_url']):
+            raise CommandError('--docker-url must be tcp:// or https://, the scheduler only talks to the remote '
+                               'dockers over TLS')
+
+        redis_client = redis.Redis.from_url(options['redis_url'])
+        docker_client = docker.from_env()
+        info = runners.RunnerInfo(options['name'], options['docker_url'],
+                                  {label for label in options['labels'].split(',') if label},
+                                  options['max_running_jobs'], options['cpus'] or runners.host_cpus(),
+                                  admission.parse_memory(options['memory']) if options['memory']
+                                  else runners.host_memory_bytes(), options['shares_paths'])
+        stopping = threading.Event()
+
+        def stop(signum, frame):
+            stopping.set()
+
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+
+        if options['events']:
+            app = celery.Celery('fastci', broker=options['redis_url'])
+            threading.Thread(target=watch_docker_events, args=(docker_client, app, stopping), daemon=True).start()
+
+        try:
+            while not stopping.is_set():
+                try:
+                    # only while the docker is actually there
+                    docker_client.ping()
+                    runners.announce(redis_client, info)
+                except (docker.errors.DockerException, requests.exceptions.RequestException, redis.RedisError) as e:
+                    self.stderr.write(f'Could not announce the runner: {e}')
+
+                stopping.wait(settings.FASTCI_RUNNER_HEARTBEAT_SECS)
+        finally:
+            # so no new jobs are put here
+            runners.withdraw(redis_client, info.name)
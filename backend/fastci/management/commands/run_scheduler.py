@@ -0,0 +1,23 @@
+import signal
+
+from django.core.management.base import BaseCommand
+
+from fastci import tasks
+
+
+class Command(BaseCommand):
+    help = 'Steps the pipelines in a loop instead of the celery beat ticks. Use together with ' \
+           'FASTCI_SCHEDULER_DAEMON = True. Several of them can run at once'
+
+    def handle(self, *args, **options):
+        tasks.init_clients()
+        stopping = False
+
+        def stop(signum, frame):
+            # let the current step finish, so the leases are released
+            nonlocal stopping
+            stopping = True
+
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+        tasks.run_scheduler(lambda: stopping)
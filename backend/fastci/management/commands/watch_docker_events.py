@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from fastci import tasks
+
+
+class Command(BaseCommand):
+    help = 'Listens to the docker events and steps the pipelines whose containers have started or died. ' \
+           'Use together with FASTCI_SCHEDULER_MODE = \'events\''
+
+    def handle(self, *args, **options):
+        tasks.init_clients()
+        tasks.watch_docker_events()
@@ -0,0 +1,19 @@
+# Generated by Django 4.0.1 on 2026-10-18 06:42
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fastci', '0013_pipeline_repo_url'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='job',
+            name='container_id',
+            field=models.CharField(db_index=True, max_length=64, null=True, validators=[django.core.validators.RegexValidator(regex='[0-9a-fA-F]{64}')]),
+        ),
+    ]
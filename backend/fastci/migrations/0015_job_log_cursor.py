@@ -0,0 +1,18 @@
+# Generated by Django 4.0.1 on 2026-10-18 06:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fastci', '0014_job_container_id_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='log_cursor',
+            field=models.CharField(blank=True, default='', max_length=40),
+        ),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 4.0.1 on 2026-10-18 07:30
+
+from django.db import migrations, models
+
+
+def move_output_to_log_store(apps, schema_editor):
+    # Importing the real thing is a bit naughty, but the store only needs the id
+    from fastci.logs import JobLogStore
+
+    Job = apps.get_model('fastci', 'Job')
+
+    for job in Job.objects.exclude(output='').only('pk', 'output', 'log_cursor').iterator():
+        # we don't know which of the lines were stderr anymore
+        JobLogStore(job.pk).append('all', job.output.encode('utf-8'))
+        job.stderr_log_cursor = job.log_cursor
+        job.save(update_fields=['stderr_log_cursor'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fastci', '0015_job_log_cursor'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='stderr_log_cursor',
+            field=models.CharField(blank=True, default='', max_length=40),
+        ),
+        migrations.RunPython(move_output_to_log_store, migrations.RunPython.noop),
+        migrations.RenameField(
+            model_name='job',
+            old_name='log_cursor',
+            new_name='stdout_log_cursor',
+        ),
+        migrations.RemoveField(
+            model_name='job',
+            name='output',
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.0.1 on 2026-10-18 06:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fastci', '0016_job_log_store'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='pool_slot',
+            field=models.CharField(blank=True, max_length=4096, null=True),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 4.0.1 on 2026-10-18 06:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fastci', '0017_job_pool_slot'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Image',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=400, unique=True)),
+                ('digest', models.CharField(blank=True, max_length=71)),
+                ('size_bytes', models.BigIntegerField(default=0)),
+                ('last_used_secs', models.FloatField(default=0.0)),
+                ('pulled', models.BooleanField(default=False)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='job',
+            name='image',
+            field=models.CharField(blank=True, max_length=400),
+        ),
+        migrations.AddField(
+            model_name='job',
+            name='image_digest',
+            field=models.CharField(blank=True, max_length=71),
+        ),
+    ]
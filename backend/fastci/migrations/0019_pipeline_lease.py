@@ -0,0 +1,23 @@
+# Generated by Django 4.0.1 on 2026-10-18 06:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fastci', '0018_image_cache'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pipeline',
+            name='lease_expires_secs',
+            field=models.FloatField(default=0.0),
+        ),
+        migrations.AddField(
+            model_name='pipeline',
+            name='lease_owner',
+            field=models.CharField(blank=True, default='', max_length=200),
+        ),
+    ]
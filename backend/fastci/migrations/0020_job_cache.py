@@ -0,0 +1,38 @@
+# Generated by Django 4.0.1 on 2026-10-18 07:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fastci', '0019_pipeline_lease'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CacheEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=64, unique=True)),
+                ('exit_code', models.IntegerField()),
+                ('created_secs', models.FloatField(default=0.0)),
+                ('last_used_secs', models.FloatField(default=0.0)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='job',
+            name='cache_hit',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='job',
+            name='cache_key',
+            field=models.CharField(blank=True, max_length=64),
+        ),
+        migrations.AddField(
+            model_name='job',
+            name='cache_spec',
+            field=models.JSONField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 4.0.1 on 2026-10-18 07:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fastci', '0020_job_cache'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='cpus',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='job',
+            name='memory_bytes',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='job',
+            name='status',
+            field=models.IntegerField(choices=[(0, 'Not Started'), (1, 'Running'), (2, 'Timed Out'), (3, 'Docker Error'), (4, 'Not Found'), (5, 'Finished'), (6, 'Failed To Start'), (7, 'Cancelled'), (8, 'Dependency Failed'), (9, 'Queued')], default=0),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.0.1 on 2026-10-18 07:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fastci', '0021_job_resources'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='job',
+            name='name',
+            field=models.CharField(db_index=True, max_length=200),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.0.1 on 2026-10-18 07:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fastci', '0022_job_name_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='runner',
+            field=models.CharField(blank=True, db_index=True, default='', max_length=200),
+        ),
+    ]
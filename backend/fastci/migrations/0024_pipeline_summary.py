@@ -0,0 +1,65 @@
+# Generated by Django 4.0.1 on 2026-10-18 07:22
+
+from django.db import migrations, models
+from django.db.models import Count, Q, Sum
+
+
+def summarize_existing_pipelines(apps, schema_editor):
+    # @CopyPaste - keep in sync with fastci.summaries.update_summaries
+    Job = apps.get_model('fastci', 'Job')
+    Pipeline = apps.get_model('fastci', 'Pipeline')
+    pipelines = Pipeline.objects.in_bulk()
+    # 5 == JobStatus.FINISHED
+    rows = Job.objects.order_by().values('pipeline_id', 'status').annotate(
+        count=Count('pk'), uptime_secs=Sum('uptime_secs'),
+        failed_exit_count=Count('pk', filter=Q(status=5) & ~Q(exit_code=0)))
+
+    for row in rows:
+        pipeline = pipelines[row['pipeline_id']]
+        pipeline.job_counts[str(row['status'])] = row['count']
+        pipeline.failed_exit_count += row['failed_exit_count']
+        pipeline.total_uptime_secs += row['uptime_secs'] or 0.0
+
+    Pipeline.objects.bulk_update(list(pipelines.values()), ['job_counts', 'failed_exit_count', 'total_uptime_secs'],
+                                 batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fastci', '0023_job_runner'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pipeline',
+            name='created_secs',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AddField(
+            model_name='pipeline',
+            name='failed_exit_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='pipeline',
+            name='finished_secs',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AddField(
+            model_name='pipeline',
+            name='job_counts',
+            field=models.JSONField(default=dict),
+        ),
+        migrations.AddField(
+            model_name='pipeline',
+            name='started_secs',
+            field=models.FloatField(null=True),
+        ),
+        migrations.AddField(
+            model_name='pipeline',
+            name='total_uptime_secs',
+            field=models.FloatField(default=0.0),
+        ),
+        migrations.RunPython(summarize_existing_pipelines, migrations.RunPython.noop),
+    ]
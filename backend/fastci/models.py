@@ -15,6 +15,8 @@ class JobStatus(models.IntegerChoices):
     FAILED_TO_START = 6
     CANCELLED = 7
     DEPENDENCY_FAILED = 8
+    # ready to be started, but waits for the host to have enough room for it, see admission
+    QUEUED = 9
 
 
 class PipelineStatus(models.IntegerChoices):
@@ -39,25 +41,88 @@ class Pipeline(models.Model):
     # could be a path to a directory, so we use the max length of a filename in linux just in case
     repo_url = models.CharField(max_length=4096, blank=True, null=True)
 
+    # see leases
+    lease_owner = models.CharField(max_length=200, blank=True, default='')
+    lease_expires_secs = models.FloatField(default=0.0)
+
+    # The summary for the listing, so it doesn't have to look at the jobs, see summaries
+    # str(job status) -> how many of the jobs have it
+    job_counts = models.JSONField(default=dict)
+    # how many of the finished jobs have exited with a non-zero code
+    failed_exit_count = models.IntegerField(default=0)
+    # as of the last time any of the jobs has changed
+    total_uptime_secs = models.FloatField(default=0.0)
+    # null for the ones created before these were added
+    created_secs = models.FloatField(null=True)
+    started_secs = models.FloatField(null=True)
+    finished_secs = models.FloatField(null=True)
+
     # TODO:
     #   1) initiator
     #   2) stages?
-    #   3) uptime
 
     class Meta:
         ordering = ['-pk']
 
 
+class Image(models.Model):
+    """
+    A docker image that some job has used, see images
+    """
+    # as it was written in the pipeline, i.e. python:3.9
+    name = models.CharField(max_length=400, unique=True)
+    # id of the image the name pointed to the last time it was used
+    digest = models.CharField(max_length=71, blank=True)
+    size_bytes = models.BigIntegerField(default=0)
+    last_used_secs = models.FloatField(default=0.0)
+    # only the pulled images can be thrown away, since they can be pulled again
+    pulled = models.BooleanField(default=False)
+
+
+class CacheEntry(models.Model):
+    """
+    A stored result of a job, the files themselves are in job_cache.entry_dir
+    """
+    # see job_cache.compute_key
+    key = models.CharField(max_length=64, unique=True)
+    exit_code = models.IntegerField()
+    created_secs = models.FloatField(default=0.0)
+    last_used_secs = models.FloatField(default=0.0)
+
+
 class Job(models.Model):
-    name = models.CharField(max_length=200)
+    # indexed for the history of the jobs with the same name, see graphs.expected_durations
+    name = models.CharField(max_length=200, db_index=True)
     pipeline = models.ForeignKey(Pipeline, on_delete=models.CASCADE, related_name='jobs')
 
     # id of an already created container
     # a hexadecimal of exact size 64
     # id is null <=> job is cleaned up
-    container_id = models.CharField(max_length=64, validators=[RegexValidator(regex=r'[0-9a-fA-F]{64}')], null=True)
+    container_id = models.CharField(max_length=64, validators=[RegexValidator(regex=r'[0-9a-fA-F]{64}')], null=True,
+                                    db_index=True)
+
+    # name of the runner whose docker has the container, see runners
+    runner = models.CharField(max_length=200, blank=True, default='', db_index=True)
+
+    # the image as it was written in the pipeline and the id it was resolved to, the container is created from the latter
+    image = models.CharField(max_length=400, blank=True)
+    image_digest = models.CharField(max_length=71, blank=True)
+
+    # the slot of the warm pool container that was claimed for this job, if any, see warm_pool
+    pool_slot = models.CharField(max_length=4096, blank=True, null=True)
 
     timeout_secs = models.FloatField(blank=True, null=True)
+
+    # what the job has asked for in the pipeline, also the limits of its container. None == no limit, see admission
+    cpus = models.FloatField(blank=True, null=True)
+    memory_bytes = models.BigIntegerField(blank=True, null=True)
+
+    # only for the jobs with `cache` in the pipeline: {'inputs': [...], 'outputs': [...], 'static_key': ...}, see job_cache
+    cache_spec = models.JSONField(blank=True, null=True)
+    # computed right before the job is started
+    cache_key = models.CharField(max_length=64, blank=True)
+    # true <=> the job was never run, its result was taken from the cache
+    cache_hit = models.BooleanField(default=False)
     host_start_time_secs = models.FloatField(default=0.0)
     uptime_secs = models.FloatField(default=0.0)
 
@@ -68,18 +133,15 @@ class Job(models.Model):
     error = models.CharField(max_length=400, blank=True)
     exit_code = models.IntegerField(blank=True, null=True)
 
-    # TODO:
-    #   1) Support other encodings?
-    #   2) Distinguish stdout/stderr?
-    #   3) Will colors work?
-    # in utf-8
-    output = models.TextField(default='', blank=True)
+    # The output itself lives in logs.JobLogStore
+    # docker timestamps of the last log lines that made it into the log store, so we don't fetch the same lines again
+    stdout_log_cursor = models.CharField(max_length=40, blank=True, default='')
+    stderr_log_cursor = models.CharField(max_length=40, blank=True, default='')
 
     # TODO:
-    #   1) support multiple runners
-    #   2) pipeline info
-    #   3) support subprocesses (not in docker)
-    #   4) sticky jobs
+    #   1) pipeline info
+    #   2) support subprocesses (not in docker)
+    #   3) sticky jobs
 
     class Meta:
         ordering = ['-pk']
@@ -94,7 +156,7 @@ class Job(models.Model):
         """
         Returns: complete == was started and stopped running for any reason
         """
-        return self.status not in (JobStatus.NOT_STARTED, JobStatus.RUNNING)
+        return self.status not in (JobStatus.NOT_STARTED, JobStatus.QUEUED, JobStatus.RUNNING)
 
 
 class LightPipelineSerializer(serializers.ModelSerializer):
@@ -109,7 +171,7 @@ class CompleteJobSerializer(serializers.ModelSerializer):
     class Meta:
         model = Job
         fields = ['id', 'name', 'pipeline', 'container_id', 'timeout_secs', 'uptime_secs', 'parents', 'status', 'error',
-                  'exit_code', 'output']
+                  'exit_code', 'cache_hit', 'cpus', 'memory_bytes', 'runner']
 
 
 class ListingJobSerializer(serializers.ModelSerializer):
@@ -130,6 +192,17 @@ class NodeJobSerializer(serializers.ModelSerializer):
         fields = ['id', 'name', 'status', 'exit_code', 'parents']
 
 
+class ListingPipelineSerializer(serializers.ModelSerializer):
+    """
+    Used in the pipeline list - just the summary, no jobs
+    """
+
+    class Meta:
+        model = Pipeline
+        fields = ['id', 'name', 'status', 'commit_hash', 'repo_url', 'job_counts', 'failed_exit_count',
+                  'total_uptime_secs', 'created_secs', 'started_secs', 'finished_secs']
+
+
 class CompletePipelineSerializer(serializers.ModelSerializer):
     jobs = NodeJobSerializer(many=True, read_only=True)
 
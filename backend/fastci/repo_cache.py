@@ -0,0 +1,102 @@
+import fcntl
+import hashlib
+import shutil
+import subprocess
+import tempfile
+from contextlib import contextmanager
+from pathlib import Path
+
+from django.conf import settings
+from rest_framework.exceptions import ValidationError
+
+# Inside the pipeline dir
+# @CopyPaste - keep in sync with repo_bootstrap.py
+REPO_DIR_NAME = 'repo'
+
+
+# The host keeps a bare mirror of every repository, and each pipeline gets a checkout that borrows the objects from it
+# (clone --shared). So the history is fetched (incrementally) and stored only once, no matter how many pipelines there
+# are. The mirror is then mounted into the jobs at the same path, so git still works inside of them
+#
+# WARN: Never gc the mirrors, the objects that aren't reachable anymore might still be used by the checkouts. Not even
+#       git itself may do it after a fetch, see disable_gc
+
+
+def mirror_dir(repo_url: str) -> Path:
+    return Path(settings.FASTCI_REPO_MIRROR_DIR) / f'{hashlib.sha256(repo_url.encode()).hexdigest()}.git'
+
+
+def git(*args: str, cwd: Path = None):
+    subprocess.run(['git', *args], cwd=cwd, check=True, capture_output=True)
+
+
+# the settings that stop git from collecting the garbage (or doing any other maintenance) on its own
+NO_GC_CONFIG = {'gc.auto': '0', 'gc.pruneExpire': 'never', 'maintenance.auto': 'false'}
+
+
+def disable_gc(mirror: Path):
+    for name, value in NO_GC_CONFIG.items():
+        git('config', name, value, cwd=mirror)
+
+
+def has_commit(mirror: Path, commit_hash: str) -> bool:
+    return subprocess.run(['git', 'cat-file', '-e', f'{commit_hash}^{{commit}}'], cwd=mirror,
+                          capture_output=True).returncode == 0
+
+
+@contextmanager
+def locked(mirror: Path):
+    """
+    Only one process at a time may clone or fetch into a mirror
+    """
+    mirror.parent.mkdir(parents=True, exist_ok=True)
+
+    with open(mirror.with_suffix('.lock'), 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield
+
+
+def update_mirror(repo_url: str, commit_hash: str) -> Path:
+    """
+    Clones the mirror or fetches into it, unless it already has the commit
+
+    Raises: ValidationError if the repository doesn't have the commit, subprocess.CalledProcessError if git fails
+
+    Returns: path of the mirror
+    """
+    mirror = mirror_dir(repo_url)
+
+    with locked(mirror):
+        if not mirror.exists():
+            # cloned on the side, so a failed clone doesn't leave half of a mirror behind
+            tmp_dir = Path(tempfile.mkdtemp(dir=mirror.parent))
+
+            try:
+                git('clone', '--mirror', '--quiet', repo_url, str(tmp_dir / 'mirror.git'))
+                disable_gc(tmp_dir / 'mirror.git')
+                (tmp_dir / 'mirror.git').rename(mirror)
+            finally:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+        elif not has_commit(mirror, commit_hash):
+            # in case it was cloned before we started doing that
+            disable_gc(mirror)
+            git('fetch', '--prune', '--quiet', 'origin', cwd=mirror)
+
+        if not has_commit(mirror, commit_hash):
+            raise ValidationError({'commit_hash': f'No commit {commit_hash} in {repo_url}'})
+
+    return mirror
+
+
+def checkout(repo_url: str, commit_hash: str, pipeline_dir: Path) -> Path:
+    """
+    Puts a checkout of the commit into <pipeline_dir>/repo
+
+    Returns: path of the mirror, it must be mounted into the jobs at the same path
+    """
+    mirror = update_mirror(repo_url, commit_hash)
+    repo_dir = pipeline_dir / REPO_DIR_NAME
+    git('clone', '--shared', '--no-checkout', '--quiet', str(mirror), str(repo_dir))
+    git('checkout', '--detach', '--quiet', commit_hash, cwd=repo_dir)
+
+    return mirror
@@ -0,0 +1,41 @@
+import json
+
+import redis
+from django.conf import settings
+from rest_framework.exceptions import ValidationError
+
+# The action endpoints don't wait for their tasks, they only give back the id of the task. Its outcome is kept here for
+# a while (see views.task_view), and is also published along with the changes, see events.task_finished
+#
+# FYI: Not the celery results, since the json serializer can't bring the ValidationError back with its details
+
+KEY_PREFIX = 'fastci.task.'
+PENDING = 'PENDING'
+SUCCESS = 'SUCCESS'
+FAILURE = 'FAILURE'
+
+
+def describe_error(e: BaseException):
+    """
+    Returns: something json-serializable, the same thing DRF would give for the ValidationError
+    """
+    if isinstance(e, ValidationError):
+        return e.detail
+
+    return f'{type(e).__name__}: {e}'
+
+
+def make_report(task_id: str, state: str, result=None, error=None) -> dict:
+    return {'id': task_id, 'state': state, 'result': result, 'error': error}
+
+
+def save(client: redis.Redis, report: dict):
+    client.set(KEY_PREFIX + report['id'], json.dumps(report), ex=settings.FASTCI_TASK_REPORT_TTL_SECS)
+
+
+def load(client: redis.Redis, task_id: str) -> dict:
+    """
+    Returns: PENDING if it hasn't finished yet (or there's no such task, or it was too long ago)
+    """
+    value = client.get(KEY_PREFIX + task_id)
+    return json.loads(value) if value is not None else make_report(task_id, PENDING)
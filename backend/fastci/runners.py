@@ -0,0 +1,203 @@
+import json
+import os
+import socket
+from typing import Optional
+
+import docker
+import docker.tls
+import redis
+from django.conf import settings
+from django.db.models import Count
+
+from . import models
+
+# Runners - the hosts whose docker runs the jobs. The local docker is always there as LOCAL, and any number of remote
+# ones can be added by running `python manage.py run_runner_agent` on them. The agent keeps announcing its runner (how
+# to reach its docker, its labels and capacity) in redis, and the runner is gone once it stops doing that. The scheduler
+# talks to the docker of the runner directly, the same way it talks to the local one. The agent also tells it when the
+# containers there start or die, like watch_docker_events does for the local one
+#
+# FYI: The agent doesn't run the jobs itself, so the docker of each runner must be reachable from the server. Whoever
+#      can reach it is root on that host, so the remote ones are only ever talked to over TLS with a client certificate
+#      (see FASTCI_RUNNER_TLS_* in the settings, and `dockerd --tlsverify` on the runner). The ones announced with a
+#      plain docker url, or when we have no certificate, are ignored, see is_secure
+#
+# NOTE: On purpose the agent is not a relay: it doesn't take the assignments from us, nor report the state and the logs
+#       of the jobs back. Then the scheduler, the admission, the job cache and JobLogTail would each need a second way
+#       of doing everything, one for the local docker and one for the agents, while now they just pick the client (see
+#       tasks.client_for and connect). The price is the direct TLS access to the docker of every runner, from the
+#       workers and from the ASGI server
+#
+# WARN: The jobs that mount anything from the host (the pipeline dir, the workdir, the repo, their own volumes) can only
+#       be put on the runners that see the same paths as we do, i.e. via NFS. See RunnerInfo.shares_paths
+
+LOCAL = ''
+KEY_PREFIX = 'fastci.runner.'
+
+
+class RunnerGone(Exception):
+    """
+    The runner hasn't announced itself for a while, so it's either dead or unreachable
+    """
+
+
+class RunnerInfo:
+    __slots__ = ('name', 'docker_url', 'labels', 'max_running_jobs', 'cpus', 'memory_bytes', 'shares_paths')
+
+    name: str
+    # how we reach its docker, i.e. tcp://10.0.0.2:2376
+    docker_url: str
+    # the jobs with `runner_labels` are only put on the runners that have all of them
+    labels: set[str]
+    # None == no limit
+    max_running_jobs: Optional[int]
+    cpus: float
+    memory_bytes: int
+    # true <=> it sees the same files at the same paths as we do
+    shares_paths: bool
+
+    def __init__(self, name: str, docker_url: str, labels: set[str], max_running_jobs: Optional[int], cpus: float,
+                 memory_bytes: int, shares_paths: bool):
+        self.name = name
+        self.docker_url = docker_url
+        self.labels = labels
+        self.max_running_jobs = max_running_jobs
+        self.cpus = cpus
+        self.memory_bytes = memory_bytes
+        self.shares_paths = shares_paths
+
+    def to_json(self) -> str:
+        return json.dumps({field: getattr(self, field) if field != 'labels' else sorted(self.labels)
+                           for field in self.__slots__})
+
+    @classmethod
+    def from_json(cls, value: str) -> 'RunnerInfo':
+        fields = json.loads(value)
+        fields['labels'] = set(fields['labels'])
+        return cls(**fields)
+
+
+def host_cpus() -> float:
+    return os.cpu_count() or 1
+
+
+def host_memory_bytes() -> int:
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+
+def default_name() -> str:
+    return socket.gethostname()
+
+
+def local_info() -> RunnerInfo:
+    return RunnerInfo(LOCAL, f'unix://{settings.FASTCI_DOCKER_SOCKET}', set(settings.FASTCI_LOCAL_RUNNER_LABELS),
+                      settings.FASTCI_MAX_RUNNING_JOBS, settings.FASTCI_HOST_CPUS or host_cpus(),
+                      settings.FASTCI_HOST_MEMORY_BYTES or host_memory_bytes(), True)
+
+
+def has_tls_config() -> bool:
+    return bool(settings.FASTCI_RUNNER_TLS_CA_CERT and settings.FASTCI_RUNNER_TLS_CLIENT_CERT
+                and settings.FASTCI_RUNNER_TLS_CLIENT_KEY)
+
+
+def get_tls_config() -> docker.tls.TLSConfig:
+    return docker.tls.TLSConfig(client_cert=(settings.FASTCI_RUNNER_TLS_CLIENT_CERT,
+                                             settings.FASTCI_RUNNER_TLS_CLIENT_KEY),
+                                ca_cert=settings.FASTCI_RUNNER_TLS_CA_CERT, verify=True)
+
+
+def is_tls_url(docker_url: str) -> bool:
+    # the docker SDK turns tcp:// into https:// once it has the TLS config
+    return docker_url.startswith('tcp://') or docker_url.startswith('https://')
+
+
+def is_secure(info: RunnerInfo) -> bool:
+    """
+    Returns: whether we can talk to the docker of the runner, see connect
+    """
+    return info.name == LOCAL or (is_tls_url(info.docker_url) and has_tls_config())
+
+
+def connect(info: RunnerInfo) -> docker.DockerClient:
+    """
+    Raises: RunnerGone if the runner is remote and we can't talk to it over TLS, see is_secure
+
+    Returns: a new client of the runner's docker
+    """
+    if info.name == LOCAL:
+        return docker.DockerClient(base_url=info.docker_url)
+
+    if not is_secure(info):
+        raise RunnerGone(info.name)
+
+    return docker.DockerClient(base_url=info.docker_url, tls=get_tls_config())
+
+
+def announce(client: redis.Redis, info: RunnerInfo):
+    # the agent has to announce itself again before it expires, see run_runner_agent
+    client.set(KEY_PREFIX + info.name, info.to_json(), ex=settings.FASTCI_RUNNER_TTL_SECS)
+
+
+def withdraw(client: redis.Redis, name: str):
+    client.delete(KEY_PREFIX + name)
+
+
+def alive(client: redis.Redis) -> dict[str, RunnerInfo]:
+    """
+    Returns: name -> info of the runners that can take jobs right now, the local one included
+    """
+    infos = {LOCAL: local_info()}
+    keys = list(client.scan_iter(match=f'{KEY_PREFIX}*'))
+
+    for value in client.mget(keys) if keys else []:
+        # might have expired in the meantime
+        if value is not None:
+            info = RunnerInfo.from_json(value)
+
+            if is_secure(info):
+                infos[info.name] = info
+
+    return infos
+
+
+def get_loads(infos: dict[str, RunnerInfo]) -> dict[str, float]:
+    """
+    Takes 1 query
+
+    Returns: runner name -> how many not yet finished jobs it has per job it can run at once
+    """
+    counts = dict(models.Job.objects.filter(runner__in=list(infos), container_id__isnull=False,
+                                            status__in=(models.JobStatus.NOT_STARTED, models.JobStatus.QUEUED,
+                                                        models.JobStatus.RUNNING))
+                  .order_by().values('runner').annotate(count=Count('pk')).values_list('runner', 'count'))
+
+    return {name: counts.get(name, 0) / (info.max_running_jobs or info.cpus) for name, info in infos.items()}
+
+
+def place(infos: dict[str, RunnerInfo], labels: list[set[str]], needs_paths: list[bool]) -> Optional[list[str]]:
+    """
+    Puts each job on the least loaded runner that can take it
+
+    Args:
+        labels: what each job wants from its runner
+        needs_paths: whether each job mounts anything from the host
+
+    Returns: runner name for each job, None if some of them can't be put anywhere
+    """
+    loads = get_loads(infos)
+    placement = []
+
+    for job_labels, job_needs_paths in zip(labels, needs_paths):
+        # the local one wins the ties
+        candidates = [name for name, info in infos.items() if job_labels <= info.labels
+                      and (info.shares_paths or not job_needs_paths)]
+        runner = min(candidates, key=lambda name: (loads[name], name != LOCAL), default=None)
+
+        if runner is None:
+            return None
+
+        placement.append(runner)
+        # so the rest of the pipeline is spread out too
+        loads[runner] += 1 / (infos[runner].max_running_jobs or infos[runner].cpus)
+
+    return placement
@@ -0,0 +1,41 @@
+from django.db.models import Count, Q, Sum
+
+from . import events
+from . import models
+
+# The pipeline list shows a summary of each pipeline (see models.Pipeline), so it doesn't have to load all of the jobs
+# with their parents. The summaries of the pipelines whose jobs have changed are brought up to date right before the
+# changes are published, see tasks.notify_of_change
+#
+# FYI: They are counted again from the jobs instead of being incremented and decremented on every change, since the jobs
+#      are changed from quite a few places. It's still one query for all of them, and they can never drift
+
+
+def update_summaries(pipeline_ids: set[int]):
+    """
+    Takes 3 queries, no matter how many pipelines there are. The summaries go out with the other changes
+    """
+    if not pipeline_ids:
+        return
+
+    rows = models.Job.objects.filter(pipeline_id__in=list(pipeline_ids)).order_by().values('pipeline_id', 'status') \
+        .annotate(count=Count('pk'), uptime_secs=Sum('uptime_secs'),
+                  failed_exit_count=Count('pk', filter=Q(status=models.JobStatus.FINISHED) & ~Q(exit_code=0)))
+    pipelines = models.Pipeline.objects.in_bulk(list(pipeline_ids))
+
+    for pipeline in pipelines.values():
+        pipeline.job_counts = dict()
+        pipeline.failed_exit_count = 0
+        pipeline.total_uptime_secs = 0.0
+
+    for row in rows:
+        pipeline = pipelines[row['pipeline_id']]
+        pipeline.job_counts[str(row['status'])] = row['count']
+        pipeline.failed_exit_count += row['failed_exit_count']
+        pipeline.total_uptime_secs += row['uptime_secs'] or 0.0
+
+    models.Pipeline.objects.bulk_update(list(pipelines.values()),
+                                        ['job_counts', 'failed_exit_count', 'total_uptime_secs'])
+
+    for pipeline in pipelines.values():
+        events.pipeline_changed(pipeline, status_changed=False)
@@ -1,15 +1,20 @@
+import asyncio
+import concurrent.futures
 import json
 import os
 import shutil
 import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Optional
+from typing import Optional, Callable
 
 import celery
 import docker.errors
 import docker.models.containers
 import redis
-from celery.signals import worker_init, beat_init
+import requests
+from celery.signals import worker_init, worker_process_init, beat_init, task_success, task_failure
 from celery.utils.log import get_task_logger
 
 # required so models can be imported and all of the infrastructure works
@@ -20,10 +25,25 @@ import django
 django.setup()
 
 from rest_framework.exceptions import ValidationError
-from django.db import transaction, DatabaseError
+from django.conf import settings
+from django.db import transaction
 from django.db.models import Q
+from . import admission
+from . import aiodocker
+from . import events
+from . import graphs
+from . import images
+from . import job_cache
+from . import leases
+from . import logs
 from . import models
 from . import jobs
+from . import reports
+from . import repo_cache
+from . import runners
+from . import summaries
+from . import versions
+from . import warm_pool
 
 logger = get_task_logger(__name__)
 app = celery.Celery('fastci', broker='redis://', backend='redis://')
@@ -33,6 +53,18 @@ docker_client: Optional[docker.DockerClient]
 docker_client = None
 redis_client: Optional[redis.Redis]
 redis_client = None
+# only in worker, and only if enabled
+container_pool: Optional[warm_pool.WarmPool]
+container_pool = None
+# the dockers of the remote runners, connected to when they are first needed, see client_for
+runner_clients: dict[str, docker.DockerClient]
+runner_clients = dict()
+
+# Dependency graphs of the pipelines that are being stepped, so we don't have to query all of the jobs on every tick
+# WARN: Only valid as long as the jobs are changed by the scheduler itself, see forget_pipeline_graph. The other workers
+#       are taken care of by the leases
+pipeline_graphs: dict[int, graphs.PipelineGraph]
+pipeline_graphs = dict()
 
 COUNT_FIRST_PIPELINES_TO_NOT_CLEAN_UP = 10
 INTERNAL_DIR = (Path(__file__).parent.parent.parent / 'internal').absolute()
@@ -40,14 +72,22 @@ INTERNAL_DIR = (Path(__file__).parent.parent.parent / 'internal').absolute()
 
 def notify_of_change():
     """
-    Notifies all subscribers that the state has changed
+    Tells all subscribers what has changed since the last time, see events
     """
-    redis_client.publish('pipeline-job-state-change', 1)
+    # so the summaries go out along with what has changed
+    summaries.update_summaries(events.changed_pipeline_ids())
+    # before it's published, so whoever refetches because of it doesn't get an old ETag
+    versions.bump_changed(redis_client, events.changed_pipeline_ids(), events.changed_job_ids(),
+                          events.status_changed_pipeline_ids())
+    message = events.take()
+
+    if message is not None:
+        redis_client.publish(events.CHANNEL, message)
 
 
 def init_clients():
     global docker_client
-    docker_client = docker.DockerClient(base_url='unix:///var/run/docker.sock')
+    docker_client = docker.DockerClient(base_url=f'unix://{settings.FASTCI_DOCKER_SOCKET}')
     # FYI: logging is not setup at worker_init/beat_init
     print('Docker client running!')
 
@@ -56,24 +96,91 @@ def init_clients():
     print('Redis client running!')
 
 
+def client_for(runner: str, runner_infos: Optional[dict[str, runners.RunnerInfo]] = None) -> docker.DockerClient:
+    """
+    Args:
+        runner_infos: see runners.alive, asked for if not given
+
+    Raises: runners.RunnerGone if we haven't connected to the runner yet, and it's not alive anymore
+
+    Returns: the client of the runner's docker
+    """
+    if runner == runners.LOCAL:
+        return docker_client
+
+    if runner not in runner_clients:
+        runner_infos = runner_infos if runner_infos is not None else runners.alive(redis_client)
+
+        if runner not in runner_infos:
+            raise runners.RunnerGone(runner)
+
+        runner_clients[runner] = runners.connect(runner_infos[runner])
+
+    return runner_clients[runner]
+
+
+def init_warm_pool(remove_leftovers: bool):
+    global container_pool
+    container_pool = warm_pool.WarmPool(docker_client, INTERNAL_DIR, Path(settings.FASTCI_WARM_POOL_DIR),
+                                        settings.FASTCI_WARM_POOL_SIZE, settings.FASTCI_WARM_POOL_SIZE_PER_IMAGE,
+                                        settings.FASTCI_WARM_POOL_IDLE_TTL_SECS, {jobs.MANAGED_LABEL: ''})
+
+    if remove_leftovers:
+        # the claimed ones are still needed by their jobs
+        container_pool.remove_leftovers(set(models.Job.objects.filter(container_id__isnull=False)
+                                            .values_list('container_id', flat=True)))
+
+    print('Warm pool running!')
+
+
 @worker_init.connect
 def setup_globals_worker(sender, **kwargs):
     init_clients()
 
+    if settings.FASTCI_WARM_POOL_SIZE > 0:
+        init_warm_pool(remove_leftovers=True)
+
+
+@worker_process_init.connect
+def setup_globals_worker_process(sender, **kwargs):
+    # The prefork pool forks after worker_init, and the children must not share the connections (or the idle containers
+    # of the pool) with each other
+    init_clients()
+
+    if settings.FASTCI_WARM_POOL_SIZE > 0:
+        init_warm_pool(remove_leftovers=False)
+
 
 @beat_init.connect
 def setup_globals_beat(sender, **kwargs):
     init_clients()
 
 
-def do_create_job(job_data: dict, pipeline_id: int, common_pipeline_dir: Optional[Path],
-                  work_dir_to_bind: Optional[Path], commit_hash: Optional[str], repo_url: Optional[str]) -> models.Job:
-    """
-    Creates the container and an associated Job model
+# The ones that the views enqueue without waiting for them, see reports
+REPORTED_TASK_NAMES = {f'{__name__}.{name}' for name in ('create_pipeline_from_json', 'update_job', 'cancel_job',
+                                                          'update_pipeline', 'cancel_pipeline', 'create_pipelines',
+                                                          'cancel_pipelines', 'clean_up_pipelines')}
 
-    Returns:
-        The created Job model
-    """
+
+def report_task(report: dict):
+    reports.save(redis_client, report)
+    events.task_finished(report)
+    notify_of_change()
+
+
+@task_success.connect
+def report_task_success(sender=None, result=None, **kwargs):
+    if sender.name in REPORTED_TASK_NAMES:
+        report_task(reports.make_report(sender.request.id, reports.SUCCESS, result=result))
+
+
+@task_failure.connect
+def report_task_failure(sender=None, task_id=None, exception=None, **kwargs):
+    if sender.name in REPORTED_TASK_NAMES:
+        report_task(reports.make_report(task_id, reports.FAILURE, error=reports.describe_error(exception)))
+
+
+def validate_job_data(job_data: dict):
     if not isinstance(job_data, dict):
         raise ValidationError({'outer object': 'Must be a key-value object'})
 
@@ -87,16 +194,184 @@ def do_create_job(job_data: dict, pipeline_id: int, common_pipeline_dir: Optiona
         except ValueError:
             raise ValidationError({'timeout_secs': 'Must be convertible to float'})
 
+    if 'cpus' in job_data:
+        try:
+            cpus = float(job_data['cpus'])
+        except (TypeError, ValueError):
+            raise ValidationError({'cpus': 'Must be convertible to float'})
+
+        if cpus <= 0:
+            raise ValidationError({'cpus': 'Must be positive'})
+
+    if 'memory' in job_data:
+        try:
+            admission.parse_memory(job_data['memory'])
+        except ValueError:
+            raise ValidationError({'memory': 'Must be a positive number of bytes, or a number with one of the units: '
+                                             f'{", ".join(admission.MEMORY_UNITS)}'})
+
     if 'volumes' in job_data:
         if not isinstance(job_data['volumes'], list) or not all(isinstance(volume, str) for volume
                                                                 in job_data['volumes']):
             raise ValidationError({'volumes': 'Must be a list of str'})
 
+    if 'runner_labels' in job_data:
+        if not isinstance(job_data['runner_labels'], list) or not all(isinstance(label, str) for label
+                                                                      in job_data['runner_labels']):
+            raise ValidationError({'runner_labels': 'Must be a list of str'})
+
+    if 'cache' in job_data:
+        cache = job_data['cache']
+
+        if not isinstance(cache, (bool, dict)):
+            raise ValidationError({'cache': 'Must be a bool or a key-value object'})
+
+        if isinstance(cache, dict):
+            for field in ('inputs', 'outputs'):
+                paths = cache.get(field, [])
+
+                if not isinstance(paths, list) or not all(isinstance(path, str) for path in paths):
+                    raise ValidationError({'cache': {field: 'Must be a list of str'}})
+
+                if any(Path(path).is_absolute() or '..' in Path(path).parts for path in paths):
+                    raise ValidationError({'cache': {field: 'Must be relative to /fastci/pipeline and stay inside'}})
+
+
+def get_cache_spec(job_data: dict) -> Optional[dict]:
+    """
+    Returns: the `cache` of an already validated job in one form, or None if it's not cached
+    """
+    cache = job_data.get('cache', False)
+
+    if cache is False:
+        return None
+
+    cache = cache if isinstance(cache, dict) else dict()
+    return {'inputs': cache.get('inputs', []), 'outputs': cache.get('outputs', [])}
+
+
+def validate_pipeline_data(data: dict):
+    """
+    Checks everything we can before touching the docker or the database
+    """
+    if not isinstance(data, dict):
+        raise ValidationError({'outer object': 'Must be a key-value object'})
+
+    if 'name' not in data:
+        raise ValidationError({'name': 'Field required'})
+
+    if 'bind_workdir_from_host' in data and not Path(data['bind_workdir_from_host']).is_absolute():
+        raise ValidationError({'bind_workdir_from_host': 'must be absolute'})
+
+    if 'commit_hash' in data and 'repo_url' not in data:
+        raise ValidationError({'repo_url': 'Also required'})
+
+    if 'commit_hash' not in data and 'repo_url' in data:
+        raise ValidationError({'commit_hash': 'Also required'})
+
+    if 'jobs' not in data or not isinstance(data['jobs'], list) or len(data['jobs']) == 0:
+        raise ValidationError({'jobs': 'Must be a non-empty list'})
+
+    if 'commit_hash' in data:
+        if 'bind_workdir_from_host' in data:
+            raise ValidationError({'bind_workdir_from_host': 'If pipeline is in repo mode, we can\'t bind a '
+                                                             'custom workdir, working directory is set to be the '
+                                                             'root of the repository!'})
+        if data.get('setup_pipeline_dir', False):
+            raise ValidationError({'setup_pipeline_dir': 'If pipeline is in repo mode, there\'s no need to setup the '
+                                                         'pipeline dir, sincethe repository directory is shared for '
+                                                         'all jobs in the pipeline!'})
+
+    jobs_names = set()
+
+    for i, job_data in enumerate(data['jobs']):
+        try:
+            validate_job_data(job_data)
+        except ValidationError as e:
+            raise ValidationError({f'job {i}': e.detail})
+
+        if job_data['name'] in jobs_names:
+            raise ValidationError({job_data['name']: 'Names of jobs in a single pipeline must be unique'})
+
+        jobs_names.add(job_data['name'])
+        cache_spec = get_cache_spec(job_data)
+
+        if cache_spec is not None and 'bind_workdir_from_host' in data:
+            raise ValidationError({job_data['name']: 'Can\'t cache a job with a workdir from the host, its contents '
+                                                     'aren\'t part of the cache key'})
+
+        if cache_spec is not None and (cache_spec['inputs'] or cache_spec['outputs']) \
+                and not data.get('setup_pipeline_dir', False) and 'commit_hash' not in data:
+            raise ValidationError({job_data['name']: 'The cache inputs and outputs are in the pipeline dir, so there '
+                                                     'must be one'})
+
+    if 'parents' in data:
+        if not isinstance(data['parents'], dict):
+            raise ValidationError({'parents': 'Must be a key-value object'})
+
+        for child_name, parent_names in data['parents'].items():
+            if not isinstance(parent_names, list):
+                raise ValidationError({'parents': f'Parents of {child_name} must be a list'})
+
+            for name in (child_name, *parent_names):
+                if name not in jobs_names:
+                    raise ValidationError({'parents': f'No job named {name}'})
+
+
+def validate_pipelines_data(data: list):
+    """
+    Same as validate_pipeline_data, but for a batch of them. Tells about all of the bad ones at once
+    """
+    if not isinstance(data, list) or len(data) == 0:
+        raise ValidationError({'outer object': 'Must be a non-empty list'})
+
+    errors = dict()
+
+    for i, pipeline_data in enumerate(data):
+        try:
+            validate_pipeline_data(pipeline_data)
+        except ValidationError as e:
+            errors[f'pipeline {i}'] = e.detail
+
+    if errors:
+        raise ValidationError(errors)
+
+
+def do_create_container(job_data: dict, runner: str, image_digests: dict[str, str], pipeline_id: int,
+                        common_pipeline_dir: Optional[Path], work_dir_to_bind: Optional[Path],
+                        commit_hash: Optional[str],
+                        repo_url: Optional[str]) -> tuple[docker.models.containers.Container, Optional[Path]]:
+    """
+    Creates the container for an already validated job, or takes one from the warm pool if possible
+
+    Args:
+        runner: where to create it, see runners.place
+        image_digests: see images.resolve_images, must have the image of the job (as it is on the runner)
+
+    Returns: the container and its pool slot if it came from the pool
+    """
     name = job_data['name']
-    image = job_data['image']
+    # pinned, so all of the jobs of the pipeline use the same image even if the tag is moved in the meantime
+    image = image_digests[job_data['image']]
     command = job_data['command']
-    volumes = job_data.get('volumes', [])
-    timeout_secs = job_data.get('timeout_secs')
+    # copied, since the job's own volumes are part of its cache key, see do_create_job
+    volumes = list(job_data.get('volumes', []))
+
+    # the limits can't be put on an already created container
+    limits = dict()
+
+    if 'cpus' in job_data:
+        limits['nano_cpus'] = int(float(job_data['cpus']) * 1e9)
+
+    if 'memory' in job_data:
+        limits['mem_limit'] = admission.parse_memory(job_data['memory'])
+
+    if container_pool is not None and runner == runners.LOCAL and not volumes and not limits \
+            and common_pipeline_dir is None and work_dir_to_bind is None and commit_hash is None:
+        pooled = container_pool.claim(image, command)
+
+        if pooled is not None:
+            return pooled.container, pooled.slot_dir
 
     if common_pipeline_dir is not None:
         # this uses str, not repr
@@ -115,49 +390,222 @@ def do_create_job(job_data: dict, pipeline_id: int, common_pipeline_dir: Optiona
     if commit_hash is not None:
         # then repo_url won't be None
         volumes.append(f'{INTERNAL_DIR}:/fastci/internal:ro')
-
-        if repo_url.startswith('/'):
-            volumes.append(f'{repo_url}:{repo_url}:ro')
+        # the checkout in the pipeline dir borrows the objects from there, see repo_cache
+        mirror = repo_cache.mirror_dir(repo_url)
+        volumes.append(f'{mirror}:{mirror}:ro')
 
         command = f'/fastci/internal/repo_bootstrap.py {repo_url} {commit_hash} {command}'
 
-    container: docker.models.containers.Container
-    container = docker_client.containers.create(image, command, detach=True, volumes=volumes)
+    container = client_for(runner).containers.create(image, command, detach=True, volumes=volumes,
+                                                     labels={jobs.MANAGED_LABEL: '',
+                                                             jobs.PIPELINE_LABEL: str(pipeline_id),
+                                                             jobs.JOB_LABEL: name}, **limits)
+    return container, None
+
+
+def remove_containers(containers: list[tuple[docker.models.containers.Container, Optional[Path]]]):
+    """
+    Args:
+        containers: what do_create_containers returned
+    """
+    def remove(container: docker.models.containers.Container, pool_slot: Optional[Path]):
+        # force, because the pooled ones are running
+        container.remove(force=True)
+
+        if pool_slot is not None:
+            warm_pool.remove_slot(pool_slot)
+
+    with ThreadPoolExecutor(max_workers=settings.FASTCI_CREATE_CONTAINER_THREADS) as executor:
+        # list is needed to wait for all of them and see the exceptions
+        list(executor.map(remove, *zip(*containers)))
+
 
+def roll_back_containers(containers: list[tuple[docker.models.containers.Container, Optional[Path]]]):
+    """
+    Removes the containers of a failed creation. Never raises, so the failure itself isn't hidden by a failed clean-up
+
+    Args:
+        containers: see remove_containers
+    """
     try:
-        job = models.Job(name=name, pipeline=models.Pipeline.objects.get(pk=pipeline_id), container_id=container.id,
-                         timeout_secs=timeout_secs)
-        job.full_clean()
-        job.save()
-    except DatabaseError:
-        container.remove()
-        raise
+        remove_containers(containers)
+    except Exception:
+        # WARN: Whatever couldn't be removed is left behind, it's labelled with the pipeline, see jobs.PIPELINE_LABEL
+        logger.exception('Failed to remove the containers of a failed creation')
+
+
+def do_create_containers(jobs_data: list[dict], placement: list[str], image_digests: dict[str, dict[str, str]],
+                         *args) -> list[tuple[docker.models.containers.Container, Optional[Path]]]:
+    """
+    Creates the containers in parallel. Either all of them are created or none
+
+    Args:
+        placement: runner of each job, see runners.place
+        image_digests: runner -> its image digests, see do_create_container
+        args: see do_create_container
+
+    Returns: see do_create_container, in the same order as the jobs
+    """
+    with ThreadPoolExecutor(max_workers=settings.FASTCI_CREATE_CONTAINER_THREADS) as executor:
+        futures = [executor.submit(do_create_container, job_data, runner, image_digests[runner], *args)
+                   for job_data, runner in zip(jobs_data, placement)]
+        # have to wait for all of them anyway, so we know what to clean up
+        concurrent.futures.wait(futures)
+
+    containers = [future.result() for future in futures if future.exception() is None]
+
+    if len(containers) != len(futures):
+        roll_back_containers(containers)
+        raise next(future.exception() for future in futures if future.exception() is not None)
+
+    return containers
+
+
+def make_cache_spec(job_data: dict, image_digests: dict[str, str], commit_hash: Optional[str]) -> Optional[dict]:
+    """
+    Returns: Job.cache_spec of an already validated job, None if it's not cached
+    """
+    cache_spec = get_cache_spec(job_data)
+
+    if cache_spec is not None:
+        cache_spec['static_key'] = job_cache.static_key(image_digests[job_data['image']], job_data['command'],
+                                                        job_data.get('volumes', []), commit_hash)
+
+    return cache_spec
+
+
+def restore_cached_roots(data: dict, placement: list[str], image_digests: dict[str, dict[str, str]],
+                         pipeline_dir: Optional[Path]) -> dict[str, tuple[str, models.CacheEntry]]:
+    """
+    Looks up the cached jobs without any parents before their containers are created, since all of their inputs are
+    already there. The outputs of the hits are put back into the pipeline dir right away, see do_create_job for the rest
+
+    NOTE: The keys of the others depend on what their parents make, so they are looked up once they are ready, and
+          their containers are created anyway, see use_cached_result
+
+    Args:
+        data: an already validated pipeline, its repository must be checked out already
+        placement: see place_jobs
+        image_digests: see do_create_containers
+
+    Returns: job name -> its key and the entry, for the hits
+    """
+    # Without a checkout the pipeline dir may still be filled in before the roots start, so it's too early to tell
+    if data.get('commit_hash') is None:
+        return dict()
+
+    parents = data.get('parents', {})
+    hits = dict()
+
+    for job_data, runner in zip(data['jobs'], placement):
+        cache_spec = make_cache_spec(job_data, image_digests[runner], data.get('commit_hash'))
+
+        if cache_spec is None or parents.get(job_data['name']):
+            continue
+
+        key = job_cache.compute_key(cache_spec, pipeline_dir)
+        entry = job_cache.restore_outputs(key, cache_spec, pipeline_dir)
+
+        if entry is not None:
+            hits[job_data['name']] = (key, entry)
+
+    return hits
+
+
+def do_create_job(job_data: dict, runner: str, image_digests: dict[str, str], pipeline: models.Pipeline,
+                  container: Optional[docker.models.containers.Container], pool_slot: Optional[Path],
+                  hit: Optional[tuple[str, models.CacheEntry]] = None) -> models.Job:
+    """
+    Creates the Job model for an already created container
+
+    Args:
+        container: None for a hit
+        hit: the key and the entry if the result was taken from the cache before the container was created, see
+             restore_cached_roots. Then the job is finished right away, only its logs have to be restored still
+
+    Returns:
+        The created Job model
+    """
+    job = models.Job(name=job_data['name'], pipeline=pipeline, container_id=container.id if container else None,
+                     runner=runner, pool_slot=pool_slot, image=job_data['image'],
+                     image_digest=image_digests[job_data['image']], timeout_secs=job_data.get('timeout_secs'),
+                     cache_spec=make_cache_spec(job_data, image_digests, pipeline.commit_hash),
+                     cpus=float(job_data['cpus']) if 'cpus' in job_data else None,
+                     memory_bytes=admission.parse_memory(job_data['memory']) if 'memory' in job_data else None)
+
+    if hit is not None:
+        # the same as use_cached_result would do, only it never had a container to clean up
+        job.cache_key, entry = hit
+        job.status = models.JobStatus.FINISHED
+        job.exit_code = entry.exit_code
+        job.cache_hit = True
+
+    # no container is the same as a cleaned up one
+    job.full_clean(exclude=['container_id'] if container is None else None)
+    job.save()
 
     return job
 
 
-def do_clean_up_job(job_model: models.Job):
-    job = jobs.DockerJob(docker_client, job_model)
-    job.clean_up()
-    job_model.container_id = None
-    job_model.save()
+def do_clean_up_jobs(job_models: list[models.Job]):
+    """
+    Removes the containers of the jobs, in parallel
+    """
+    if not job_models:
+        return
 
+    runner_infos = runners.alive(redis_client)
 
-@transaction.atomic
-def do_clean_up_pipeline(pipeline: models.Pipeline):
-    assert pipeline.status != models.PipelineStatus.RUNNING and pipeline.status != models.PipelineStatus.NOT_STARTED, \
-        'Attempting to clean up an unfinished pipeline!'
+    def clean_up(job_model: models.Job):
+        try:
+            job = jobs.DockerJob(client_for(job_model.runner, runner_infos), job_model)
+            job.clean_up()
+        except runners.RunnerGone:
+            logger.warning(f'Runner {job_model.runner} is gone, leaving the container of job {job_model.pk} behind')
 
-    if pipeline.tmp_dir is not None and Path(pipeline.tmp_dir).exists():
-        shutil.rmtree(pipeline.tmp_dir)
+    with ThreadPoolExecutor(max_workers=settings.FASTCI_CREATE_CONTAINER_THREADS) as executor:
+        # list is needed to wait for all of them and see the exceptions
+        list(executor.map(clean_up, job_models))
 
-    pipeline.tmp_dir = None
+    for job_model in job_models:
+        job_model.container_id = None
+        events.job_changed(job_model)
 
-    pipeline.cleaned_up = True
-    pipeline.save()
+    models.Job.objects.bulk_update(job_models, ['container_id'])
+
+
+def get_clean_up_refusal(pipeline: models.Pipeline) -> Optional[str]:
+    """
+    Returns: why the pipeline can't be cleaned up, None if it can
+    """
+    if pipeline.cleaned_up:
+        return 'Already cleaned up'
+
+    if pipeline.status == models.PipelineStatus.RUNNING or pipeline.status == models.PipelineStatus.NOT_STARTED:
+        return 'Not finished yet, it has to be cancelled first'
+
+    return None
+
+
+@transaction.atomic
+def do_clean_up_pipelines(pipelines: list[models.Pipeline]):
+    """
+    Cleans up the leased pipelines (see get_clean_up_refusal) with a couple of queries for all of them
+    """
+    for pipeline in pipelines:
+        assert pipeline.status != models.PipelineStatus.RUNNING and \
+               pipeline.status != models.PipelineStatus.NOT_STARTED, 'Attempting to clean up an unfinished pipeline!'
+
+        if pipeline.tmp_dir is not None and Path(pipeline.tmp_dir).exists():
+            shutil.rmtree(pipeline.tmp_dir)
 
-    for job in models.Job.objects.filter(pipeline=pipeline):
-        do_clean_up_job(job)
+        pipeline.tmp_dir = None
+        pipeline.cleaned_up = True
+        events.pipeline_changed(pipeline, status_changed=False)
+
+    models.Pipeline.objects.bulk_update(pipelines, ['tmp_dir', 'cleaned_up'])
+    # the ones taken from the cache never had their containers for long
+    do_clean_up_jobs(list(models.Job.objects.filter(pipeline__in=pipelines, container_id__isnull=False)))
 
 
 # NOTE: This is not the same as step_job, even though the name is very similar...
@@ -168,38 +616,160 @@ def do_clean_up_pipeline(pipeline: models.Pipeline):
 #       with updates
 @app.task
 def update_job(job_model_id: int):
-    job_model = models.Job.objects.get(pk=job_model_id)
+    pipeline_id = models.Job.objects.values_list('pipeline_id', flat=True).get(pk=job_model_id)
 
-    if job_model.container_id is None:
-        logger.warning('Trying to update an already cleaned up container!')
-    else:
-        job = jobs.DockerJob(docker_client, job_model)
-        job.update()
+    with leases.wait_for(pipeline_id):
+        job_model = models.Job.objects.get(pk=job_model_id)
+
+        if job_model.container_id is None:
+            logger.warning('Trying to update an already cleaned up container!')
+        else:
+            job = jobs.DockerJob(client_for(job_model.runner), job_model)
+            job.update()
+            job.save()
+            store_cached_result(job_model)
+            # asked for explicitly, so even the uptime counts
+            events.job_changed(job_model)
+            forget_pipeline_graph(job_model.pipeline_id)
+            notify_of_change()
+
+
+def get_container_states(runner_infos: dict[str, runners.RunnerInfo],
+                         pipeline_id: Optional[int] = None) -> dict[str, str]:
+    """
+    Asks the docker of each runner about all of our containers (or the containers of one pipeline) at once
+
+    Args:
+        runner_infos: the runners to ask, see runners.alive
+
+    Returns: container id -> state of the container, i.e. 'running'
+    """
+    label = jobs.MANAGED_LABEL if pipeline_id is None else f'{jobs.PIPELINE_LABEL}={pipeline_id}'
+    container_states = dict()
+
+    for runner in runner_infos:
+        try:
+            # sparse == don't inspect each container, the list itself has everything we need
+            container_states.update({container.id: container.attrs['State'] for container in
+                                     client_for(runner, runner_infos).containers.list(all=True, sparse=True,
+                                                                                      filters={'label': label})})
+        except (docker.errors.DockerException, requests.exceptions.RequestException) as e:
+            # the containers that aren't in here are asked about one by one anyway
+            logger.error(f'Could not list the containers of runner {runner!r}: {e}')
+
+    return container_states
+
+
+def get_pipeline_dir(job: models.Job) -> Optional[Path]:
+    return Path(job.pipeline.tmp_dir) if job.pipeline.tmp_dir is not None else None
+
+
+def use_cached_result(job: models.Job) -> bool:
+    """
+    Finishes a job that is about to be started right away, if its result is in the cache. Otherwise just remembers the
+    key, so the result can be stored once the job is done
+
+    Returns: True if the result was taken from the cache
+    """
+    job.cache_key = job_cache.compute_key(job.cache_spec, get_pipeline_dir(job))
+    entry = job_cache.restore(job.cache_key, job, get_pipeline_dir(job))
+
+    if entry is None:
         job.save()
-        notify_of_change()
+        return False
+
+    job.status = models.JobStatus.FINISHED
+    job.exit_code = entry.exit_code
+    job.cache_hit = True
+    job.save()
+    # it will never be started
+    do_clean_up_jobs([job])
+
+    return True
+
+
+def store_cached_result(job: models.Job):
+    """
+    Stores the result of the job if it has just succeeded and is supposed to be cached
+    """
+    if job.cache_key and not job.cache_hit and job.is_successfull():
+        job_cache.store(job.cache_key, job, get_pipeline_dir(job))
 
 
-def step_job(job: models.Job) -> bool:
+def step_job(job: models.Job, graph: graphs.PipelineGraph, container_state: Optional[str],
+             capacity: admission.Capacity, prefetched: Optional[jobs.PrefetchedContainer] = None) -> bool:
     """
+    Args:
+        capacity: what's left of the host, the ready job is started only if it fits
+        prefetched: see prefetch_running_jobs
+
     Returns: True if anything changed
     """
     assert job.container_id is not None
-    docker_job = jobs.DockerJob(docker_client, job)
+    # just in case someone has changed it behind our back
+    graph.job_changed(job)
+
+    if job.runner not in capacity.runner_infos and job.pk not in graph.doomed:
+        # whatever it was doing there is lost
+        job.status = models.JobStatus.DOCKER_ERROR
+        job.error = f'Runner {job.runner} is gone'
+        job.save()
+        events.job_changed(job)
+        graph.job_changed(job)
+        capacity.release(job)
+
+        return True
+
+    docker_job = jobs.DockerJob(client_for(job.runner, capacity.runner_infos), job, container_state, prefetched)
 
-    if docker_job.status == models.JobStatus.NOT_STARTED:
-        if any(parent.is_failed() for parent in job.parents.all()):
-            docker_job.status = models.JobStatus.DEPENDENCY_FAILED
-            docker_job.save()
+    if job.pk in graph.doomed:
+        docker_job.status = models.JobStatus.DEPENDENCY_FAILED
+        docker_job.save()
+        graph.job_changed(job)
 
+        return True
+    elif job.pk in graph.ready:
+        # the key is computed only once, even if the job waits in the queue for a while
+        if job.cache_spec is not None and not job.cache_key and use_cached_result(job):
+            if job.pk in capacity.admitted_ids:
+                # see admit_ready_jobs
+                capacity.release(job)
+
+            graph.job_changed(job)
             return True
-        elif all(parent.is_successfull() for parent in job.parents.all()):
-            docker_job.start()
-            docker_job.save()
+
+        if not capacity.admit(job):
+            if job.status == models.JobStatus.QUEUED:
+                return False
+
+            job.status = models.JobStatus.QUEUED
+            job.save()
+            events.job_changed(job)
+            graph.job_changed(job)
 
             return True
-    elif docker_job.status == models.JobStatus.RUNNING:
+
+        docker_job.start()
+        docker_job.save()
+        graph.job_changed(job)
+
+        if docker_job.status != models.JobStatus.RUNNING:
+            capacity.release(job)
+
+        if settings.FASTCI_SCHEDULER_MODE == 'events' and docker_job.status == models.JobStatus.RUNNING \
+                and job.timeout_secs is not None:
+            # Nobody will tell us that the time is up, so we have to remember it ourselves
+            step_pipeline.apply_async((job.pipeline_id,), countdown=job.timeout_secs)
+
+        return True
+    elif job.pk in graph.running:
         docker_job.update()
         docker_job.save()
+        store_cached_result(job)
+        graph.job_changed(job)
+
+        if job.is_complete():
+            capacity.release(job)
 
         return True
 
@@ -208,168 +778,623 @@ def step_job(job: models.Job) -> bool:
 
 @app.task
 def cancel_job(job_model_id: int):
-    job_model = models.Job.objects.get(pk=job_model_id)
+    pipeline_id = models.Job.objects.values_list('pipeline_id', flat=True).get(pk=job_model_id)
 
-    if job_model.container_id is None:
-        logger.warning('Trying to cancel an already cleaned up container!')
-    else:
-        job = jobs.DockerJob(docker_client, job_model)
-        job.cancel()
-        job.save()
-        notify_of_change()
+    with leases.wait_for(pipeline_id):
+        job_model = models.Job.objects.get(pk=job_model_id)
+
+        if job_model.container_id is None:
+            logger.warning('Trying to cancel an already cleaned up container!')
+        else:
+            do_cancel_job(job_model)
+            forget_pipeline_graph(job_model.pipeline_id)
+            notify_of_change()
+
+
+def do_cancel_job(job_model: models.Job):
+    try:
+        job = jobs.DockerJob(client_for(job_model.runner), job_model)
+    except runners.RunnerGone:
+        # nothing to stop anymore
+        if not job_model.is_complete():
+            job_model.status = models.JobStatus.CANCELLED
+            job_model.save()
+            events.job_changed(job_model)
+
+        return
+
+    job.cancel()
+    job.save()
 
 
 @app.task
 def cancel_pipeline(pipeline_model_id: int):
-    pipeline = models.Pipeline.objects.get(pk=pipeline_model_id)
+    with leases.wait_for(pipeline_model_id):
+        do_cancel_pipeline(models.Pipeline.objects.get(pk=pipeline_model_id))
+
 
+def run_on_pipelines(pipeline_ids: list[int], get_refusal: Callable[[models.Pipeline], Optional[str]],
+                     run: Callable[[list[models.Pipeline]], dict[int, str]]) -> list[dict]:
+    """
+    Takes the leases of all of the pipelines at once, and runs on all of the ones it can be run on at once
+
+    Args:
+        get_refusal: why it can't be run on the pipeline, None if it can
+        run: returns pipeline id -> what went wrong, for the ones where something did
+
+    Returns: {"pipeline_id": ..., "error": None or why it wasn't done} for each of the pipelines, in the same order
+    """
+    errors = dict()
+    existing_ids = set(models.Pipeline.objects.filter(pk__in=pipeline_ids).values_list('pk', flat=True))
+
+    with leases.wait_for_all(existing_ids) as acquired:
+        for pipeline_id, changed_hands in acquired.items():
+            if changed_hands:
+                forget_pipeline_graph(pipeline_id)
+
+        pipelines = []
+
+        # the status could have changed before we got the leases
+        for pipeline in models.Pipeline.objects.filter(pk__in=list(acquired)):
+            if (refusal := get_refusal(pipeline)) is not None:
+                errors[pipeline.pk] = refusal
+            else:
+                pipelines.append(pipeline)
+
+        if pipelines:
+            errors.update(run(pipelines))
+
+    notify_of_change()
+
+    for pipeline_id in set(pipeline_ids) - set(acquired):
+        errors[pipeline_id] = 'No such pipeline' if pipeline_id not in existing_ids else 'Busy, try again later'
+
+    return [{'pipeline_id': pipeline_id, 'error': errors.get(pipeline_id)} for pipeline_id in pipeline_ids]
+
+
+@app.task
+def cancel_pipelines(pipeline_model_ids: list[int]) -> list[dict]:
+    """
+    Cancels a batch of pipelines, i.e. all of the ones of a stale branch
+
+    Returns: see run_on_pipelines
+    """
+    return run_on_pipelines(pipeline_model_ids, get_cancel_refusal, do_cancel_pipelines)
+
+
+@app.task
+def clean_up_pipelines(pipeline_model_ids: list[int]) -> list[dict]:
+    """
+    Cleans up a batch of finished pipelines right away, without waiting for the scheduler
+
+    Returns: see run_on_pipelines
+    """
+    def clean_up(pipelines: list[models.Pipeline]) -> dict[int, str]:
+        do_clean_up_pipelines(pipelines)
+        return dict()
+
+    return run_on_pipelines(pipeline_model_ids, get_clean_up_refusal, clean_up)
+
+
+def get_cancel_refusal(pipeline: models.Pipeline) -> Optional[str]:
+    """
+    Returns: why the pipeline can't be cancelled, None if it can
+    """
     if pipeline.cleaned_up:
-        logger.warning('Trying to cancel an already cleaned up pipeline!')
-        return
+        return 'Already cleaned up'
 
     if pipeline.status == models.PipelineStatus.FINISHED or pipeline.status == models.PipelineStatus.FAILED:
-        logger.warning('Trying to cancel an already finished pipeline!')
-        return
+        return 'Already finished'
     elif pipeline.status == models.PipelineStatus.CANCELLED:
-        logger.warning('Trying to cancel an already cancelled pipeline!')
+        return 'Already cancelled'
+
+    return None
+
+
+def do_cancel_pipeline(pipeline: models.Pipeline):
+    if (refusal := get_cancel_refusal(pipeline)) is not None:
+        logger.warning(f'Trying to cancel pipeline {pipeline.pk}: {refusal}')
         return
 
-    pipeline.status = models.PipelineStatus.CANCELLED
-    pipeline.save()
+    do_cancel_pipelines([pipeline])
+    notify_of_change()
+
+
+def do_cancel_pipelines(pipelines: list[models.Pipeline]) -> dict[int, str]:
+    """
+    Cancels the leased pipelines (see get_cancel_refusal) and their jobs. The jobs that haven't started, which are most
+    of them usually, are cancelled with one query, and the running ones are stopped in parallel
+
+    Returns: pipeline id -> what went wrong with stopping its jobs, for the ones where something did
+    """
+    finished_secs = time.time()
+
+    for pipeline in pipelines:
+        pipeline.status = models.PipelineStatus.CANCELLED
+        pipeline.finished_secs = finished_secs
+        events.pipeline_changed(pipeline)
+        forget_pipeline_graph(pipeline.pk)
+
+    # the rest might have been changed in the meantime, i.e. the summary
+    models.Pipeline.objects.bulk_update(pipelines, ['status', 'finished_secs'])
+
+    # the ones taken from the cache don't have their containers anymore
+    job_models = list(models.Job.objects.filter(pipeline__in=pipelines, container_id__isnull=False))
+    unstarted = [job_model for job_model in job_models
+                 if job_model.status == models.JobStatus.NOT_STARTED or job_model.status == models.JobStatus.QUEUED]
+
+    # nothing to ask the docker about, see DockerJob.cancel
+    for job_model in unstarted:
+        job_model.status = models.JobStatus.CANCELLED
+        events.job_changed(job_model)
+
+    models.Job.objects.bulk_update(unstarted, ['status'])
+    errors = do_cancel_jobs([job_model for job_model in job_models if job_model.status == models.JobStatus.RUNNING])
+
+    return {job_model.pipeline_id: errors[job_model.pk] for job_model in job_models if job_model.pk in errors}
+
+
+def do_cancel_jobs(job_models: list[models.Job]) -> dict[int, str]:
+    """
+    Stops the containers of the running jobs in parallel. The outputs are captured and saved one by one afterwards
+
+    Returns: job id -> what went wrong, for the ones that couldn't be stopped
+    """
+    if not job_models:
+        return dict()
+
+    runner_infos = runners.alive(redis_client)
+
+    def cancel(job_model: models.Job) -> Optional[jobs.DockerJob]:
+        """
+        Returns: None if the runner is gone
+        """
+        try:
+            job = jobs.DockerJob(client_for(job_model.runner, runner_infos), job_model)
+        except runners.RunnerGone:
+            return None
 
-    for job_model in models.Job.objects.filter(pipeline=pipeline):
-        job = jobs.DockerJob(docker_client, job_model)
         job.cancel()
-        job.save()
+        return job
+
+    with ThreadPoolExecutor(max_workers=settings.FASTCI_CREATE_CONTAINER_THREADS) as executor:
+        futures = [executor.submit(cancel, job_model) for job_model in job_models]
+        # have to wait for all of them anyway, so we know what to save
+        concurrent.futures.wait(futures)
+
+    errors = dict()
+
+    for job_model, future in zip(job_models, futures):
+        if future.exception() is not None:
+            # the next step will see it's still running
+            logger.error(f'Could not cancel job {job_model.pk}: {future.exception()}')
+            errors[job_model.pk] = reports.describe_error(future.exception())
+        elif future.result() is None:
+            # nothing to stop anymore
+            job_model.status = models.JobStatus.CANCELLED
+            job_model.save()
+            events.job_changed(job_model)
+        else:
+            future.result().save()
 
-    notify_of_change()
+    return errors
 
 
 # Come up with more consistent naming
 @app.task
 def step_pipeline(pipeline_model_id: int):
-    pipeline = models.Pipeline.objects.get(pk=pipeline_model_id)
+    with leases.wait_for(pipeline_model_id) as changed_hands:
+        if changed_hands:
+            forget_pipeline_graph(pipeline_model_id)
 
-    if pipeline.cleaned_up:
-        logger.warning('Trying to step an already cleaned up pipeline!')
-        return
+        pipeline = models.Pipeline.objects.get(pk=pipeline_model_id)
 
-    if do_step_pipeline(pipeline):
-        notify_of_change()
+        if pipeline.cleaned_up:
+            logger.warning('Trying to step an already cleaned up pipeline!')
+            return
+
+        runner_infos = runners.alive(redis_client)
+        # only the runners the pipeline's jobs are on
+        pipeline_runners = set(pipeline.jobs.values_list('runner', flat=True))
+        container_states = get_container_states({runner: info for runner, info in runner_infos.items()
+                                                 if runner in pipeline_runners}, pipeline.pk)
+        capacity = admission.Capacity.current(runner_infos)
+        admit_ready_jobs([pipeline], capacity)
+
+        if do_step_pipeline(pipeline, container_states, capacity,
+                            prefetch_running_jobs([pipeline], container_states, capacity)):
+            notify_of_change()
+
+    wake_queued_pipelines(capacity)
+
+
+@app.task
+def update_pipeline(pipeline_model_id: int):
+    """
+    Same as step_pipeline, but someone has asked for it, so the outcome is reported
+    """
+    step_pipeline(pipeline_model_id)
+
+
+def place_jobs(data: dict, runner_infos: Optional[dict[str, runners.RunnerInfo]] = None) -> list[str]:
+    """
+    Args:
+        runner_infos: see runners.alive, asked for if not given
+
+    Raises: ValidationError if some of the jobs can't be put on any of the runners
+
+    Returns: runner of each job of an already validated pipeline, see runners.place
+    """
+    # everything but their own volumes comes with the pipeline
+    pipeline_needs_paths = data.get('setup_pipeline_dir', False) or 'commit_hash' in data \
+        or 'bind_workdir_from_host' in data
+    placement = runners.place(runner_infos if runner_infos is not None else runners.alive(redis_client),
+                              [set(job_data.get('runner_labels', [])) for job_data in data['jobs']],
+                              [pipeline_needs_paths or bool(job_data.get('volumes')) for job_data in data['jobs']])
+
+    if placement is None:
+        raise ValidationError({'runner_labels': 'No runner has all of the labels of some of the jobs (or sees the '
+                                                'same files as we do, if the jobs need them)'})
+
+    return placement
+
+
+def resolve_pipeline_images(pipelines: list[tuple[dict, list[str]]]) -> dict[str, dict[str, str]]:
+    """
+    The docker can't create a container without its image, so whatever is missing is pulled before anything else, all
+    at once on each runner. Also fails early if there's no such image
+
+    Args:
+        pipelines: the data of each pipeline and its placement, see place_jobs
+
+    Raises: see images.resolve_images
+
+    Returns: runner -> its image digests, see do_create_container
+    """
+    runner_images = dict()
+
+    for data, placement in pipelines:
+        for job_data, runner in zip(data['jobs'], placement):
+            runner_images.setdefault(runner, set()).add(job_data['image'])
+
+    return {runner: images.resolve_images(client_for(runner), names, remember=runner == runners.LOCAL)
+            for runner, names in runner_images.items()}
+
+
+def after_pipelines_created(pipeline_ids: list[int]):
+    notify_of_change()
+
+    # Don't wait for the next tick to start the first jobs
+    for pipeline_id in pipeline_ids:
+        step_pipeline.delay(pipeline_id)
+
+    if container_pool is not None and pipeline_ids:
+        # top up what we've just taken
+        maintain_warm_pool.delay()
 
 
 @app.task
-@transaction.atomic
 def create_pipeline_from_json(json_str: str) -> int:
     # TODO: we pass the json already, so maybe we can somehow tell celery not to serialize any more
     data = json.loads(json_str)
+    validate_pipeline_data(data)
+    placement = place_jobs(data)
+    pipeline_id = do_create_pipeline(data, placement, resolve_pipeline_images([(data, placement)]))
+    after_pipelines_created([pipeline_id])
 
-    bind_workdir_from_host = Path(data['bind_workdir_from_host']) if 'bind_workdir_from_host' in data else None
-
-    if bind_workdir_from_host is not None:
-        if not bind_workdir_from_host.is_absolute():
-            raise ValidationError({'bind_workdir_from_host': 'must be absolute'})
+    return pipeline_id
 
-    if 'commit_hash' in data and 'repo_url' not in data:
-        raise ValidationError({'repo_url': 'Also required'})
 
-    if 'commit_hash' not in data and 'repo_url' in data:
-        raise ValidationError({'commit_hash': 'Also required'})
-
-    if 'jobs' not in data or not isinstance(data['jobs'], list) or len(data['jobs']) == 0:
-        raise ValidationError({'jobs': 'Must be a non-empty list'})
+def do_create_pipeline(data: dict, placement: list[str], image_digests: dict[str, dict[str, str]]) -> int:
+    """
+    Args:
+        data: an already validated pipeline
+        placement: see place_jobs
+        image_digests: see resolve_pipeline_images, may have more than this pipeline needs
 
+    Returns: id of the created pipeline
+    """
+    bind_workdir_from_host = Path(data['bind_workdir_from_host']) if 'bind_workdir_from_host' in data else None
     commit_hash = data.get('commit_hash')
     repo_url = data.get('repo_url')
-
-    if commit_hash is not None:
-        if bind_workdir_from_host is not None:
-            raise ValidationError({'bind_workdir_from_host': 'If pipeline is in repo mode, we can\'t bind a '
-                                                             'custom workdir, working directory is set to be the '
-                                                             'root of the repository!'})
-        if data.get('setup_pipeline_dir', False):
-            raise ValidationError({'setup_pipeline_dir': 'If pipeline is in repo mode, there\'s no need to setup the '
-                                                         'pipeline dir, sincethe repository directory is shared for '
-                                                         'all jobs in the pipeline!'})
-
     common_pipeline_dir = Path(tempfile.mkdtemp()) if data.get('setup_pipeline_dir', False) \
                                                       or commit_hash is not None else None
 
+    # We need the id for the container labels. But we don't want to keep the database locked while the docker creates
+    # the containers, so the pipeline is saved on its own
+    # WARN: This means that for a while the pipeline doesn't have any jobs, and the stepper must be ready for that
+    #       It's deleted again if anything fails, or later by the scheduler if we die, see delete_abandoned_pipelines
+    pipeline = models.Pipeline(name=data['name'], tmp_dir=common_pipeline_dir, commit_hash=commit_hash,
+                               repo_url=repo_url, created_secs=time.time())
+    pipeline.save()
+
     try:
-        pipeline = models.Pipeline(name=data['name'], tmp_dir=common_pipeline_dir, commit_hash=commit_hash,
-                                   repo_url=repo_url)
-        pipeline.save()
+        if commit_hash is not None:
+            # Once for the whole pipeline, before any job starts
+            repo_cache.checkout(repo_url, commit_hash, common_pipeline_dir)
 
-        jobs_names = dict()
+        hits = restore_cached_roots(data, placement, image_digests, common_pipeline_dir)
+        # the hits never get a container
+        to_create = [i for i, job_data in enumerate(data['jobs']) if job_data['name'] not in hits]
+        created = do_create_containers([data['jobs'][i] for i in to_create], [placement[i] for i in to_create],
+                                       image_digests, pipeline.pk, common_pipeline_dir, bind_workdir_from_host,
+                                       commit_hash, repo_url)
+        containers = [(None, None)] * len(data['jobs'])
 
-        # TODO: All of this try except is super ugly... And I have a feeling I'm using transactions incorrectly, but
-        #       right now I don't see how I can do better
-        try:
-            for i, job_data in enumerate(data['jobs']):
-                try:
-                    job = do_create_job(job_data, pipeline.pk, common_pipeline_dir, bind_workdir_from_host, commit_hash,
-                                        repo_url)
-                except ValidationError as e:
-                    raise ValidationError({f'job {i}': e.detail})
-
-                if job.name in jobs_names:
-                    # @Speed - do_clean_up_job does some useless database actions
-                    do_clean_up_job(job)
-                    raise ValidationError({job.name: 'Names of jobs in a single pipeline must be unique'})
-
-                jobs_names[job.name] = job
-
-            if 'parents' in data:
-                for child_name, parent_names in data['parents'].items():
-                    jobs_names[child_name].parents.set([jobs_names[parent_name] for parent_name in parent_names])
-
-            for job in jobs_names.values():
-                job.save()
-        except (DatabaseError, ValidationError):
-            # @Speed - do_clean_up_job does some useless database actions
-            for job in jobs_names.values():
-                do_clean_up_job(job)
+        for i, container in zip(to_create, created):
+            containers[i] = container
 
+        try:
+            with transaction.atomic():
+                jobs_names = {job_data['name']: do_create_job(job_data, runner, image_digests[runner], pipeline,
+                                                              container, pool_slot, hits.get(job_data['name']))
+                              for job_data, runner, (container, pool_slot) in zip(data['jobs'], placement, containers)}
+
+                # from_job is the one who has the parents
+                models.Job.parents.through.objects.bulk_create([
+                    models.Job.parents.through(from_job=jobs_names[child_name], to_job=jobs_names[parent_name])
+                    for child_name, parent_names in data.get('parents', {}).items() for parent_name in parent_names
+                ])
+        except Exception:
+            roll_back_containers(created)
             raise
-    except (DatabaseError, ValidationError):
-        if common_pipeline_dir:
-            os.rmdir(common_pipeline_dir)
 
+        # not while the database is locked
+        for name, (key, _) in hits.items():
+            job_cache.restore_logs(key, jobs_names[name].pk)
+    except Exception:
+        delete_pipelines([pipeline])
+        # someone might have seen it in the meantime
+        notify_of_change()
         raise
 
-    notify_of_change()
+    events.pipeline_changed(pipeline)
+
+    for job in jobs_names.values():
+        events.job_changed(job)
 
     return pipeline.pk
 
 
-def do_step_pipeline(pipeline: models.Pipeline) -> bool:
+def delete_pipelines(pipelines: list[models.Pipeline]):
+    """
+    Only the ones whose creation has failed, so their jobs (if any) have never run
+    """
+    job_ids = list(models.Job.objects.filter(pipeline__in=pipelines).values_list('pk', flat=True))
+
+    for pipeline in pipelines:
+        if pipeline.tmp_dir is not None:
+            shutil.rmtree(pipeline.tmp_dir, ignore_errors=True)
+
+        events.pipeline_deleted(pipeline.pk)
+
+    models.Pipeline.objects.filter(pk__in=[pipeline.pk for pipeline in pipelines]).delete()
+
+    # FYI: Unlike the containers, the logs are kept when the pipelines are cleaned up, since they are still shown
+    for job_id in job_ids:
+        logs.JobLogStore(job_id).remove()
+
+
+def delete_abandoned_pipelines():
+    """
+    The ones whose creation was cut short without cleaning up after itself, i.e. the worker died. See do_create_pipeline
+    """
+    delete_pipelines(list(models.Pipeline.objects.filter(
+        status=models.PipelineStatus.NOT_STARTED, jobs__isnull=True,
+        created_secs__lt=time.time() - settings.FASTCI_ABANDONED_PIPELINE_SECS)))
+
+
+def do_create_pipelines(json_strs: list[str]) -> list[dict]:
+    """
+    Creates a batch of pipelines. One failed pipeline doesn't stop the others. Everything is validated and placed
+    before anything is created, and the images of all of them are pulled at once
+
+    Returns: {"pipeline_id": ... or None, "error": None or what went wrong} for each of them, in the same order
+    """
+    results = [{'pipeline_id': None, 'error': None} for _ in json_strs]
+    runner_infos = runners.alive(redis_client)
+    # index, data, placement
+    prepared = []
+
+    for index, json_str in enumerate(json_strs):
+        try:
+            data = json.loads(json_str)
+            validate_pipeline_data(data)
+            prepared.append((index, data, place_jobs(data, runner_infos)))
+        except (ValueError, ValidationError) as e:
+            results[index]['error'] = reports.describe_error(e)
+
+    try:
+        image_digests = resolve_pipeline_images([(data, placement) for _, data, placement in prepared])
+    except (docker.errors.DockerException, requests.exceptions.RequestException, runners.RunnerGone) as e:
+        # so only the ones whose images are missing fail, see below
+        logger.warning(f'Could not resolve the images of the whole batch: {e}')
+        image_digests = None
+
+    for index, data, placement in prepared:
+        try:
+            results[index]['pipeline_id'] = do_create_pipeline(
+                data, placement, image_digests if image_digests is not None else
+                resolve_pipeline_images([(data, placement)]))
+        except Exception as e:
+            logger.exception(e)
+            results[index]['error'] = reports.describe_error(e)
+
+    after_pipelines_created([result['pipeline_id'] for result in results if result['pipeline_id'] is not None])
+
+    return results
+
+
+# @CopyPaste - the name is used by the post-receive hook, keep in sync
+@app.task
+def create_pipelines_from_json(json_strs: list[str]) -> list[Optional[int]]:
+    """
+    Creates a batch of pipelines, i.e. all of the ones from a push, see do_create_pipelines
+
+    Returns: ids of the pipelines, None for the ones that failed
+    """
+    return [result['pipeline_id'] for result in do_create_pipelines(json_strs)]
+
+
+@app.task
+def create_pipelines(json_strs: list[str]) -> list[dict]:
+    """
+    Same as create_pipelines_from_json, but tells what went wrong with each of them
+
+    Returns: see do_create_pipelines
+    """
+    return do_create_pipelines(json_strs)
+
+
+def get_pipeline_graph(pipeline: models.Pipeline) -> Optional[graphs.PipelineGraph]:
+    """
+    Returns: None if the pipeline doesn't have any jobs yet (they are still being created)
+    """
+    if pipeline.pk not in pipeline_graphs:
+        graph = graphs.PipelineGraph.build(pipeline)
+
+        if graph is None:
+            return None
+
+        pipeline_graphs[pipeline.pk] = graph
+
+    return pipeline_graphs[pipeline.pk]
+
+
+def wake_queued_pipelines(capacity: admission.Capacity):
+    """
+    In the events mode nobody steps the pipelines whose jobs wait in the queue when a job of some other pipeline is
+    done, so we do it ourselves. In the poll mode the next tick takes care of them anyway
+    """
+    if settings.FASTCI_SCHEDULER_MODE != 'events' or not capacity.released:
+        return
+
+    for pipeline_id in models.Job.objects.filter(status=models.JobStatus.QUEUED).values_list('pipeline_id', flat=True) \
+            .distinct():
+        step_pipeline.delay(pipeline_id)
+
+
+def forget_pipeline_graph(pipeline_id: int):
+    """
+    Must be called whenever the jobs of the pipeline are changed outside of do_step_pipeline
+    """
+    pipeline_graphs.pop(pipeline_id, None)
+
+
+def admit_ready_jobs(pipelines: list[models.Pipeline], capacity: admission.Capacity):
+    """
+    Admits the ready jobs of all of the pipelines at once, the most critical ones first (see
+    PipelineGraph.compute_priorities), so it doesn't matter in which order the pipelines are stepped. Whatever doesn't
+    fit is queued by step_job
+
+    WARN: The priorities are only compared within the pipelines of this call, i.e. the batch of one worker (or the one
+          pipeline of step_pipeline). The ready jobs of the pipelines stepped elsewhere at the same time aren't seen, so
+          one of theirs with a lower priority can still take the capacity first. The priorities are kept only in the
+          graphs, which live in the memory of whoever holds the lease
+    """
+    priorities = dict()
+
+    for pipeline in pipelines:
+        graph = get_pipeline_graph(pipeline)
+
+        if graph is not None:
+            priorities.update({job_id: graph.nodes[job_id].priority for job_id in graph.ready})
+
+    ready_jobs = models.Job.objects.filter(pk__in=list(priorities)).only('pk', 'runner', 'cpus', 'memory_bytes')
+
+    # the smaller ones that still fit go ahead of the bigger ones that don't
+    for job in sorted(ready_jobs, key=lambda job: (-priorities[job.pk], job.pk)):
+        capacity.admit(job)
+
+
+def prefetch_running_jobs(pipelines: list[models.Pipeline], container_states: dict[str, str],
+                          capacity: admission.Capacity) -> dict[int, jobs.PrefetchedContainer]:
+    """
+    Asks the docker about all of the running jobs of the pipelines at once (and starts the ready ones), instead of one
+    after another while they are being stepped. So a tick takes as long as the slowest call, not all of them together
+
+    WARN: The pipelines must be leased, since the ready jobs are started right away. Only the ones that were admitted
+          are started (see admit_ready_jobs), the rest are queued by step_job as usual
+
+    Returns: job id -> what was fetched for it. Empty if FASTCI_DOCKER_BACKEND isn't 'asyncio'
+    """
+    if settings.FASTCI_DOCKER_BACKEND != 'asyncio':
+        return dict()
+
+    running_ids = set()
+    ready_ids = set()
+
+    for pipeline in pipelines:
+        graph = get_pipeline_graph(pipeline)
+
+        if graph is not None:
+            running_ids |= graph.running
+            ready_ids |= graph.ready
+
+    # the pooled ones are started by DockerJob itself, and the cached ones might not need to be started at all
+    startable = Q(pk__in=ready_ids & capacity.admitted_ids, pool_slot__isnull=True, cache_spec__isnull=True)
+    # only the local docker is asked directly, the remote runners go through the SDK as usual
+    job_models = list(models.Job.objects.filter(Q(pk__in=running_ids) | startable, container_id__isnull=False,
+                                                runner=runners.LOCAL)
+                      .only('pk', 'container_id', 'stdout_log_cursor', 'stderr_log_cursor'))
+
+    async def prefetch_all() -> list[Optional[jobs.PrefetchedContainer]]:
+        client = aiodocker.AsyncDockerClient(settings.FASTCI_DOCKER_SOCKET, settings.FASTCI_DOCKER_CONCURRENCY)
+        return await asyncio.gather(*[jobs.prefetch_container(client, job, container_states.get(job.container_id),
+                                                              start=job.pk in ready_ids)
+                                      for job in job_models])
+
+    return {job.pk: prefetched for job, prefetched in zip(job_models, asyncio.run(prefetch_all()))
+            if prefetched is not None}
+
+
+def do_step_pipeline(pipeline: models.Pipeline, container_states: dict[str, str], capacity: admission.Capacity,
+                     prefetched: Optional[dict[int, jobs.PrefetchedContainer]] = None) -> bool:
     """
+    Args:
+        container_states: see get_container_states. The containers that aren't in here are asked about one by one
+        capacity: see step_job, shared by all of the pipelines stepped in the same tick
+        prefetched: see prefetch_running_jobs
+
     Returns: if anything changed
     """
     assert not pipeline.cleaned_up, 'Trying to step a cleaned up pipeline!'
 
-    jobs = list(models.Job.objects.filter(pipeline=pipeline))
-    # make sure we have non-zero amount of jobs
-    assert jobs
+    graph = get_pipeline_graph(pipeline)
 
-    # WARN: list comprehension is needed because all steps must be run
-    anything_changed = any([step_job(job) for job in jobs])
+    if graph is None:
+        return False
 
-    if all(job.is_complete() for job in jobs):
-        # all jobs are either cancelled, transitively cancelled or successfull
-        if all(job.status == models.JobStatus.CANCELLED or job.status == models.JobStatus.DEPENDENCY_FAILED or
-               job.is_successfull() for job in jobs) and any(not job.is_successfull() for job in jobs):
-            pipeline.status = models.PipelineStatus.CANCELLED
-        elif any(job.is_failed() for job in jobs):
-            pipeline.status = models.PipelineStatus.FAILED
-        else:
-            pipeline.status = models.PipelineStatus.FINISHED
+    anything_changed = False
+    stepped_ids = set()
+
+    # The jobs released by the ones we've just stepped can be stepped right away, no need to wait for the next tick
+    while to_step_ids := graph.active_ids() - stepped_ids:
+        job_models = models.Job.objects.in_bulk(list(to_step_ids))
+        # WARN: list comprehension is needed because all steps must be run
+        anything_changed = any([step_job(job, graph, container_states.get(job.container_id), capacity,
+                                         (prefetched or dict()).get(job.pk))
+                                for job in (job_models[job_id] for job_id in graph.by_priority(to_step_ids)
+                                            if job_id in job_models)]) or anything_changed
+        stepped_ids |= to_step_ids
+
+    if graph.is_complete():
+        pipeline.status = graph.final_status()
+        pipeline.finished_secs = time.time()
 
-        pipeline.save()
+        # i.e. everything was taken from the cache right away
+        if pipeline.started_secs is None:
+            pipeline.started_secs = pipeline.finished_secs
+
+        pipeline.save(update_fields=['status', 'started_secs', 'finished_secs'])
+        events.pipeline_changed(pipeline)
+        forget_pipeline_graph(pipeline.pk)
         anything_changed = True
     elif pipeline.status == models.PipelineStatus.NOT_STARTED:
         pipeline.status = models.PipelineStatus.RUNNING
-        pipeline.save()
+        pipeline.started_secs = time.time()
+        pipeline.save(update_fields=['status', 'started_secs'])
+        events.pipeline_changed(pipeline)
         anything_changed = True
 
     return anything_changed
@@ -377,29 +1402,196 @@ def do_step_pipeline(pipeline: models.Pipeline) -> bool:
 
 @app.task
 def step_pipelines():
-    # TODO: Real bad problems with concurrency. Right now we just run one worker with only one thread...
-    #       Maybe we need to switch to PostgreSQL, transactions with sqlite always cause locks, and I don't know why...
-    #       How bad could the engine be to cause deadlocks ALL. THE. TIME..? So I assume that I'm doing something wrong
-    pipelines_to_step = models.Pipeline.objects.filter((Q(status=models.PipelineStatus.NOT_STARTED) |
-                                                        Q(status=models.PipelineStatus.RUNNING)) & Q(cleaned_up=False))
-
-    # WARN: list comprehension is needed because all the steps must be run
-    if any([do_step_pipeline(pipeline) for pipeline in pipelines_to_step]):
-        notify_of_change()
+    do_step_pipelines()
+
+    if container_pool is not None:
+        container_pool.maintain()
+
+
+def do_step_pipelines() -> bool:
+    """
+    Steps a batch of the active pipelines and cleans up the old ones
+
+    Returns: True if there's probably more work right away, i.e. something has changed or the batch was full
+    """
+    # Any number of workers can run this at the same time, each one steps only the pipelines it has got the leases of
+    active_pipelines = models.Pipeline.objects.filter((Q(status=models.PipelineStatus.NOT_STARTED) |
+                                                       Q(status=models.PipelineStatus.RUNNING)) & Q(cleaned_up=False))
+    acquired = leases.claim_batch(active_pipelines, settings.FASTCI_LEASE_BATCH_SIZE)
+    renewed_secs = time.time()
+
+    try:
+        for pipeline_id, changed_hands in acquired.items():
+            if changed_hands:
+                forget_pipeline_graph(pipeline_id)
+
+        # the status could have changed before we got the lease
+        pipelines_to_step = list(active_pipelines.filter(pk__in=list(acquired)))
+
+        # One call per runner for all of its containers instead of one per job
+        runner_infos = runners.alive(redis_client)
+        container_states = get_container_states(runner_infos)
+        capacity = admission.Capacity.current(runner_infos)
+        admit_ready_jobs(pipelines_to_step, capacity)
+        prefetched = prefetch_running_jobs(pipelines_to_step, container_states, capacity)
+
+        anything_changed = False
+        held = set(acquired)
+
+        for i, pipeline in enumerate(pipelines_to_step):
+            # Creating the containers (or pulling the images) of the ones before might have taken a while, and the
+            # leases must not expire while we are still stepping
+            if time.time() - renewed_secs > settings.FASTCI_LEASE_TTL_SECS / 2:
+                held = leases.renew(other.pk for other in pipelines_to_step[i:])
+                renewed_secs = time.time()
+
+            # someone else has taken it over in the meantime, and is stepping it now
+            if pipeline.pk not in held:
+                logger.warning(f'Lost the lease of pipeline {pipeline.pk} before stepping it')
+                continue
+
+            anything_changed |= do_step_pipeline(pipeline, container_states, capacity, prefetched)
+
+        if anything_changed:
+            notify_of_change()
+    finally:
+        leases.release(acquired)
+
+    wake_queued_pipelines(capacity)
+    busy = anything_changed or len(acquired) == settings.FASTCI_LEASE_BATCH_SIZE
+
+    # the ones that were cancelled or cleaned up in the meantime
+    for pipeline_id in set(pipeline_graphs) - set(active_pipelines.values_list('pk', flat=True)):
+        forget_pipeline_graph(pipeline_id)
 
     pipelines_to_clean_up = models.Pipeline.objects.filter(~Q(status=models.PipelineStatus.NOT_STARTED) &
                                                            ~Q(status=models.PipelineStatus.RUNNING) &
                                                            Q(cleaned_up=False))[COUNT_FIRST_PIPELINES_TO_NOT_CLEAN_UP:]
+    acquired = leases.try_acquire(pipelines_to_clean_up.values_list('pk', flat=True))
+
+    try:
+        # the others might have been cleaned up while we were waiting
+        do_clean_up_pipelines(list(models.Pipeline.objects.filter(pk__in=list(acquired), cleaned_up=False)))
+    finally:
+        leases.release(acquired)
+
+    delete_abandoned_pipelines()
+    # the containers that are gone now
+    notify_of_change()
+
+    return busy
+
+
+def run_scheduler(should_stop: Callable[[], bool]):
+    """
+    Steps the pipelines in a loop until told to stop. Unlike the beat ticks, the steps never overlap or pile up in the
+    queue. Sleeps for FASTCI_SCHEDULER_MIN_SLEEP_SECS while there's work to do, and backs off up to the tick interval of
+    the current mode when there isn't
+    """
+    max_sleep_secs = settings.FASTCI_RECONCILE_INTERVAL_SECS if settings.FASTCI_SCHEDULER_MODE == 'events' \
+        else settings.FASTCI_POLL_INTERVAL_SECS
+    sleep_secs = settings.FASTCI_SCHEDULER_MIN_SLEEP_SECS
+
+    while not should_stop():
+        tick_start = time.time()
+
+        try:
+            busy = do_step_pipelines()
+        except Exception as e:
+            # i.e. the docker or the database is restarting, we'll just try again later
+            logger.exception(e)
+            busy = False
+
+        if busy:
+            sleep_secs = settings.FASTCI_SCHEDULER_MIN_SLEEP_SECS
+        else:
+            sleep_secs = min(2 * sleep_secs, max_sleep_secs)
+
+        # the time of the step itself counts too
+        time.sleep(max(0.0, sleep_secs - (time.time() - tick_start)))
+
+
+@app.task
+def collect_image_garbage():
+    removed = images.collect_garbage(docker_client, settings.FASTCI_IMAGE_CACHE_BUDGET_BYTES)
+
+    if removed:
+        logger.info(f'Removed images: {", ".join(removed)}')
+
+
+@app.task
+def collect_job_cache_garbage():
+    removed = job_cache.collect_garbage()
+
+    if removed:
+        logger.info(f'Removed unfinished job cache entries: {", ".join(path.name for path in removed)}')
 
-    for pipeline in pipelines_to_clean_up:
-        do_clean_up_pipeline(pipeline)
+
+@app.task
+def maintain_warm_pool():
+    if container_pool is not None:
+        container_pool.maintain()
+
+
+def find_pipeline_of_container(container_id: str) -> Optional[int]:
+    """
+    Returns: id of the pipeline that owns the container, or None if it's not one of ours
+    """
+    return models.Job.objects.filter(container_id=container_id).values_list('pipeline_id', flat=True).first()
+
+
+def watch_docker_events():
+    """
+    Steps the pipelines whenever the docker tells us that something happened to their containers. Runs forever
+
+    The stepping itself is done by the worker, we just send it the `step_pipeline` tasks
+    """
+    since = None
+
+    while True:
+        try:
+            # Only ours, so the other containers on the host don't cost us a query each. The ones created before we
+            # started labelling them are left to the reconciliation sweep
+            for event in docker_client.events(since=since, decode=True,
+                                              filters={'type': 'container', 'event': ['start', 'die', 'oom'],
+                                                       'label': jobs.MANAGED_LABEL}):
+                # in case we reconnect, so we don't miss anything in between
+                since = event['time']
+
+                if jobs.PIPELINE_LABEL in event['Actor']['Attributes']:
+                    pipeline_id = int(event['Actor']['Attributes'][jobs.PIPELINE_LABEL])
+                else:
+                    # taken from the warm pool, or not claimed yet
+                    pipeline_id = find_pipeline_of_container(event['id'])
+
+                if pipeline_id is not None:
+                    step_pipeline.delay(pipeline_id)
+        except (docker.errors.APIError, docker.errors.DockerException) as e:
+            # docker daemon restarted or something like that, just reconnect. The reconciliation sweep will take care of
+            # anything that happened while we were gone
+            logger.error(e)
+            time.sleep(1)
 
 
 @app.on_after_configure.connect
 def setup_periodic_tasks(sender, **kwargs):
-    # TODO: The fact that the tasks may overlap might cause problems. And right now they can.
-    #       The solution proposed by celery via locking is really trash so I don't want to implement it...
-    #       I think we should eventually make it so each task schedules the next one after completion, and get rid of
-    #       the external beat scheduler. Another idea is to make an infinite task, maybe with the help of eventlet
+    # NOTE: The ticks can overlap, which is fine thanks to the leases. But under load the beat sends them faster than the
+    #       worker can handle, and they pile up in the queue. That's what FASTCI_SCHEDULER_DAEMON is for
     # FYI: logging also isn't setup at this point
-    sender.add_periodic_task(0.5, step_pipelines.s(), name='Update job info and schedule jobs')
+    if settings.FASTCI_SCHEDULER_DAEMON:
+        # the scheduler daemon does the stepping, but the warm pool lives in the worker
+        if settings.FASTCI_WARM_POOL_SIZE > 0:
+            sender.add_periodic_task(settings.FASTCI_POLL_INTERVAL_SECS, maintain_warm_pool.s(),
+                                     name='Top up the warm pool')
+    elif settings.FASTCI_SCHEDULER_MODE == 'events':
+        # The events do the actual scheduling, this is just a fallback
+        sender.add_periodic_task(settings.FASTCI_RECONCILE_INTERVAL_SECS, step_pipelines.s(),
+                                 name='Reconcile job info and schedule jobs')
+    else:
+        sender.add_periodic_task(settings.FASTCI_POLL_INTERVAL_SECS, step_pipelines.s(),
+                                 name='Update job info and schedule jobs')
+
+    sender.add_periodic_task(settings.FASTCI_IMAGE_GC_INTERVAL_SECS, collect_image_garbage.s(),
+                             name='Remove least recently used images')
+    sender.add_periodic_task(settings.FASTCI_JOB_CACHE_GC_INTERVAL_SECS, collect_job_cache_garbage.s(),
+                             name='Remove unfinished job cache entries')
@@ -1,3 +1,785 @@
-from django.test import TestCase
+import asyncio
+import fnmatch
+import json
+import hashlib
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Optional
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from asgiref.testing import ApplicationCommunicator
+from channels.routing import URLRouter
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import IntegrityError
+from django.test import TestCase, TransactionTestCase, override_settings
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from . import admission
+from . import graphs
+from . import images
+from . import job_cache
+from . import jobs
+from . import leases
+from . import logs
+from . import models
+from . import repo_cache
+from . import runners
+from . import tasks
+from . import versions
+from . import views
+from . import websocket_consumers
+from . import websocket_routing
+
+
+class FakeRedis:
+    """
+    Only what the runners and the versions need, without the expiry
+    """
+    values: dict[str, bytes]
+
+    def __init__(self):
+        self.values = dict()
+
+    def set(self, key: str, value: str, ex: int = None, nx: bool = False):
+        if not nx or key not in self.values:
+            self.values[key] = value.encode()
+
+    def get(self, key: str) -> Optional[bytes]:
+        return self.values.get(key)
+
+    def incr(self, key: str):
+        self.values[key] = str(int(self.values.get(key, b'0')) + 1).encode()
+
+    def delete(self, key: str):
+        self.values.pop(key, None)
+
+    def scan_iter(self, match: str) -> list[str]:
+        return [key for key in self.values if fnmatch.fnmatch(key, match)]
+
+    def mget(self, keys: list[str]) -> list[Optional[bytes]]:
+        return [self.values.get(key) for key in keys]
+
+    @contextmanager
+    def pipeline(self, transaction: bool = True):
+        # executed right away
+        yield mock.MagicMock(incr=self.incr)
+
+
+def make_container_id(name: str) -> str:
+    return hashlib.sha256(name.encode()).hexdigest()
+
+
+def make_fake_docker(name: str) -> mock.MagicMock:
+    client = mock.MagicMock()
+    client.images.get.return_value = mock.MagicMock(id=f'sha256:{name}', attrs={'Size': 1})
+    client.containers.create.return_value = mock.MagicMock(id=make_container_id(name))
+    return client
+
+
+def connect_websocket(path: str, query_string: bytes) -> dict:
+    """
+    Returns: the first thing the consumer answers the handshake with
+    """
+    async def run() -> dict:
+        communicator = ApplicationCommunicator(URLRouter(websocket_routing.websocket_urlpatterns), {
+            'type': 'websocket', 'path': path, 'query_string': query_string, 'headers': [], 'subprotocols': []
+        })
+        await communicator.send_input({'type': 'websocket.connect'})
+        answer = await communicator.receive_output(5)
+        await communicator.send_input({'type': 'websocket.disconnect', 'code': 1000})
+        await communicator.wait(5)
+        return answer
+
+    return async_to_sync(run)()
+
+
+def make_access_token() -> str:
+    return str(RefreshToken.for_user(User.objects.create(username='someone')).access_token)
+
+
+# the consumers would listen to the redis otherwise
+@override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}})
+class JobLogTailTest(TransactionTestCase):
+    def test_rejects_without_token(self):
+        self.assertEqual(connect_websocket('/ws/job_log/1/', b'offset=0')['type'], 'websocket.close')
+
+    def test_rejects_invalid_token(self):
+        self.assertEqual(connect_websocket('/ws/job_log/1/', b'offset=0&token=nope')['type'], 'websocket.close')
+
+    def test_accepts_valid_token(self):
+        self.assertEqual(connect_websocket('/ws/job_log/1/', f'offset=0&token={make_access_token()}'.encode())['type'],
+                         'websocket.accept')
+
+
+@override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}})
+class ChangeNotifierTest(TransactionTestCase):
+    def setUp(self):
+        # the hub would subscribe to the redis
+        patcher = mock.patch.object(websocket_consumers.hub, 'add')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_rejects_without_token(self):
+        self.assertEqual(connect_websocket('/ws/', b'')['type'], 'websocket.close')
+
+    def test_rejects_invalid_token(self):
+        self.assertEqual(connect_websocket('/ws/', b'token=nope')['type'], 'websocket.close')
+
+    def test_accepts_valid_token(self):
+        self.assertEqual(connect_websocket('/ws/', f'token={make_access_token()}'.encode())['type'], 'websocket.accept')
+
+
+@override_settings(FASTCI_RUNNER_TLS_CA_CERT='ca.pem', FASTCI_RUNNER_TLS_CLIENT_CERT='cert.pem',
+                   FASTCI_RUNNER_TLS_CLIENT_KEY='key.pem')
+class RemoteRunnerTest(TestCase):
+    redis_client: FakeRedis
+
+    def setUp(self):
+        self.redis_client = FakeRedis()
+        # what the agent of the second host announces, see run_runner_agent
+        runners.announce(self.redis_client, runners.RunnerInfo('second', 'tcp://second:2376', {'gpu'}, 4, 4, 2 ** 30,
+                                                               False))
+
+    def test_plain_docker_url_is_ignored(self):
+        runners.announce(self.redis_client, runners.RunnerInfo('plain', 'unix:///var/run/docker.sock', {'gpu'}, 4, 4,
+                                                               2 ** 30, False))
+        self.assertEqual(set(runners.alive(self.redis_client)), {runners.LOCAL, 'second'})
+
+        with override_settings(FASTCI_RUNNER_TLS_CLIENT_KEY=None):
+            self.assertEqual(set(runners.alive(self.redis_client)), {runners.LOCAL})
+
+    def test_jobs_land_on_second_runner(self):
+        data = {'name': 'p', 'jobs': [{'name': 'a', 'image': 'img', 'command': 'true', 'runner_labels': ['gpu']},
+                                      {'name': 'b', 'image': 'img', 'command': 'true'}]}
+        local_docker = make_fake_docker('local')
+        second_docker = make_fake_docker('second')
+
+        with mock.patch.object(tasks, 'redis_client', self.redis_client), \
+                mock.patch.object(tasks, 'docker_client', local_docker), \
+                mock.patch.object(tasks, 'runner_clients', dict()), \
+                mock.patch.object(runners, 'connect', return_value=second_docker) as connect:
+            tasks.validate_pipeline_data(data)
+            placement = tasks.place_jobs(data)
+            pipeline_id = tasks.do_create_pipeline(data, placement, tasks.resolve_pipeline_images([(data, placement)]))
+
+        self.assertEqual(placement, ['second', runners.LOCAL])
+        self.assertEqual(connect.call_args.args[0].docker_url, 'tcp://second:2376')
+        jobs = {job.name: job for job in models.Job.objects.filter(pipeline_id=pipeline_id)}
+        self.assertEqual((jobs['a'].runner, jobs['a'].container_id, jobs['a'].image_digest),
+                         ('second', make_container_id('second'), 'sha256:second'))
+        self.assertEqual((jobs['b'].runner, jobs['b'].container_id), (runners.LOCAL, make_container_id('local')))
+        self.assertEqual(second_docker.containers.create.call_count, 1)
+        self.assertEqual(local_docker.containers.create.call_count, 1)
+
+
+class CreateContainersTest(TestCase):
+    def test_failed_rollback_keeps_the_first_error(self):
+        container = mock.MagicMock(id=make_container_id('a'))
+
+        def do_create_container(job_data: dict, *args):
+            if job_data['name'] == 'b':
+                raise ValueError('no such image')
+
+            return container, None
+
+        with mock.patch.object(tasks, 'do_create_container', side_effect=do_create_container), \
+                mock.patch.object(tasks, 'remove_containers', side_effect=OSError('docker is gone')) as remove, \
+                self.assertLogs('fastci.tasks', 'ERROR'), self.assertRaisesRegex(ValueError, 'no such image'):
+            tasks.do_create_containers([{'name': 'a'}, {'name': 'b'}], [runners.LOCAL, runners.LOCAL],
+                                       {runners.LOCAL: dict()}, 1)
+
+        remove.assert_called_once_with([(container, None)])
+
+
+class AdmitReadyJobsTest(TestCase):
+    def test_one_query_per_tick(self):
+        pipeline = models.Pipeline.objects.create(name='p')
+
+        for i in range(10):
+            models.Job.objects.create(name=f'j{i}', pipeline=pipeline, container_id=make_container_id(f'j{i}'),
+                                      runner=runners.LOCAL, image='img')
+
+        # the graph is cached between the ticks
+        tasks.get_pipeline_graph(pipeline)
+        # room for all of them
+        capacity = admission.Capacity({runners.LOCAL: runners.RunnerInfo(runners.LOCAL, 'unix:///var/run/docker.sock',
+                                                                         set(), None, 100, 2 ** 40, True)}, dict())
+
+        try:
+            with self.assertNumQueries(1):
+                tasks.admit_ready_jobs([pipeline], capacity)
+        finally:
+            tasks.forget_pipeline_graph(pipeline.pk)
+
+        self.assertEqual(len(capacity.admitted_ids), 10)
+
+
+class RepoCacheTest(TestCase):
+    def test_mirror_is_never_collected(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            repo = Path(tmp_dir) / 'repo'
+            subprocess.run(['git', 'init', '--quiet', str(repo)], check=True)
+            subprocess.run(['git', '-c', 'user.name=fastci', '-c', 'user.email=fastci@localhost', 'commit', '--quiet',
+                            '--allow-empty', '-m', 'first'], cwd=repo, check=True)
+            commit_hash = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=repo, check=True, capture_output=True,
+                                         text=True).stdout.strip()
+
+            with override_settings(FASTCI_REPO_MIRROR_DIR=Path(tmp_dir) / 'mirrors'):
+                mirror = repo_cache.update_mirror(str(repo), commit_hash)
+
+            for name, value in repo_cache.NO_GC_CONFIG.items():
+                self.assertEqual(subprocess.run(['git', 'config', '--get', name], cwd=mirror, check=True,
+                                                capture_output=True, text=True).stdout.strip(), value)
+
+
+class JobCacheTest(TestCase):
+    def test_failed_store_leaves_nothing_behind(self):
+        with tempfile.TemporaryDirectory() as tmp_dir, override_settings(FASTCI_JOB_CACHE_DIR=Path(tmp_dir)), \
+                mock.patch.object(job_cache, 'copy_path', side_effect=OSError('disk full')):
+            job_model = mock.MagicMock(pk=1, cache_spec={'outputs': ['out']})
+
+            with self.assertRaises(OSError):
+                job_cache.store('key', job_model, Path(tmp_dir) / 'pipeline')
+
+            self.assertEqual(list(Path(tmp_dir).iterdir()), [])
+
+    def test_collects_only_stale_tmp_dirs(self):
+        with tempfile.TemporaryDirectory() as tmp_dir, override_settings(FASTCI_JOB_CACHE_DIR=Path(tmp_dir)):
+            stale = Path(tmp_dir) / f'{job_cache.TMP_PREFIX}stale'
+            fresh = Path(tmp_dir) / f'{job_cache.TMP_PREFIX}fresh'
+            entry = job_cache.entry_dir('key')
+
+            for path in [stale, fresh, entry]:
+                (path / job_cache.LOGS_DIR_NAME).mkdir(parents=True)
+
+            old = time.time() - settings.FASTCI_JOB_CACHE_TMP_TTL_SECS - 1
+            os.utime(stale, (old, old))
+            os.utime(entry, (old, old))
+
+            self.assertEqual(job_cache.collect_garbage(), [stale])
+            self.assertEqual(set(Path(tmp_dir).iterdir()), {fresh, entry})
+
+    def test_cached_root_never_gets_a_container(self):
+        data = {'name': 'p', 'commit_hash': 'c' * 40, 'repo_url': 'repo',
+                'jobs': [{'name': 'a', 'image': 'img', 'command': 'make', 'cache': {'inputs': ['in.txt'],
+                                                                                   'outputs': ['out']}},
+                         {'name': 'b', 'image': 'img', 'command': 'true'}],
+                'parents': {'b': ['a']}}
+        fake_docker = make_fake_docker('local')
+
+        def checkout(repo_url: str, commit_hash: str, destination: Path):
+            self.addCleanup(shutil.rmtree, destination, ignore_errors=True)
+            (destination / 'in.txt').write_text('in')
+
+        with tempfile.TemporaryDirectory() as tmp_dir, \
+                override_settings(FASTCI_JOB_CACHE_DIR=Path(tmp_dir) / 'cache', FASTCI_LOGS_DIR=Path(tmp_dir)), \
+                mock.patch.object(tasks, 'redis_client', FakeRedis()), \
+                mock.patch.object(tasks, 'docker_client', fake_docker), \
+                mock.patch.object(repo_cache, 'checkout', side_effect=checkout), \
+                mock.patch.object(tasks, 'notify_of_change'):
+            def create_pipeline() -> dict[str, models.Job]:
+                tasks.validate_pipeline_data(data)
+                placement = tasks.place_jobs(data)
+                pipeline_id = tasks.do_create_pipeline(data, placement,
+                                                       tasks.resolve_pipeline_images([(data, placement)]))
+                return {job.name: job for job in models.Job.objects.filter(pipeline_id=pipeline_id)}
+
+            # nothing in the cache yet
+            jobs_names = create_pipeline()
+            self.assertEqual(fake_docker.containers.create.call_count, 2)
+            self.assertEqual(jobs_names['a'].status, models.JobStatus.NOT_STARTED)
+
+            # what the first one would have stored once it succeeded
+            pipeline_dir = Path(jobs_names['a'].pipeline.tmp_dir)
+            key = job_cache.compute_key(jobs_names['a'].cache_spec, pipeline_dir)
+            (job_cache.entry_dir(key) / job_cache.OUTPUTS_DIR_NAME / 'out').mkdir(parents=True)
+            (job_cache.entry_dir(key) / job_cache.LOGS_DIR_NAME).mkdir()
+
+            for stream in logs.STREAMS:
+                (job_cache.entry_dir(key) / job_cache.LOGS_DIR_NAME / stream).write_bytes(b'made')
+
+            models.CacheEntry.objects.create(key=key, exit_code=0, created_secs=time.time(),
+                                             last_used_secs=time.time())
+
+            fake_docker.containers.create.reset_mock()
+            jobs_names = create_pipeline()
+            self.assertEqual(fake_docker.containers.create.call_count, 1)
+            self.assertEqual((jobs_names['a'].status, jobs_names['a'].exit_code, jobs_names['a'].cache_hit,
+                              jobs_names['a'].container_id, jobs_names['a'].cache_key),
+                             (models.JobStatus.FINISHED, 0, True, None, key))
+            self.assertEqual(jobs_names['b'].container_id, make_container_id('local'))
+            self.assertTrue((Path(jobs_names['a'].pipeline.tmp_dir) / 'out').is_dir())
+            log_store = logs.JobLogStore(jobs_names['a'].pk)
+            self.assertEqual(log_store.read(logs.STREAMS[0], 0, log_store.size(logs.STREAMS[0])), b'made')
+
+
+class LeasesTest(TestCase):
+    pipeline: models.Pipeline
+
+    def setUp(self):
+        self.pipeline = models.Pipeline.objects.create(name='p')
+
+    def as_worker(self, name: str):
+        return mock.patch.object(leases, 'worker_id', return_value=name)
+
+    def test_only_one_worker_wins(self):
+        with self.as_worker('first'):
+            self.assertEqual(leases.try_acquire([self.pipeline.pk]), {self.pipeline.pk: True})
+
+        with self.as_worker('second'):
+            self.assertEqual(leases.try_acquire([self.pipeline.pk]), dict())
+            self.assertEqual(leases.claim_batch(models.Pipeline.objects.all(), 10), dict())
+
+        self.pipeline.refresh_from_db()
+        self.assertEqual(self.pipeline.lease_owner, 'first')
+
+    def test_expired_lease_is_taken_over(self):
+        with self.as_worker('first'):
+            leases.try_acquire([self.pipeline.pk])
+
+        # the first one has died
+        models.Pipeline.objects.filter(pk=self.pipeline.pk).update(lease_expires_secs=time.time() - 1)
+
+        with self.as_worker('second'):
+            self.assertEqual(leases.claim_batch(models.Pipeline.objects.all(), 10), {self.pipeline.pk: True})
+
+    def test_changed_hands(self):
+        with self.as_worker('first'):
+            leases.release(leases.try_acquire([self.pipeline.pk]))
+            # nobody else has had it in between
+            self.assertEqual(leases.try_acquire([self.pipeline.pk]), {self.pipeline.pk: False})
+            leases.release([self.pipeline.pk])
+
+        with self.as_worker('second'):
+            leases.release(leases.try_acquire([self.pipeline.pk]))
+
+        with self.as_worker('first'):
+            self.assertEqual(leases.try_acquire([self.pipeline.pk]), {self.pipeline.pk: True})
+
+    @override_settings(FASTCI_LEASE_TTL_SECS=0.1, FASTCI_LEASE_RETRY_SECS=0.01)
+    def test_wait_for_all_gives_up_on_busy_ones(self):
+        free = models.Pipeline.objects.create(name='free')
+        # held by someone else well past the deadline
+        models.Pipeline.objects.filter(pk=self.pipeline.pk).update(lease_owner='second',
+                                                                   lease_expires_secs=time.time() + 60)
+
+        with self.as_worker('first'):
+            with leases.wait_for_all([self.pipeline.pk, free.pk]) as acquired:
+                self.assertEqual(set(acquired), {free.pk})
+
+            with self.assertRaises(TimeoutError):
+                with leases.wait_for(self.pipeline.pk):
+                    pass
+
+        free.refresh_from_db()
+        self.assertLessEqual(free.lease_expires_secs, time.time())
+
+    def test_renew_keeps_only_ours(self):
+        taken = models.Pipeline.objects.create(name='taken')
+
+        with self.as_worker('first'):
+            leases.try_acquire([self.pipeline.pk, taken.pk])
+
+        # ours has expired, and the other one was taken over
+        models.Pipeline.objects.update(lease_expires_secs=time.time() - 1)
+        models.Pipeline.objects.filter(pk=taken.pk).update(lease_owner='second')
+
+        with self.as_worker('first'):
+            self.assertEqual(leases.renew([self.pipeline.pk, taken.pk]), {self.pipeline.pk})
+
+        self.pipeline.refresh_from_db()
+        self.assertGreater(self.pipeline.lease_expires_secs, time.time())
+
+
+@override_settings(FASTCI_LEASE_TTL_SECS=0.2)
+class StepPipelinesTest(TestCase):
+    def step(self, on_first_step) -> list[int]:
+        """
+        Steps a batch of two pipelines, on_first_step is called with the other one while the first one is being stepped
+
+        Returns: the ids of the pipelines that were stepped, each one only if its lease was still valid by then
+        """
+        pipeline_ids = [models.Pipeline.objects.create(name=name).pk for name in ('first', 'second')]
+        stepped = []
+
+        def do_step_pipeline(pipeline: models.Pipeline, *args) -> bool:
+            if models.Pipeline.objects.get(pk=pipeline.pk).lease_expires_secs > time.time():
+                stepped.append(pipeline.pk)
+
+            if len(stepped) == 1:
+                on_first_step([pipeline_id for pipeline_id in pipeline_ids if pipeline_id != pipeline.pk][0])
+
+            return False
+
+        with mock.patch.object(runners, 'alive', return_value=dict()), \
+                mock.patch.object(tasks, 'get_container_states', return_value=dict()), \
+                mock.patch.object(tasks, 'admit_ready_jobs'), \
+                mock.patch.object(tasks, 'prefetch_running_jobs', return_value=dict()), \
+                mock.patch.object(tasks, 'notify_of_change'), \
+                mock.patch.object(tasks, 'do_step_pipeline', side_effect=do_step_pipeline):
+            tasks.do_step_pipelines()
+
+        return stepped
+
+    def test_leases_are_renewed_while_stepping(self):
+        # longer than the lease
+        stepped = self.step(lambda other_id: time.sleep(0.25))
+        self.assertEqual(len(stepped), 2)
+
+    def test_taken_over_pipeline_is_skipped(self):
+        def take_over(other_id: int):
+            time.sleep(0.25)
+            models.Pipeline.objects.filter(pk=other_id).update(lease_owner='second', lease_expires_secs=time.time() + 60)
+
+        stepped = self.step(take_over)
+        self.assertEqual(len(stepped), 1)
+
+
+class JobLogStoreTest(TestCase):
+    # the chunk boundaries are at 4, 8, 12...
+    DATA = b'aaa\nbbbb\ncc\nd'
+
+    store: logs.JobLogStore
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        settings_override = override_settings(FASTCI_LOGS_DIR=tmp_dir.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        for patcher in [mock.patch.object(logs, 'CHUNK_SIZE', 4), mock.patch.object(logs, 'MAX_READ_SIZE', 8)]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.store = logs.JobLogStore(1)
+        # in pieces that don't line up with the chunks
+        self.store.append('all', self.DATA[:6])
+        self.store.append('all', self.DATA[6:])
+
+    def read(self, start_end: tuple[int, int]) -> bytes:
+        return self.store.read('all', *start_end)
+
+    def test_chunks(self):
+        self.assertEqual(self.store.size('all'), len(self.DATA))
+        self.assertEqual(len(os.listdir(self.store.root / 'all')), 4)
+        self.assertEqual(self.store.read('all', 0, len(self.DATA)), self.DATA)
+        self.assertEqual(self.store.read('all', 2, 11), b'a\nbbbb\ncc')
+
+    def test_read_range(self):
+        # cut at the last newline, which is in another chunk
+        self.assertEqual(self.read(self.store.read_range('all', 2, 10)), b'a\nbbbb\n')
+        # capped at MAX_READ_SIZE
+        self.assertEqual(self.store.read_range('all', 0, 100), (0, 4))
+        # no newline at all
+        self.assertEqual(self.store.read_range('all', 5, 2), (5, 7))
+        # past the end
+        self.assertEqual(self.store.read_range('all', 100, 10), (len(self.DATA), len(self.DATA)))
+
+    def test_head(self):
+        self.assertEqual(self.read(self.store.head('all', 1)), b'aaa\n')
+        # capped at MAX_READ_SIZE, in the middle of the second line
+        self.assertEqual(self.read(self.store.head('all', 2)), b'aaa\nbbbb')
+        self.assertEqual(self.read(self.store.head('all', 1, offset=4)), b'bbbb\n')
+        # the last line isn't terminated yet
+        self.assertEqual(self.read(self.store.head('all', 5, offset=9)), b'cc\nd')
+        self.assertEqual(self.store.head('all', 1, offset=100), (len(self.DATA), len(self.DATA)))
+
+    def test_tail(self):
+        self.assertEqual(self.read(self.store.tail('all', 1)), b'd')
+        self.assertEqual(self.read(self.store.tail('all', 2)), b'cc\nd')
+        self.assertEqual(self.read(self.store.tail('all', 1, end=9)), b'bbbb\n')
+        # capped at MAX_READ_SIZE
+        self.assertEqual(self.store.tail('all', 100), (len(self.DATA) - 8, len(self.DATA)))
+        self.assertEqual(self.read(self.store.tail('all', 100, end=100)), self.DATA[-8:])
+
+    def test_empty(self):
+        self.assertEqual(self.store.size('stdout'), 0)
+        self.assertEqual(self.store.read_range('stdout', 0, 10), (0, 0))
+        self.assertEqual(self.store.head('stdout', 10), (0, 0))
+        self.assertEqual(self.store.tail('stdout', 10), (0, 0))
+
+    def test_remove(self):
+        self.store.remove()
+        self.assertEqual(self.store.size('all'), 0)
+
+
+class ImagesTest(TestCase):
+    def test_removes_the_recorded_image(self):
+        models.Image.objects.create(name='img', digest='sha256:old', size_bytes=10, pulled=True)
+        client = mock.MagicMock()
+
+        self.assertEqual(images.collect_garbage(client, 0), ['img'])
+        # the tag might point to a newer image by now
+        client.images.remove.assert_called_once_with('sha256:old')
+        self.assertFalse(models.Image.objects.exists())
+
+    def test_concurrent_pulls(self):
+        models.Image.objects.create(name='img', digest='sha256:old', pulled=True)
+        client = make_fake_docker('new')
+
+        # someone else got there between our get and create
+        with mock.patch.object(models.Image.objects, 'get_or_create', side_effect=IntegrityError):
+            self.assertEqual(images.resolve_images(client, {'img'}), {'img': 'sha256:new'})
+
+        image_model = models.Image.objects.get(name='img')
+        self.assertEqual(image_model.digest, 'sha256:new')
+        # it wasn't pulled this time, but it's still ours to remove
+        self.assertTrue(image_model.pulled)
+
+
+class WatchDockerEventsTest(TestCase):
+    def test_only_our_containers(self):
+        class Stop(Exception):
+            pass
+
+        def events(**kwargs):
+            yield {'time': 1, 'id': make_container_id('ours'), 'Actor': {'Attributes': {jobs.PIPELINE_LABEL: '7'}}}
+            raise Stop()
+
+        client = mock.MagicMock()
+        client.events.side_effect = events
+
+        with mock.patch.object(tasks, 'docker_client', client), \
+                mock.patch.object(tasks.step_pipeline, 'delay') as step_pipeline, self.assertRaises(Stop):
+            tasks.watch_docker_events()
+
+        self.assertEqual(client.events.call_args.kwargs['filters']['label'], jobs.MANAGED_LABEL)
+        step_pipeline.assert_called_once_with(7)
+
+
+class ChangeHubTest(TestCase):
+    def test_malformed_message_is_skipped(self):
+        change = {'pipelines': [], 'jobs': [{'id': 1, 'pipeline_id': 1}]}
+
+        async def listen():
+            yield {'data': b'{not json'}
+            yield {'data': json.dumps(change).encode()}
+            raise asyncio.CancelledError()
+
+        redis_client = mock.MagicMock(aclose=mock.AsyncMock())
+        redis_client.pubsub.return_value = mock.MagicMock(subscribe=mock.AsyncMock(), aclose=mock.AsyncMock(),
+                                                          listen=listen)
+        consumer = mock.MagicMock(push=mock.AsyncMock())
+        hub = websocket_consumers.ChangeHub()
+        hub.consumers.add(consumer)
+
+        with mock.patch('redis.asyncio.Redis', return_value=redis_client), self.assertRaises(asyncio.CancelledError):
+            async_to_sync(hub.listen)()
+
+        consumer.push.assert_called_once_with(change)
+
+    def test_malformed_subscription_is_ignored(self):
+        notifier = websocket_consumers.ChangeNotifier()
+        notifier.subscribe({'pipelines': [1]})
+
+        for text_data in ['{not json', '{"pipelines": 5}', '{"pipelines": [2], "jobs": ["x"]}']:
+            async_to_sync(notifier.receive)(text_data)
+
+        self.assertEqual(notifier.pipeline_ids, {1})
+        self.assertEqual(notifier.job_ids, set())
+
+
+def create_jobs(pipeline: models.Pipeline, parents: dict[str, list[str]], **fields) -> dict[str, models.Job]:
+    """
+    Args:
+        parents: name -> names of its parents, for every job of the pipeline
+
+    Returns: name -> the job
+    """
+    job_models = {name: models.Job.objects.create(name=name, pipeline=pipeline, image='img', **fields)
+                  for name in parents}
+
+    for name, parent_names in parents.items():
+        job_models[name].parents.add(*[job_models[parent_name] for parent_name in parent_names])
+
+    return job_models
+
+
+class PipelineGraphTest(TestCase):
+    pipeline: models.Pipeline
+    job_models: dict[str, models.Job]
+
+    def setUp(self):
+        self.pipeline = models.Pipeline.objects.create(name='p')
+        # a -> b -> c, and d on its own
+        self.job_models = create_jobs(self.pipeline, {'a': [], 'b': ['a'], 'c': ['b'], 'd': []})
+
+    def ids(self, *names: str) -> set[int]:
+        return {self.job_models[name].pk for name in names}
+
+    def change(self, graph: graphs.PipelineGraph, name: str, status: models.JobStatus, exit_code: int = None):
+        job_model = self.job_models[name]
+        job_model.status = status
+        job_model.exit_code = exit_code
+        graph.job_changed(job_model)
+
+    def test_build(self):
+        # the jobs, the edges and the history for the priorities
+        with self.assertNumQueries(3):
+            graph = graphs.PipelineGraph.build(self.pipeline)
+
+        self.assertEqual(set(graph.nodes), self.ids('a', 'b', 'c', 'd'))
+        self.assertEqual(graph.ready, self.ids('a', 'd'))
+        self.assertIsNone(graphs.PipelineGraph.build(models.Pipeline.objects.create(name='empty')))
+
+    def test_children_are_released_right_away(self):
+        graph = graphs.PipelineGraph.build(self.pipeline)
+        self.change(graph, 'a', models.JobStatus.RUNNING)
+        self.assertEqual((graph.ready, graph.running), (self.ids('d'), self.ids('a')))
+
+        self.change(graph, 'a', models.JobStatus.FINISHED, 0)
+        self.assertEqual((graph.ready, graph.running), (self.ids('b', 'd'), set()))
+        self.assertEqual(graph.active_ids(), self.ids('b', 'd'))
+
+    def test_failure_dooms_the_descendants(self):
+        graph = graphs.PipelineGraph.build(self.pipeline)
+        self.change(graph, 'a', models.JobStatus.FINISHED, 1)
+        self.assertEqual((graph.ready, graph.doomed), (self.ids('d'), self.ids('b')))
+
+        # that's what the scheduler does with the doomed ones
+        self.change(graph, 'b', models.JobStatus.DEPENDENCY_FAILED)
+        self.assertEqual(graph.doomed, self.ids('c'))
+
+    def test_final_status(self):
+        def final_status(statuses: dict[str, tuple[models.JobStatus, Optional[int]]]) -> models.PipelineStatus:
+            graph = graphs.PipelineGraph.build(self.pipeline)
+
+            for name, (status, exit_code) in statuses.items():
+                self.change(graph, name, status, exit_code)
+
+            self.assertTrue(graph.is_complete())
+            return graph.final_status()
+
+        finished = (models.JobStatus.FINISHED, 0)
+        failed = (models.JobStatus.FINISHED, 1)
+        dependency_failed = (models.JobStatus.DEPENDENCY_FAILED, None)
+        cancelled = (models.JobStatus.CANCELLED, None)
+
+        self.assertEqual(final_status({'a': finished, 'b': finished, 'c': finished, 'd': finished}),
+                         models.PipelineStatus.FINISHED)
+        self.assertEqual(final_status({'a': failed, 'b': dependency_failed, 'c': dependency_failed, 'd': finished}),
+                         models.PipelineStatus.FAILED)
+        self.assertEqual(final_status({'a': cancelled, 'b': dependency_failed, 'c': dependency_failed, 'd': finished}),
+                         models.PipelineStatus.CANCELLED)
+
+
+class PrioritiesTest(TestCase):
+    def test_critical_path_first(self):
+        # what the jobs took before, see expected_durations
+        history = models.Pipeline.objects.create(name='history')
+
+        for name, uptime_secs in [('setup', 1.0), ('build', 100.0), ('lint', 10.0)]:
+            models.Job.objects.create(name=name, pipeline=history, image='img', status=models.JobStatus.FINISHED,
+                                      exit_code=0, uptime_secs=uptime_secs)
+
+        pipeline = models.Pipeline.objects.create(name='p')
+        # the setup is quick on its own, but the long build waits for it
+        job_models = create_jobs(pipeline, {'lint': [], 'setup': [], 'build': ['setup']})
+        graph = graphs.PipelineGraph.build(pipeline)
+
+        self.assertEqual([graph.nodes[job_model.pk].priority for job_model in job_models.values()], [10.0, 101.0, 100.0])
+        self.assertEqual(graph.by_priority(graph.ready), [job_models['setup'].pk, job_models['lint'].pk])
+
+        # the running ones still go first
+        job_models['lint'].status = models.JobStatus.RUNNING
+        graph.job_changed(job_models['lint'])
+        self.assertEqual(graph.by_priority(graph.ready | graph.running), [job_models['lint'].pk,
+                                                                          job_models['setup'].pk])
+
+
+class ApiTestCase(TestCase):
+    """
+    Signed in, with the versions in a FakeRedis
+    """
+    redis_client: FakeRedis
+    client: APIClient
+
+    def setUp(self):
+        self.redis_client = FakeRedis()
+        patcher = mock.patch.object(views, 'redis_client', self.redis_client)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create(username='someone'))
+
+
+class VersionedViewTest(ApiTestCase):
+    def test_etags(self):
+        pipeline = models.Pipeline.objects.create(name='p')
+        url = f'/fastci/api/pipeline/{pipeline.pk}/'
+        response = self.client.get(url)
+        etag = response['ETag']
+        self.assertEqual(response.status_code, 200)
+
+        # not even the database is asked
+        with self.assertNumQueries(0):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual((response.status_code, response['ETag']), (304, etag))
+
+        versions.bump_changed(self.redis_client, {pipeline.pk}, set(), set())
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(response.json()['name'], 'p')
+
+
+class PaginationTest(ApiTestCase):
+    def test_pages_stay_stable(self):
+        pipeline_ids = [models.Pipeline.objects.create(name=f'p{i}').pk for i in range(45)]
+        url = '/fastci/api/pipeline_list/'
+        seen_ids = []
+
+        while url is not None:
+            page = self.client.get(url).json()
+            seen_ids += [pipeline['id'] for pipeline in page['results']]
+            url = page['next']
+            # the new ones go to the front, and don't shift the pages after the cursor
+            models.Pipeline.objects.create(name='new')
+
+        self.assertEqual(seen_ids, sorted(pipeline_ids, reverse=True))
+
+
+@override_settings(FASTCI_LEASE_TTL_SECS=0.1, FASTCI_LEASE_RETRY_SECS=0.01)
+class RunOnPipelinesTest(TestCase):
+    def test_results_per_pipeline(self):
+        valid = models.Pipeline.objects.create(name='valid', status=models.PipelineStatus.RUNNING)
+        finished = models.Pipeline.objects.create(name='finished', status=models.PipelineStatus.FINISHED)
+        busy = models.Pipeline.objects.create(name='busy', status=models.PipelineStatus.RUNNING, lease_owner='other',
+                                              lease_expires_secs=time.time() + 60)
+        missing_id = busy.pk + 1
+
+        with mock.patch.object(tasks, 'notify_of_change'):
+            results = tasks.cancel_pipelines([missing_id, busy.pk, valid.pk, finished.pk])
+
+        self.assertEqual(results, [{'pipeline_id': missing_id, 'error': 'No such pipeline'},
+                                   {'pipeline_id': busy.pk, 'error': 'Busy, try again later'},
+                                   {'pipeline_id': valid.pk, 'error': None},
+                                   {'pipeline_id': finished.pk, 'error': 'Already finished'}])
+        self.assertEqual({pipeline.name: pipeline.status for pipeline in models.Pipeline.objects.all()},
+                         {'valid': models.PipelineStatus.CANCELLED, 'finished': models.PipelineStatus.FINISHED,
+                          'busy': models.PipelineStatus.RUNNING})
+        # the leases are released, except for the one that was never ours
+        self.assertEqual(models.Pipeline.objects.filter(lease_expires_secs__gt=time.time()).get(), busy)
+
+
+class BatchViewsTest(ApiTestCase):
+    def test_validates_the_ids(self):
+        with mock.patch.object(tasks.cancel_pipelines, 'delay', return_value=mock.MagicMock(id='task')) as delay:
+            for data in [{}, {'pipeline_ids': []}, {'pipeline_ids': [1, 'x']}, {'pipeline_ids': [True]}]:
+                self.assertEqual(self.client.post('/fastci/api/cancel_pipelines/', data, format='json').status_code,
+                                 400)
+
+            response = self.client.post('/fastci/api/cancel_pipelines/', {'pipeline_ids': [1, 2]}, format='json')
+
+        self.assertEqual((response.status_code, response.json()), (202, {'task_id': 'task'}))
+        delay.assert_called_once_with([1, 2])
@@ -12,10 +12,15 @@ router.register('create_user', views.CreateUserViewSet)
 
 urlpatterns = [
     path('api/', include(router.urls)),
+    path('api/job_log/<int:job_id>/', views.job_log_view),
     path('api/update_job/<int:job_id>/', views.update_job_view),
     path('api/cancel_job/<int:job_id>/', views.cancel_job_view),
     path('api/update_pipeline/<int:pipeline_id>/', views.update_pipeline_view),
     path('api/cancel_pipeline/<int:pipeline_id>/', views.cancel_pipeline_view),
     path('api/create_pipeline/', views.create_pipeline_view),
-    path('api/current_user/', views.current_user_view)
+    path('api/create_pipelines/', views.create_pipelines_view),
+    path('api/cancel_pipelines/', views.cancel_pipelines_view),
+    path('api/clean_up_pipelines/', views.clean_up_pipelines_view),
+    path('api/current_user/', views.current_user_view),
+    path('api/task/<str:task_id>/', views.task_view)
 ]
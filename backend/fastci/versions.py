@@ -0,0 +1,76 @@
+import secrets
+
+import redis
+
+from . import models
+
+# Every pipeline and job (and each of the lists) has a version in redis that is bumped whenever it changes, right
+# before the change is published, see tasks.notify_of_change. So the views can tell the client that what it already has
+# is still fine by looking only at the versions, see views.VersionedMixin
+#
+# The epoch is there in case redis forgets the versions (it's restarted without persistence), so they start from zero
+# again and the old ETags must not match the new ones
+#
+# WARN: Only the real changes bump the versions (see events), so the uptime of the running jobs is as of the last one
+
+KEY_PREFIX = 'fastci.version.'
+EPOCH_KEY = KEY_PREFIX + 'epoch'
+JOB_LIST = 'job_list'
+PIPELINE_LIST = 'pipeline_list'
+
+
+def pipeline_name(pipeline_id: int) -> str:
+    return f'pipeline.{pipeline_id}'
+
+
+def job_name(job_id: int) -> str:
+    return f'job.{job_id}'
+
+
+def bump_changed(redis_client: redis.Redis, pipeline_ids: set[int], job_ids: set[int],
+                 status_changed_pipeline_ids: set[int]):
+    """
+    Takes 1 query if the status of some pipeline has changed, since the jobs show the status of their pipeline
+
+    Args:
+        pipeline_ids: the pipelines that have changed themselves or whose jobs have
+        status_changed_pipeline_ids: the ones whose status has changed
+    """
+    if status_changed_pipeline_ids:
+        job_ids = job_ids | set(models.Job.objects.filter(pipeline_id__in=list(status_changed_pipeline_ids))
+                                .values_list('pk', flat=True))
+
+    names = [pipeline_name(pipeline_id) for pipeline_id in pipeline_ids] + [job_name(job_id) for job_id in job_ids]
+
+    if pipeline_ids:
+        # the summaries in the list have changed too
+        names.append(PIPELINE_LIST)
+
+    if job_ids:
+        names.append(JOB_LIST)
+
+    if not names:
+        return
+
+    with redis_client.pipeline(transaction=False) as redis_pipeline:
+        for name in names:
+            redis_pipeline.incr(KEY_PREFIX + name)
+
+        redis_pipeline.execute()
+
+
+def make_etag(redis_client: redis.Redis, names: list[str]) -> str:
+    """
+    Takes 1 round trip to redis (2 the very first time)
+
+    Raises: redis.RedisError
+
+    Returns: the ETag of whatever is made of the things with these names, as it is right now
+    """
+    epoch, *values = redis_client.mget([EPOCH_KEY] + [KEY_PREFIX + name for name in names])
+
+    if epoch is None:
+        redis_client.set(EPOCH_KEY, secrets.token_hex(8), nx=True)
+        epoch = redis_client.get(EPOCH_KEY)
+
+    return '"{}"'.format('.'.join([epoch.decode('ascii')] + [(value or b'0').decode('ascii') for value in values]))
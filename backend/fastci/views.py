@@ -1,49 +1,210 @@
 import json
+import logging
+from typing import Callable, Optional
 
+import redis
 from django.contrib.auth.models import User
-from django.db import transaction
-from rest_framework import viewsets, mixins
+from django.shortcuts import get_object_or_404
+from django.utils.http import parse_etags
+from rest_framework import viewsets, mixins, status
 from rest_framework.decorators import api_view, permission_classes, parser_classes
-from rest_framework.pagination import PageNumberPagination
+from rest_framework.exceptions import ValidationError
+from rest_framework.pagination import CursorPagination
 from rest_framework.parsers import JSONParser
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.request import Request
 from rest_framework.response import Response
 
+from . import logs
+from . import reports
 from . import tasks
-from .models import Job, ListingJobSerializer, CompleteJobSerializer, Pipeline, CompletePipelineSerializer, \
-    UserSerializer
+from . import versions
+from .models import Job, ListingJobSerializer, CompleteJobSerializer, Pipeline, ListingPipelineSerializer, \
+    CompletePipelineSerializer, UserSerializer
 
+logger = logging.getLogger('fastci')
 
-class BasicPageNumberPagination(PageNumberPagination):
-    # @CopyPaste - keep in sync with frontend
+# the scheduler has its own, see tasks.init_clients
+redis_client: Optional[redis.Redis]
+redis_client = None
+
+
+def get_redis_client() -> redis.Redis:
+    global redis_client
+
+    if redis_client is None:
+        redis_client = redis.Redis()  # default settings are fine
+
+    return redis_client
+
+
+class BasicCursorPagination(CursorPagination):
+    """
+    Pages by pk, so there's neither a COUNT(*) nor an OFFSET, and a deep page costs the same as the first one. Only the
+    links to the next and the previous pages are given, no page numbers
+    """
     page_size = 20
+    ordering = '-pk'
+
+
+class VersionedMixin:
+    """
+    Gives the responses ETags made of the versions of what they show, and answers If-None-Match with 304 by looking only
+    at the versions, see versions. Without touching the database or serializing anything
+    """
+
+    def get_version_names(self) -> Optional[list[str]]:
+        """
+        Returns: None if it can't be versioned, which is the default
+        """
+        return None
+
+    def respond_versioned(self, request: Request, respond: Callable[[], Response]) -> Response:
+        names = self.get_version_names()
+        etag = None
+
+        try:
+            # WARN: It must be read before the database, so if anything changes in between, the next request gets it
+            etag = versions.make_etag(get_redis_client(), names) if names is not None else None
+        except redis.RedisError as e:
+            # it's just slower without them
+            logger.warning(f'Could not read the versions: {e}')
+
+        if etag is not None and etag in parse_etags(request.headers.get('If-None-Match', '')):
+            response = Response(status=status.HTTP_304_NOT_MODIFIED)
+        else:
+            response = respond()
+
+        if etag is not None and response.status_code in (status.HTTP_200_OK, status.HTTP_304_NOT_MODIFIED):
+            response['ETag'] = etag
+            # so the browser asks every time, but with If-None-Match
+            response['Cache-Control'] = 'private, no-cache'
+
+        return response
+
+
+class VersionedListMixin(VersionedMixin, mixins.ListModelMixin):
+    # the name of the version of the whole list, see versions
+    list_version_name: str
 
+    def get_version_names(self) -> Optional[list[str]]:
+        # every page has the same version
+        return [self.list_version_name]
 
-class ListJobViewSet(viewsets.GenericViewSet, mixins.ListModelMixin):
+    def list(self, request, *args, **kwargs):
+        return self.respond_versioned(request, lambda: super(VersionedListMixin, self).list(request, *args, **kwargs))
+
+
+class VersionedRetrieveMixin(VersionedMixin, mixins.RetrieveModelMixin):
+    # pk -> the name of its version, see versions
+    make_version_name: Callable[[int], str]
+
+    def get_version_names(self) -> Optional[list[str]]:
+        pk = self.kwargs['pk']
+        # it's a 404 anyway
+        return [self.make_version_name(int(pk))] if pk.isdigit() else None
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.respond_versioned(request,
+                                      lambda: super(VersionedRetrieveMixin, self).retrieve(request, *args, **kwargs))
+
+
+class ListJobViewSet(viewsets.GenericViewSet, VersionedListMixin):
     queryset = Job.objects.all()
     serializer_class = ListingJobSerializer
     permission_classes = [IsAuthenticated]
-    pagination_class = BasicPageNumberPagination
+    pagination_class = BasicCursorPagination
+    list_version_name = versions.JOB_LIST
 
 
-class RetrieveJobViewSet(viewsets.GenericViewSet, mixins.RetrieveModelMixin):
+class RetrieveJobViewSet(viewsets.GenericViewSet, VersionedRetrieveMixin):
     queryset = Job.objects.all()
     serializer_class = CompleteJobSerializer
     permission_classes = [IsAuthenticated]
+    make_version_name = staticmethod(versions.job_name)
+
+
+def get_pipeline_ids(request: Request) -> list[int]:
+    pipeline_ids = request.data.get('pipeline_ids') if isinstance(request.data, dict) else None
+
+    if not isinstance(pipeline_ids, list) or len(pipeline_ids) == 0 or \
+            not all(isinstance(pipeline_id, int) and not isinstance(pipeline_id, bool) for pipeline_id in pipeline_ids):
+        raise ValidationError({'pipeline_ids': 'Must be a non-empty list of int'})
+
+    return pipeline_ids
+
+
+def get_int_query_param(request: Request, name: str, default: int = None) -> int:
+    value = request.query_params.get(name)
+
+    if value is None:
+        if default is None:
+            raise ValidationError({name: 'Field required'})
+
+        return default
+
+    try:
+        value = int(value)
+    except ValueError:
+        raise ValidationError({name: 'Must be an integer'})
 
+    if value < 0:
+        raise ValidationError({name: 'Must be non-negative'})
 
-class ListPipelineViewSet(viewsets.GenericViewSet, mixins.ListModelMixin):
+    return value
+
+
+@api_view()
+@permission_classes([IsAuthenticated])
+def job_log_view(request: Request, job_id: int) -> Response:
+    """
+    Returns a piece of the output of a job. Query params:
+        stream - 'all' (default), 'stdout' or 'stderr'
+        tail=N[&end=E] - the last N lines before the byte offset E (by default - before the end of the log)
+        head=N[&offset=O] - the first N lines after the byte offset O (by default - from the start of the log)
+        offset=O&length=L - L bytes after the byte offset O, cut at the last complete line
+
+    Everything is limited to logs.MAX_READ_SIZE bytes, look at `start` and `end` in the response to see what you've got
+    """
+    get_object_or_404(Job, pk=job_id)
+    stream = request.query_params.get('stream', 'all')
+
+    if stream not in logs.STREAMS:
+        raise ValidationError({'stream': f'Must be one of {", ".join(logs.STREAMS)}'})
+
+    store = logs.JobLogStore(job_id)
+
+    if 'tail' in request.query_params:
+        end = request.query_params.get('end')
+        start, end = store.tail(stream, get_int_query_param(request, 'tail'),
+                                None if end is None else get_int_query_param(request, 'end'))
+    elif 'head' in request.query_params:
+        start, end = store.head(stream, get_int_query_param(request, 'head'), get_int_query_param(request, 'offset', 0))
+    else:
+        start, end = store.read_range(stream, get_int_query_param(request, 'offset'),
+                                      get_int_query_param(request, 'length', logs.MAX_READ_SIZE))
+
+    return Response({
+        'start': start,
+        'end': end,
+        'size': store.size(stream),
+        'data': store.read(stream, start, end).decode('utf-8', errors='replace')
+    })
+
+
+class ListPipelineViewSet(viewsets.GenericViewSet, VersionedListMixin):
     queryset = Pipeline.objects.all()
-    serializer_class = CompletePipelineSerializer
+    serializer_class = ListingPipelineSerializer
     permission_classes = [IsAuthenticated]
-    pagination_class = BasicPageNumberPagination
+    pagination_class = BasicCursorPagination
+    list_version_name = versions.PIPELINE_LIST
 
 
-class RetrievePipelineViewSet(viewsets.GenericViewSet, mixins.RetrieveModelMixin):
+class RetrievePipelineViewSet(viewsets.GenericViewSet, VersionedRetrieveMixin):
     queryset = Pipeline.objects.all()
     serializer_class = CompletePipelineSerializer
     permission_classes = [IsAuthenticated]
+    make_version_name = staticmethod(versions.pipeline_name)
 
 
 class CreateUserViewSet(viewsets.GenericViewSet, mixins.CreateModelMixin):
@@ -57,12 +218,14 @@ class CreateUserViewSet(viewsets.GenericViewSet, mixins.CreateModelMixin):
 
 
 # NOTE: Order matters!
+#
+# The actions don't wait for their tasks, they give back the id of the task right away (202). How it went comes with the
+# changes (see events.task_finished), or from task_view
 @api_view()
 @permission_classes([IsAuthenticated])
-@transaction.atomic
 def update_job_view(request: Request, job_id: int) -> Response:
-    tasks.update_job.delay(job_id).get()
-    return Response()
+    task = tasks.update_job.delay(job_id)
+    return Response({'task_id': task.id, 'job_id': job_id}, status=status.HTTP_202_ACCEPTED)
 
 
 @api_view()
@@ -74,27 +237,65 @@ def current_user_view(request: Request) -> Response:
 @api_view()
 @permission_classes([IsAuthenticated])
 def cancel_job_view(request: Request, job_id: int) -> Response:
-    tasks.cancel_job.delay(job_id).get()
-    return Response()
+    task = tasks.cancel_job.delay(job_id)
+    return Response({'task_id': task.id, 'job_id': job_id}, status=status.HTTP_202_ACCEPTED)
 
 
 @api_view()
 @permission_classes([IsAuthenticated])
 def cancel_pipeline_view(request: Request, pipeline_id: int) -> Response:
-    tasks.cancel_pipeline.delay(pipeline_id).get()
-    return Response()
+    task = tasks.cancel_pipeline.delay(pipeline_id)
+    return Response({'task_id': task.id, 'pipeline_id': pipeline_id}, status=status.HTTP_202_ACCEPTED)
 
 
 @api_view()
 @permission_classes([IsAuthenticated])
 def update_pipeline_view(request: Request, pipeline_id: int) -> Response:
-    tasks.step_pipeline.delay(pipeline_id).get()
-    return Response()
+    task = tasks.update_pipeline.delay(pipeline_id)
+    return Response({'task_id': task.id, 'pipeline_id': pipeline_id}, status=status.HTTP_202_ACCEPTED)
 
 
 @api_view(['POST'])
 @parser_classes([JSONParser])
 @permission_classes([IsAuthenticated])
 def create_pipeline_view(request: Request) -> Response:
-    tasks.create_pipeline_from_json.delay(json.dumps(request.data)).get()
-    return Response()
+    # The bad ones are turned away right here, the rest (the images, the placement) is found out by the task
+    tasks.validate_pipeline_data(request.data)
+    task = tasks.create_pipeline_from_json.delay(json.dumps(request.data))
+    # the pipeline id is the result of the task
+    return Response({'task_id': task.id}, status=status.HTTP_202_ACCEPTED)
+
+
+# The batch versions of the actions, their tasks give back the outcome of each item, see tasks.run_on_pipelines
+@api_view(['POST'])
+@parser_classes([JSONParser])
+@permission_classes([IsAuthenticated])
+def create_pipelines_view(request: Request) -> Response:
+    tasks.validate_pipelines_data(request.data)
+    task = tasks.create_pipelines.delay([json.dumps(pipeline_data) for pipeline_data in request.data])
+    return Response({'task_id': task.id}, status=status.HTTP_202_ACCEPTED)
+
+
+@api_view(['POST'])
+@parser_classes([JSONParser])
+@permission_classes([IsAuthenticated])
+def cancel_pipelines_view(request: Request) -> Response:
+    task = tasks.cancel_pipelines.delay(get_pipeline_ids(request))
+    return Response({'task_id': task.id}, status=status.HTTP_202_ACCEPTED)
+
+
+@api_view(['POST'])
+@parser_classes([JSONParser])
+@permission_classes([IsAuthenticated])
+def clean_up_pipelines_view(request: Request) -> Response:
+    task = tasks.clean_up_pipelines.delay(get_pipeline_ids(request))
+    return Response({'task_id': task.id}, status=status.HTTP_202_ACCEPTED)
+
+
+@api_view()
+@permission_classes([IsAuthenticated])
+def task_view(request: Request, task_id: str) -> Response:
+    """
+    How the task enqueued by one of the actions went, see reports
+    """
+    return Response(reports.load(get_redis_client(), task_id))
@@ -0,0 +1,234 @@
+import json
+import logging
+import os
+import shlex
+import shutil
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Optional
+
+import docker.errors
+import docker.models.containers
+
+logger = logging.getLogger('fastci')
+
+# Idle containers are labelled with their image
+POOL_LABEL = 'fastci.pool'
+# @CopyPaste - keep in sync with pool_bootstrap.py
+SLOT_MOUNT = '/fastci/slot'
+START_FIFO_NAME = 'start'
+ARGV_FILE_NAME = 'argv.json'
+
+
+class PooledContainer:
+    __slots__ = ('container', 'image', 'slot_dir', 'created_at')
+
+    container: docker.models.containers.Container
+    image: str
+    # the directory on the host that is mounted into SLOT_MOUNT, that's how we talk to the container
+    slot_dir: Path
+    created_at: float
+
+    def __init__(self, container: docker.models.containers.Container, image: str, slot_dir: Path):
+        self.container = container
+        self.image = image
+        self.slot_dir = slot_dir
+        self.created_at = time.time()
+
+
+def start_claimed(slot_dir: Path):
+    """
+    Lets the container of a claimed slot run its command
+
+    Raises: OSError if the container isn't waiting anymore (i.e. it has died)
+    """
+    # Non-blocking, so if there's nobody on the other side we fail instead of hanging forever
+    fd = os.open(slot_dir / START_FIFO_NAME, os.O_WRONLY | os.O_NONBLOCK)
+    os.close(fd)
+
+
+def remove_slot(slot_dir: Path):
+    shutil.rmtree(slot_dir, ignore_errors=True)
+
+
+class WarmPool:
+    """
+    Keeps some already started containers for the recently used images, so the jobs don't have to wait for the docker
+    to create and start one. The containers just sit in pool_bootstrap.py until they are claimed and started.
+
+    Only the jobs that don't need any volumes can use the pool, since the volumes can't be changed after the container
+    is created. The same goes for the images with an entrypoint - the bootstrap script would be passed to it.
+
+    The idle containers live only in the memory of the process, so each worker process has its own pool (of the full
+    size), and only ever claims its own containers.
+
+    Thread-safe
+    """
+    client: docker.DockerClient
+    internal_dir: Path
+    root: Path
+    size: int
+    size_per_image: int
+    idle_ttl_secs: float
+    # put on every container on top of POOL_LABEL
+    labels: dict[str, str]
+    idle: dict[str, list[PooledContainer]]
+    # image -> when it was last asked for, used to pick the images to keep around and the ones to evict first
+    last_used: dict[str, float]
+    # images that can't be used with the pool
+    unpoolable: set[str]
+    lock: threading.Lock
+
+    def __init__(self, client: docker.DockerClient, internal_dir: Path, root: Path, size: int, size_per_image: int,
+                 idle_ttl_secs: float, labels: dict[str, str]):
+        self.client = client
+        self.internal_dir = internal_dir
+        self.root = root
+        self.size = size
+        self.size_per_image = size_per_image
+        self.idle_ttl_secs = idle_ttl_secs
+        self.labels = labels
+        self.idle = dict()
+        self.last_used = dict()
+        self.unpoolable = set()
+        self.lock = threading.Lock()
+
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def claim(self, image: str, command: str) -> Optional[PooledContainer]:
+        """
+        Takes an idle container for the image and sets it up to run the command once started (see start_claimed)
+
+        Returns: None if there are no idle containers for the image
+        """
+        with self.lock:
+            self.last_used[image] = time.time()
+            idle = self.idle.get(image)
+            pooled = idle.pop() if idle else None
+
+        if pooled is not None:
+            # docker would have split it the same way
+            with open(pooled.slot_dir / ARGV_FILE_NAME, 'w') as f:
+                json.dump(shlex.split(command), f)
+
+        return pooled
+
+    def idle_count(self) -> int:
+        return sum(len(idle) for idle in self.idle.values())
+
+    def _is_poolable(self, image: str) -> bool:
+        if image in self.unpoolable:
+            return False
+
+        try:
+            entrypoint = self.client.images.get(image).attrs['Config']['Entrypoint']
+        except docker.errors.ImageNotFound:
+            return False
+
+        if entrypoint:
+            self.unpoolable.add(image)
+            return False
+
+        return True
+
+    def _create(self, image: str) -> PooledContainer:
+        slot_dir = Path(tempfile.mkdtemp(dir=self.root))
+        os.mkfifo(slot_dir / START_FIFO_NAME)
+
+        try:
+            container = self.client.containers.create(image, '/fastci/internal/pool_bootstrap.py', detach=True,
+                                                      volumes=[f'{self.internal_dir}:/fastci/internal:ro',
+                                                               f'{slot_dir}:{SLOT_MOUNT}'],
+                                                      labels={**self.labels, POOL_LABEL: image})
+            container.start()
+        except docker.errors.APIError:
+            remove_slot(slot_dir)
+            raise
+
+        return PooledContainer(container, image, slot_dir)
+
+    def _remove(self, pooled: PooledContainer):
+        try:
+            pooled.container.remove(force=True)
+        except docker.errors.NotFound:
+            pass
+
+        remove_slot(pooled.slot_dir)
+
+    def maintain(self):
+        """
+        Throws out the expired and dead containers, evicts the least recently used images if we're over the size, and
+        tops up the recently used ones. Meant to be called periodically
+        """
+        now = time.time()
+        alive_ids = {container.id for container in
+                     self.client.containers.list(sparse=True, filters={'label': POOL_LABEL, 'status': 'running'})}
+        to_remove = []
+
+        with self.lock:
+            for image, idle in self.idle.items():
+                dead = [pooled for pooled in idle if pooled.container.id not in alive_ids]
+
+                if dead:
+                    # most likely there's no python in there
+                    logger.warning(f'Pooled containers of {image} died, not pooling it anymore')
+                    self.unpoolable.add(image)
+
+                to_remove += dead
+                to_remove += [pooled for pooled in idle if now - pooled.created_at > self.idle_ttl_secs]
+                self.idle[image] = [pooled for pooled in idle if pooled not in to_remove]
+
+            # least recently used first
+            images = sorted(self.idle, key=lambda image: self.last_used.get(image, 0))
+
+            for image in images:
+                while self.idle_count() > self.size and self.idle[image]:
+                    to_remove.append(self.idle[image].pop())
+
+            # most recently used first
+            to_create = []
+            budget = self.size - self.idle_count()
+
+            for image, last_used in sorted(self.last_used.items(), key=lambda item: item[1], reverse=True):
+                if now - last_used > self.idle_ttl_secs:
+                    break
+
+                missing = min(budget, self.size_per_image - len(self.idle.get(image, [])))
+
+                if missing > 0:
+                    to_create += [image] * missing
+                    budget -= missing
+
+            for image in list(self.last_used):
+                if now - self.last_used[image] > self.idle_ttl_secs:
+                    del self.last_used[image]
+
+        for pooled in to_remove:
+            self._remove(pooled)
+
+        for image in to_create:
+            if not self._is_poolable(image):
+                continue
+
+            try:
+                pooled = self._create(image)
+            except docker.errors.APIError as e:
+                logger.error(e)
+                continue
+
+            with self.lock:
+                self.idle.setdefault(image, []).append(pooled)
+
+    def remove_leftovers(self, claimed_container_ids: set[str]):
+        """
+        Removes the idle containers that were left over by the previous run, i.e. after a restart
+        """
+        for container in self.client.containers.list(all=True, sparse=True, filters={'label': POOL_LABEL}):
+            if container.id not in claimed_container_ids:
+                container.remove(force=True)
+
+        for slot_dir in self.root.iterdir():
+            if not (slot_dir / ARGV_FILE_NAME).exists():
+                remove_slot(slot_dir)
@@ -1,33 +1,381 @@
-import aioredis
 import asyncio
+import json
+import logging
+import threading
+from typing import Callable, Optional, Union
+from urllib.parse import parse_qs
+
+import docker
+import docker.errors
+import docker.types.daemon
+import redis
+import redis.asyncio
+import requests
+from channels.db import database_sync_to_async
 from channels.generic.websocket import AsyncWebsocketConsumer
+from django.contrib.auth.models import User
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken
+
+from . import jobs
+from . import logs
+from . import models
+from . import runners
+
+logger = logging.getLogger('fastci')
+
+# @CopyPaste - keep in sync with fastci.events.CHANNEL
+CHANNEL = 'pipeline-job-state-change'
+# In case we've missed the change of the job's status, see JobLogTail
+LOG_TAIL_RECHECK_SECS = 5
+
+
+def parse_ids(value, parse_id: Callable = int) -> Optional[set]:
+    """
+    Returns: None for 'all'
+    """
+    if value == 'all':
+        return None
+
+    return {parse_id(item_id) for item_id in value or []}
+
+
+@database_sync_to_async
+def authenticate(scope: dict) -> Optional[User]:
+    """
+    Same as the REST views (see REST_FRAMEWORK in the settings), but the access token comes in the token query param,
+    since the browsers can't set the headers of a websocket
+
+    Returns: None if there's no token, or it's not valid
+    """
+    token = parse_qs(scope['query_string'].decode('latin-1')).get('token', [None])[0]
+
+    if token is None:
+        return None
+
+    authentication = JWTAuthentication()
+
+    try:
+        return authentication.get_user(authentication.get_validated_token(token))
+    except (InvalidToken, AuthenticationFailed):
+        return None
+
+
+class ChangeHub:
+    """
+    The one redis subscription of this process, each change is pushed to all of the connected consumers. So the number
+    of redis connections doesn't grow with the number of open tabs. It's there only while someone is connected
+    """
+    consumers: set[Union['ChangeNotifier', 'JobLogTail']]
+    listener: Optional[asyncio.Task]
+
+    def __init__(self):
+        self.consumers = set()
+        self.listener = None
+
+    def add(self, consumer: Union['ChangeNotifier', 'JobLogTail']):
+        self.consumers.add(consumer)
+
+        if self.listener is None or self.listener.done():
+            self.listener = asyncio.create_task(self.listen())
+
+    def remove(self, consumer: Union['ChangeNotifier', 'JobLogTail']):
+        self.consumers.discard(consumer)
+
+        if not self.consumers and self.listener is not None:
+            self.listener.cancel()
+            self.listener = None
+
+    async def listen(self):
+        while True:
+            redis_client = redis.asyncio.Redis()  # default settings are fine
+            pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+
+            try:
+                await pubsub.subscribe(CHANNEL)
+
+                async for message in pubsub.listen():
+                    try:
+                        change = json.loads(message['data'])
+                    except ValueError as e:
+                        # not from fastci.events, the rest of the channel is still fine
+                        logger.warning(f'Ignoring a malformed change: {e}')
+                        continue
+
+                    # so one slow or broken consumer doesn't hold up the rest
+                    await asyncio.gather(*[consumer.push(change) for consumer in list(self.consumers)],
+                                         return_exceptions=True)
+            except (redis.RedisError, OSError) as e:
+                # the changes in between are lost, but that's fine - the clients fetch everything when they reconnect
+                logger.exception(e)
+                await asyncio.sleep(1)
+            finally:
+                await pubsub.aclose()
+                await redis_client.aclose()
+
+
+hub = ChangeHub()
 
 
 class ChangeNotifier(AsyncWebsocketConsumer):
-    redis_client: aioredis.Redis
-    pubsub_channel: aioredis.Channel
+    """
+    Pushes the changes (see fastci.events) the client is subscribed to. Needs the JWT access token in the token query
+    param, see authenticate. The client may send its subscription at any time:
+        {"pipelines": [<ids>] or "all", "jobs": [<ids>] or "all", "tasks": [<ids>] or "all"}
+    The jobs of the subscribed pipelines are included too, and so are the ids of the ones that are gone
+    ("deleted_pipelines"). Before that it gets everything
+    """
+    # None == all of them
+    pipeline_ids: Optional[set[int]]
+    job_ids: Optional[set[int]]
+    # the ones enqueued by the actions, see reports
+    task_ids: Optional[set[str]]
 
     async def connect(self):
-        self.redis_client = await aioredis.create_redis(('localhost', 6379), db=0)  # these are the default settings
-        self.pubsub_channel = (await self.redis_client.subscribe('pipeline-job-state-change'))[0]
+        self.pipeline_ids = None
+        self.job_ids = None
+        self.task_ids = None
+
+        if await authenticate(self.scope) is None:
+            await self.close()
+            return
+
         await self.accept()
+        hub.add(self)
 
-    # This won't be called if receive hasn't finished...
     async def disconnect(self, code):
-        self.clean_up_redis()
+        hub.remove(self)
+
+    def subscribe(self, subscription: dict):
+        """
+        Raises: ValueError or TypeError if the subscription is malformed, and then it's not changed at all
+        """
+        if not isinstance(subscription, dict):
+            raise TypeError('The subscription must be an object')
+
+        pipeline_ids = parse_ids(subscription.get('pipelines'))
+        job_ids = parse_ids(subscription.get('jobs'))
+        task_ids = parse_ids(subscription.get('tasks'), str)
+        self.pipeline_ids, self.job_ids, self.task_ids = pipeline_ids, job_ids, task_ids
 
-    def clean_up_redis(self):
-        self.pubsub_channel.close()
-        self.redis_client.close()
+    def filter_change(self, change: dict) -> dict:
+        """
+        Returns: only the part of the change the client is subscribed to
+        """
+        def wants_pipeline(pipeline_id: int) -> bool:
+            return self.pipeline_ids is None or pipeline_id in self.pipeline_ids
+
+        return {
+            'pipelines': [pipeline for pipeline in change['pipelines'] if wants_pipeline(pipeline['id'])],
+            'jobs': [job for job in change['jobs'] if self.job_ids is None or job['id'] in self.job_ids
+                     or wants_pipeline(job['pipeline_id'])],
+            'tasks': [task for task in change.get('tasks', []) if self.task_ids is None or task['id'] in self.task_ids],
+            'deleted_pipelines': [pipeline_id for pipeline_id in change.get('deleted_pipelines', [])
+                                  if wants_pipeline(pipeline_id)]
+        }
 
     async def receive(self, text_data=None, bytes_data=None):
+        # FYI: the old clients send 'go?' before each change, it's not needed anymore
+        if text_data and text_data.startswith('{'):
+            try:
+                self.subscribe(json.loads(text_data))
+            except (ValueError, TypeError) as e:
+                # it keeps the subscription it had
+                logger.info(f'Ignoring a malformed subscription: {e}')
+
+    async def push(self, change: dict):
+        change = self.filter_change(change)
+
+        if change['pipelines'] or change['jobs'] or change['tasks'] or change['deleted_pipelines']:
+            await self.send(json.dumps(change))
+
+
+def follow_log(runner: str, container_id: str, stream: str, cursor: str, put: Callable[[Optional[bytes]], None],
+               followed: list[docker.types.daemon.CancellableStream], stopping: threading.Event):
+    """
+    Runs in its own thread, since the docker SDK blocks. Passes everything the container prints to the stream ('stdout'
+    or 'stderr') after the cursor to put as soon as it's printed, and then None once the container has stopped
+
+    Args:
+        followed: where the log stream is put, so it can be closed from the outside, see stopping
+    """
+    docker_client = None
+
+    try:
+        runner_infos = runners.alive(redis.Redis())  # default settings are fine
+
+        if runner not in runner_infos:
+            raise runners.RunnerGone(runner)
+
+        docker_client = runners.connect(runner_infos[runner])
+        log_stream = docker_client.containers.get(container_id).logs(
+            stdout=stream == 'stdout', stderr=stream == 'stderr', timestamps=True, stream=True, follow=True,
+            since=jobs.log_cursor_to_since(cursor))
+        followed.append(log_stream)
+
+        # in case it was closed before it was put there
+        if stopping.is_set():
+            log_stream.close()
+            return
+
+        # each piece is one entry of the log, so it's a complete line (or 16k of a long one)
+        for entry in log_stream:
+            for _, timestamp, line in jobs.parse_new_lines(entry, cursor):
+                cursor = timestamp
+                put(line)
+    except (runners.RunnerGone, docker.errors.DockerException, requests.exceptions.RequestException, redis.RedisError,
+            OSError) as e:
+        # the final status will tell what happened
+        if not stopping.is_set():
+            logger.warning(f'Stopped following the {stream} of container {container_id}: {e}')
+    finally:
+        if docker_client is not None:
+            docker_client.close()
+
+        put(None)
+
+
+class JobLogTail(AsyncWebsocketConsumer):
+    """
+    Streams the output of a job as it's printed and closes once the job is complete. Query params:
+        token - the JWT access token, see authenticate
+        stream - 'all' (default), 'stdout' or 'stderr'
+        offset - how much of the stored log the client already has, see views.job_log_view
+
+    Sends:
+        {"type": "stored", "start": ..., "end": ..., "data": ...} - the stored log after the offset, in pieces
+        {"type": "live", "data": ...} - what was printed after that, straight from the docker
+        {"type": "done", "status": ..., "exit_code": ...} - right before it closes
+
+    The live output is stored by the scheduler a bit later, and then it's sent as "stored" too, so the client should
+    drop the live output it has so far whenever "stored" comes. Once the job is complete everything is stored
+
+    NOTE: The jobs are followed on their runners, so the server must be able to talk to the docker of each of them
+    """
+    job_id: int
+    stream: str
+    # how much of the stored log the client has
+    stored_end: int
+    # set by the hub when the job has changed
+    job_changed: asyncio.Event
+    tail_task: Optional[asyncio.Task]
+    followed: list[docker.types.daemon.CancellableStream]
+    stopping: threading.Event
+
+    async def connect(self):
+        self.job_id = self.scope['url_route']['kwargs']['job_id']
+        query = parse_qs(self.scope['query_string'].decode('latin-1'))
+        self.stream = query.get('stream', ['all'])[0]
+        self.job_changed = asyncio.Event()
+        self.tail_task = None
+        self.followed = []
+        self.stopping = threading.Event()
+
         try:
-            await self.pubsub_channel.get()
-        except asyncio.CancelledError:
-            # If we get disconnected while waiting on the channel, then the `disconnect` method won't be called and
-            # the warning will be logged. So, whatever, clean up redis at least
-            # (but honestly, not sure, but maybe redis is cleaned up in any case)
-            self.clean_up_redis()
-            raise
-
-        await self.send('go')
+            self.stored_end = max(0, int(query.get('offset', ['0'])[0]))
+        except ValueError:
+            self.stored_end = -1
+
+        # the same as job_log_view requires
+        if self.stream not in logs.STREAMS or self.stored_end < 0 or await authenticate(self.scope) is None:
+            await self.close()
+            return
+
+        await self.accept()
+        hub.add(self)
+        self.tail_task = asyncio.create_task(self.tail())
+
+    async def disconnect(self, code):
+        hub.remove(self)
+        self.stopping.set()
+
+        for log_stream in self.followed:
+            log_stream.close()
+
+        if self.tail_task is not None:
+            self.tail_task.cancel()
+
+    async def push(self, change: dict):
+        if any(job['id'] == self.job_id for job in change['jobs']):
+            self.job_changed.set()
+
+    @database_sync_to_async
+    def get_job(self) -> Optional[models.Job]:
+        return models.Job.objects.filter(pk=self.job_id).first()
+
+    @database_sync_to_async
+    def read_stored(self) -> list[tuple[int, int, bytes]]:
+        """
+        Returns: (start, end, data) of every piece of the stored log after what the client already has
+        """
+        store = logs.JobLogStore(self.job_id)
+        size = store.size(self.stream)
+        pieces = []
+
+        while self.stored_end < size:
+            end = min(size, self.stored_end + logs.MAX_READ_SIZE)
+            pieces.append((self.stored_end, end, store.read(self.stream, self.stored_end, end)))
+            self.stored_end = end
+
+        return pieces
+
+    async def send_stored(self):
+        for start, end, data in await self.read_stored():
+            await self.send(json.dumps({'type': 'stored', 'start': start, 'end': end,
+                                        'data': data.decode('utf-8', errors='replace')}))
+
+    async def follow(self, job: models.Job):
+        """
+        Sends everything the job prints after what's stored, until its container stops
+        """
+        loop = asyncio.get_running_loop()
+        queue: asyncio.Queue[Optional[bytes]] = asyncio.Queue()
+        cursors = {'stdout': job.stdout_log_cursor, 'stderr': job.stderr_log_cursor}
+        streams = ('stdout', 'stderr') if self.stream == 'all' else (self.stream,)
+
+        def put(data: Optional[bytes]):
+            loop.call_soon_threadsafe(queue.put_nowait, data)
+
+        for stream in streams:
+            threading.Thread(target=follow_log, args=(job.runner, job.container_id, stream, cursors[stream], put,
+                                                      self.followed, self.stopping), daemon=True).start()
+
+        remaining = len(streams)
+
+        while remaining:
+            data = await queue.get()
+
+            if data is None:
+                remaining -= 1
+                continue
+
+            await self.send(json.dumps({'type': 'live', 'data': data.decode('utf-8', errors='replace')}))
+
+    async def tail(self):
+        followed = False
+
+        while True:
+            # The cursors go first, and then the stored log. So one step may end up both stored and live, but nothing
+            # is lost in between
+            job = await self.get_job()
+            await self.send_stored()
+
+            if job is None or job.is_complete() or job.container_id is None:
+                break
+
+            if job.status == models.JobStatus.RUNNING and not followed:
+                await self.follow(job)
+                followed = True
+
+            self.job_changed.clear()
+
+            try:
+                await asyncio.wait_for(self.job_changed.wait(), LOG_TAIL_RECHECK_SECS)
+            except asyncio.TimeoutError:
+                pass
+
+        if job is not None:
+            await self.send(json.dumps({'type': 'done', 'status': job.status, 'exit_code': job.exit_code}))
+
+        await self.close()
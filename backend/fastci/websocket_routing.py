@@ -1,7 +1,8 @@
 from django.urls import path
 
-from .websocket_consumers import ChangeNotifier
+from .websocket_consumers import ChangeNotifier, JobLogTail
 
 websocket_urlpatterns = [
-    path('ws/', ChangeNotifier.as_asgi())
+    path('ws/', ChangeNotifier.as_asgi()),
+    path('ws/job_log/<int:job_id>/', JobLogTail.as_asgi())
 ]
@@ -1,12 +1,16 @@
 import React from "react";
 import * as api from "../utils/api";
 import {useWebsocketScheduler} from "../utils/api";
+import * as changes from "../utils/changes";
 import {Link, useParams} from "react-router-dom";
 import * as status from "../utils/status";
 import RequiresLogin from "./requires_login";
 import ActionWithTooltip from "./action_with_tooltip";
 import {cancelJob, updateJob} from "../utils/action_api";
 
+// How many lines of the log are loaded at once when scrolling back
+const LOG_PAGE_LINES = 1000;
+
 function makeBasicInfoElement(name, value) {
     return (
         <div key={name}>
@@ -76,9 +80,90 @@ export default function JobPage() {
             status: 0,
             error: '',
             exit_code: null,
-            output: ''
+            cache_hit: false,
+            cpus: null,
+            memory_bytes: null,
+            runner: ''
         }
     );
+    // The loaded part [start, end) of the log. It's only ever extended, so we keep it in a ref to not recreate the
+    // callbacks every time
+    const logRef = React.useRef({jobId: null, text: '', start: 0, end: 0});
+    let [log, setLog] = React.useState(logRef.current);
+    // What was printed after the loaded part, straight from the docker. Dropped once it's stored
+    let [liveText, setLiveText] = React.useState('');
+
+    const refreshLog = React.useCallback(async () => {
+        let data;
+
+        if (logRef.current.jobId !== id) {
+            data = await api.fetchDataFromGetApi(`fastci/api/job_log/${id}/?tail=${LOG_PAGE_LINES}`);
+        } else {
+            // only what was printed since the last time
+            data = await api.fetchDataFromGetApi(`fastci/api/job_log/${id}/?offset=${logRef.current.end}`);
+        }
+
+        if (data === null) {
+            // TODO: Make a toast
+            console.log('Failed to refresh job log!');
+            return;
+        }
+
+        if (logRef.current.jobId !== id) {
+            logRef.current = {jobId: id, text: data.data, start: data.start, end: data.end};
+            setLiveText('');
+        } else if (data.start === logRef.current.end && data.end > data.start) {
+            logRef.current = {...logRef.current, text: logRef.current.text + data.data, end: data.end};
+            setLiveText('');
+        }
+
+        setLog(logRef.current);
+    }, [id]);
+
+    const logLoaded = log.jobId === id;
+
+    React.useEffect(() => {
+        if (!logLoaded) {
+            return;
+        }
+
+        const socket = api.openJobLogTail(id, logRef.current.end);
+
+        socket.onmessage = (event) => {
+            const message = JSON.parse(event.data);
+
+            if (message.type === 'stored') {
+                if (message.start === logRef.current.end) {
+                    logRef.current = {...logRef.current, text: logRef.current.text + message.data, end: message.end};
+                    setLog(logRef.current);
+                }
+
+                setLiveText('');
+            } else if (message.type === 'live') {
+                setLiveText(text => text + message.data);
+            } else if (message.type === 'done') {
+                setJobData(data => ({...data, status: message.status, exit_code: message.exit_code}));
+            }
+        };
+
+        return () => socket.close();
+    }, [id, logLoaded]);
+
+    const loadEarlierLog = async () => {
+        const data = await api.fetchDataFromGetApi(
+            `fastci/api/job_log/${id}/?tail=${LOG_PAGE_LINES}&end=${logRef.current.start}`);
+
+        if (data === null) {
+            // TODO: Make a toast
+            console.log('Failed to load job log!');
+            return;
+        }
+
+        if (data.end === logRef.current.start) {
+            logRef.current = {...logRef.current, text: data.data + logRef.current.text, start: data.start};
+            setLog(logRef.current);
+        }
+    };
 
     const refreshJob = React.useCallback(async () => {
         const data = await api.fetchDataFromGetApi(`fastci/api/job/${id}`);
@@ -90,9 +175,23 @@ export default function JobPage() {
         }
 
         setJobData(data);
-    }, [id]);
+        await refreshLog();
+    }, [id, refreshLog]);
 
-    useWebsocketScheduler(refreshJob);
+    const applyChange = React.useCallback(async (change) => {
+        if (!change) {
+            await refreshJob();
+            return;
+        }
+
+        for (const job of change.jobs) {
+            setJobData(data => changes.patchJob(data, job));
+        }
+
+        await refreshLog();
+    }, [refreshJob, refreshLog]);
+
+    useWebsocketScheduler(applyChange, {jobs: [Number(id)]});
 
     let info_elements = [
         makeBasicInfoElement('Id', id),
@@ -104,19 +203,27 @@ export default function JobPage() {
             `/pipeline/${jobData.pipeline.id}`),
         makeBasicInfoElement('Repo', jobData.pipeline.repo_url || 'None'),
         makeBasicInfoElement('Commit', jobData.pipeline.commit_hash ? jobData.pipeline.commit_hash.slice(0, 7) : 'None'),
+        makeBasicInfoElement('Runner', jobData.runner || 'Local'),
         makeBasicInfoElement('Container id', jobData.container_id ? jobData.container_id.slice(0, 12) : 'Cleaned up'),
         makeBasicInfoElement('Timeout (in secs)',
             jobData.timeout_secs?.toFixed(2) ?? 'None'),
         makeBasicInfoElement('Uptime (in secs)', jobData.uptime_secs.toFixed(2)),
+        makeBasicInfoElement('CPUs', jobData.cpus ?? 'Not limited'),
+        makeBasicInfoElement('Memory (in MiB)',
+            jobData.memory_bytes !== null ? (jobData.memory_bytes / (1024 * 1024)).toFixed(0) : 'Not limited'),
         makeStatusElement(jobData),
         makeBasicInfoElement('Error', jobData.error || 'None'),
-        makeBasicInfoElement('Exit code', jobData.exit_code ?? 'None')
+        makeBasicInfoElement('Exit code', jobData.exit_code ?? 'None'),
+        makeBasicInfoElement('From cache', jobData.cache_hit ? 'Yes' : 'No')
     ];
 
     return (
         <RequiresLogin>
             <div className='job_page_container'>
-                <p className='console_output'>{jobData.output}</p>
+                <div className='console_output'>
+                    {log.start > 0 && <button onClick={loadEarlierLog}>Load earlier output</button>}
+                    <p>{log.text}{liveText}</p>
+                </div>
                 <div className='job_info_pane'>
                     {info_elements}
                 </div>
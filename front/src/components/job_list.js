@@ -6,15 +6,17 @@ import {Link} from "react-router-dom";
 import ActionWithTooltip from "./action_with_tooltip";
 import {cancelJob, updateJob} from "../utils/action_api";
 import RequiresLogin from "./requires_login";
-import {ListPaginator, PAGE_SIZE} from "./list_paginator";
+import {ListPaginator, makeListPath} from "./list_paginator";
+import * as changes from "../utils/changes";
 
 export default function JobListPage() {
     let [data, setData] = React.useState([]);
-    let [page, setPage] = React.useState(1);
-    let [pageCount, setPageCount] = React.useState(1);
+    // null - the first page, the newest ones
+    let [cursor, setCursor] = React.useState(null);
+    let [links, setLinks] = React.useState({previous: null, next: null});
 
     const refreshList = React.useCallback(async () => {
-        const response = await api.fetchDataFromGetApi(`fastci/api/job_list?page=${page}`);
+        const response = await api.fetchDataFromGetApi(makeListPath('fastci/api/job_list', cursor));
 
         if (response === null) {
             // TODO: Make a toast
@@ -24,10 +26,24 @@ export default function JobListPage() {
 
         const data = response['results'];
         setData(data);
-        setPageCount(Math.ceil(response['count'] / PAGE_SIZE));
-    }, [page]);
+        setLinks({previous: response['previous'], next: response['next']});
+    }, [cursor]);
 
-    useWebsocketScheduler(refreshList);
+    let dataRef = React.useRef(data);
+    dataRef.current = data;
+
+    const applyChange = React.useCallback(async (change) => {
+        // The new jobs only show up on the first page
+        if (!change || (cursor === null && changes.hasNewer(dataRef.current, change.jobs))) {
+            await refreshList();
+            return;
+        }
+
+        const changedJobs = changes.indexById(change.jobs);
+        setData(data => data.map(job => job.id in changedJobs ? changes.patchJob(job, changedJobs[job.id]) : job));
+    }, [cursor, refreshList]);
+
+    useWebsocketScheduler(applyChange, {jobs: 'all'});
 
     function makeJobElement(job, index) {
         const statusDescription = status.JOB_STATUS_DESCRIPTION[job.status];
@@ -89,7 +105,7 @@ export default function JobListPage() {
                 {elements}
                 </tbody>
             </table>
-            <ListPaginator page={page} setPage={setPage} pageCount={pageCount}/>
+            <ListPaginator previous={links.previous} next={links.next} setCursor={setCursor}/>
         </RequiresLogin>
     );
 }
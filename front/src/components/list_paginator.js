@@ -1,15 +1,21 @@
-// @CopyPaste - keep in sync with backend
-export const PAGE_SIZE = 20;
+export function cursorFromLink(link) {
+    // The links to the pages are full urls, only the cursor is needed to fetch them
+    return link ? new URL(link).searchParams.get('cursor') : null;
+}
+
+export function makeListPath(path, cursor) {
+    return cursor ? `${path}?cursor=${encodeURIComponent(cursor)}` : path;
+}
 
 export function ListPaginator(props) {
-    // FIXME: If there are no pages, this breaks. But I don't really care
-    let {page, setPage, pageCount} = props;
+    // previous, next - the links from the response, null if there's no such page. See BasicCursorPagination in the
+    // backend
+    let {previous, next, setCursor} = props;
 
     return (
         <div className='list_paginator'>
-            <button onClick={() => setPage(Math.max(1, page - 1))}>Prev</button>
-            <span>{page}</span>
-            <button onClick={() => setPage(Math.min(pageCount, page + 1))}>Next</button>
+            <button disabled={!previous} onClick={() => setCursor(cursorFromLink(previous))}>Prev</button>
+            <button disabled={!next} onClick={() => setCursor(cursorFromLink(next))}>Next</button>
         </div>
     );
-}
\ No newline at end of file
+}
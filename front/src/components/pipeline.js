@@ -8,6 +8,7 @@ import JobLink from "./job_link";
 import RequiresLogin from "./requires_login";
 import ActionWithTooltip from "./action_with_tooltip";
 import {cancelPipeline, updatePipeline} from "../utils/action_api";
+import * as changes from "../utils/changes";
 
 function onNodeMouseEnter(job, nodesRef) {
     nodesRef.current[job.id]?.classList.add('highlighted_main');
@@ -77,7 +78,33 @@ export default function PipelinePage() {
         setStages(topologicalSort(transformToChildrenGraph(transformedData.jobs)));
     }, [id]);
 
-    useWebsocketScheduler(refreshPipeline);
+    const applyChange = React.useCallback(async (change) => {
+        if (!change) {
+            await refreshPipeline();
+            return;
+        }
+
+        for (const pipeline of change.pipelines) {
+            setStatusId(pipeline.status);
+        }
+
+        const changedJobs = changes.indexById(change.jobs);
+
+        // The nodes are linked to each other via `children`, so they are patched in place
+        setStages(stages => {
+            for (const stage of stages) {
+                for (const job of stage) {
+                    if (job.id in changedJobs) {
+                        Object.assign(job, changes.patchJob(job, changedJobs[job.id]));
+                    }
+                }
+            }
+
+            return [...stages];
+        });
+    }, [refreshPipeline]);
+
+    useWebsocketScheduler(applyChange, {pipelines: [Number(id)]});
 
     let nodesRef = React.useRef({});
 
@@ -1,9 +1,67 @@
 import React from "react";
 import * as api from "../utils/api";
+import {useWebsocketScheduler} from "../utils/api";
+
+function describeError(responseData) {
+    // Same for the 400 of the view and for the report of the task, see reports in the backend
+    if (typeof responseData === 'string') {
+        return responseData;
+    }
+
+    if (typeof responseData === 'object' && responseData !== null && 'detail' in responseData) {
+        return responseData['detail'];
+    }
+
+    return JSON.stringify(responseData);
+}
 
 export default function PipelineCreatePage() {
     let [file, setFile] = React.useState(null);
     let [error, setError] = React.useState('\u200b');
+    // The pipeline is created in the background, these are the ids of the tasks we're still waiting for
+    let [taskIds, setTaskIds] = React.useState([]);
+
+    const applyTaskReports = React.useCallback((reports) => {
+        const finished = reports.filter(report => report.state !== 'PENDING');
+
+        if (finished.length === 0) {
+            return;
+        }
+
+        for (const report of finished) {
+            if (report.state === 'FAILURE') {
+                setError(describeError(report.error));
+            }
+        }
+
+        const finishedIds = finished.map(report => report.id);
+        setTaskIds(taskIds => taskIds.filter(taskId => !finishedIds.includes(taskId)));
+    }, []);
+
+    let taskIdsRef = React.useRef(taskIds);
+    taskIdsRef.current = taskIds;
+
+    const applyChange = React.useCallback(async (change) => {
+        if (change) {
+            applyTaskReports(change.tasks || []);
+            return;
+        }
+
+        // The reports may have come while we weren't listening, see task_view in the backend
+        const reports = [];
+
+        for (const taskId of taskIdsRef.current) {
+            const report = await api.fetchDataFromGetApi(`fastci/api/task/${taskId}/`);
+
+            if (report !== null) {
+                reports.push(report);
+            }
+        }
+
+        applyTaskReports(reports);
+    }, [applyTaskReports]);
+
+    useWebsocketScheduler(applyChange, {tasks: taskIds});
 
     async function handleSubmit(event) {
         let text = '';
@@ -29,16 +87,13 @@ export default function PipelineCreatePage() {
         // The / at the end is needed for django for some reason
         let response = await api.fetchResponseFromPostApi('fastci/api/create_pipeline/', data);
 
-        if (response.status === 200) {
+        if (response.status === 202) {
+            // Only the config is checked right away, the rest of the errors come with the report of the task
+            const responseData = await response.json();
             setError('\u200b');
+            setTaskIds(taskIds => [...taskIds, responseData['task_id']]);
         } else if (response.status === 400) {
-            let responseData = await response.json();
-
-            if ('detail' in responseData) {
-                setError(responseData['detail']);
-            } else {
-                setError(JSON.stringify(responseData));
-            }
+            setError(describeError(await response.json()));
         } else {
             console.log(response);
             setError('Failed to call api');
@@ -1,29 +1,54 @@
 import React from "react";
 import * as api from "../utils/api";
 import {useWebsocketScheduler} from "../utils/api";
-import {topologicalSort, transformToChildrenGraph, transformToJobsDict} from "../utils/node";
 import * as status from "../utils/status";
 import {Link} from "react-router-dom";
 import ActionWithTooltip from "./action_with_tooltip";
 import {cancelPipeline, updatePipeline} from "../utils/action_api";
 import RequiresLogin from "./requires_login";
 import PipelineCreatePage from "./pipeline_create";
-import JobLink from "./job_link";
-import {ListPaginator, PAGE_SIZE} from "./list_paginator";
+import {ListPaginator, makeListPath} from "./list_paginator";
+import * as changes from "../utils/changes";
+
+function makeJobCountsElement(pipeline) {
+    // Only the summary is there, see ListingPipelineSerializer in the backend. The jobs are on the pipeline page
+    let countElements = [];
+
+    for (const [statusId, count] of Object.entries(pipeline.job_counts)) {
+        const jobStatus = Number(statusId);
+        // only the finished ones have exit codes
+        const failedExitCount = jobStatus === status.JOB_FINISHED ? pipeline.failed_exit_count : 0;
+
+        for (const [exitCode, exitCount] of [[0, count - failedExitCount], [1, failedExitCount]]) {
+            if (exitCount === 0) {
+                continue;
+            }
+
+            const statusClass = status.getJobStatusClass({status: jobStatus, exit_code: exitCode});
+            countElements.push(
+                <span className={statusClass} key={`${statusId}_${exitCode}`}>
+                    <i className={`fas ${status.getIconClassFromStatusClass(statusClass)} fa_icon_fix_size`}/>
+                    {`${exitCount} ${status.JOB_STATUS_DESCRIPTION[jobStatus].toLowerCase()}`}
+                </span>
+            );
+        }
+    }
 
-export default function PipelineListPage() {
-    // TODO: @Speed - redrawing **everything** on each button click is very slow
+    return <div className='pipeline_list_job_counts'>{countElements}</div>;
+}
+
+function formatTimestamp(secs) {
+    return secs !== null ? new Date(secs * 1000).toLocaleString() : 'None';
+}
 
+export default function PipelineListPage() {
     let [data, setData] = React.useState([]);
-    let [openDropdownState, setOpenDropdownState] = React.useState({
-        pipelineId: null,
-        stageIndex: null
-    });
-    let [page, setPage] = React.useState(1);
-    let [pageCount, setPageCount] = React.useState(1);
+    // null - the first page, the newest ones
+    let [cursor, setCursor] = React.useState(null);
+    let [links, setLinks] = React.useState({previous: null, next: null});
 
     const refreshList = React.useCallback(async () => {
-        const response = await api.fetchDataFromGetApi(`fastci/api/pipeline_list?page=${page}`);
+        const response = await api.fetchDataFromGetApi(makeListPath('fastci/api/pipeline_list', cursor));
 
         if (response === null) {
             // TODO: Make a toast
@@ -31,69 +56,35 @@ export default function PipelineListPage() {
             return;
         }
 
-        const data = response['results'];
-        // @Speed - copying this each time just doesn't feel right
-        let dataWithJobsTransformed = data.map((pipeline, i) => transformToJobsDict(pipeline));
-        setData(dataWithJobsTransformed);
-        setPageCount(Math.ceil(response['count'] / PAGE_SIZE));
-    }, [page]);
+        setData(response['results']);
+        setLinks({previous: response['previous'], next: response['next']});
+    }, [cursor]);
 
-    useWebsocketScheduler(refreshList);
+    let dataRef = React.useRef(data);
+    dataRef.current = data;
 
-    // `bind` prepends any additional arguments, so these identification args must precede `event`
-    function toggleDropdown(pipelineId, stageIndex, event) {
-        // TODO: might be useful if I add hideDropdown, which isn't used yet
-        // event.stopPropagation();
+    const applyChange = React.useCallback(async (change) => {
+        // The new pipelines only show up on the first page
+        if (!change || (cursor === null && changes.hasNewer(dataRef.current, change.pipelines))) {
+            await refreshList();
+            return;
+        }
 
-        // TODO: is this needed?
-        event.preventDefault();
+        // The summaries come with the changes of the pipelines
+        const changedPipelines = changes.indexById(change.pipelines);
+        // the ones whose creation has failed
+        const deletedIds = change.deleted_pipelines || [];
 
-        if (openDropdownState.pipelineId === pipelineId &&
-            openDropdownState.stageIndex === stageIndex) {
-            setOpenDropdownState({pipelineId: null, stageIndex: null});
-        } else {
-            setOpenDropdownState({pipelineId, stageIndex});
-        }
-    }
+        setData(data => data.filter(pipeline => !deletedIds.includes(pipeline.id)).map(pipeline =>
+            pipeline.id in changedPipelines ? {...pipeline, ...changedPipelines[pipeline.id]} : pipeline));
+    }, [cursor, refreshList]);
 
-    // TODO: Not sure how to use this yet. I can place this in the top-level container, but then
-    //       I'll need to carefully handle event propagation
-    // function hideDropdown(event) {
-    //     // TODO: is this needed?
-    //     event.preventDefault();
-    //
-    //     this.setState({
-    //         pipelineIdDropdownOpen: null,
-    //         stageIndexDropdownOpen: null
-    //     });
-    // }
+    useWebsocketScheduler(applyChange, {pipelines: 'all'});
 
     function makePipelineElement(pipeline, index) {
         const statusDescription = status.PIPELINE_STATUS_DESCRIPTION[pipeline.status];
         const statusClass = status.getPipelineStatusClass(pipeline.status);
 
-        // @Speed - inefficient - copying and recalculating this here
-        const stages = topologicalSort(transformToChildrenGraph(pipeline.jobs));
-        const stagesElements = stages.map((stage, i) => {
-            const jobsElements = stage.map((job, i) => {
-                return <JobLink job={job} key={i}/>
-            });
-            const statusClass = status.getStageStatusClass(stage);
-
-            return (
-                <div className='pipeline_list_dropdown_container' key={i}>
-                    <button
-                        className={statusClass}
-                        onClick={toggleDropdown.bind(null, pipeline.id, i)}>
-                        {`Stage ${i + 1}`}
-                    </button>
-                    {(openDropdownState.pipelineId === pipeline.id &&
-                        openDropdownState.stageIndex === i) ?
-                        <div>{jobsElements}</div> : null}
-                </div>
-            );
-        });
-
         return (
             <tr key={index}>
                 <td>
@@ -103,7 +94,10 @@ export default function PipelineListPage() {
                     <Link to={`/pipeline/${pipeline.id}`}>{pipeline.name}</Link>
                 </td>
                 <td className={statusClass}>{statusDescription}</td>
-                <td>{stagesElements}</td>
+                <td>{makeJobCountsElement(pipeline)}</td>
+                <td>{pipeline.total_uptime_secs.toFixed(2)}</td>
+                <td>{formatTimestamp(pipeline.started_secs)}</td>
+                <td>{formatTimestamp(pipeline.finished_secs)}</td>
                 <td>{pipeline.repo_url || 'None'}</td>
                 <td>{pipeline.commit_hash ? pipeline.commit_hash.slice(0, 7) : 'None'}</td>
                 <td>
@@ -123,7 +117,6 @@ export default function PipelineListPage() {
     // TODO:
     //   1. search
     //   2. actions - start, restart
-    //   3. uptime
     const elements = data.map(makePipelineElement);
 
     return (
@@ -136,6 +129,9 @@ export default function PipelineListPage() {
                     <th>Name</th>
                     <th>Status</th>
                     <th>Jobs</th>
+                    <th>Uptime (in secs)</th>
+                    <th>Started</th>
+                    <th>Finished</th>
                     <th>Repo</th>
                     <th>Commit</th>
                     <th>Actions</th>
@@ -145,7 +141,7 @@ export default function PipelineListPage() {
                 {elements}
                 </tbody>
             </table>
-            <ListPaginator page={page} setPage={setPage} pageCount={pageCount}/>
+            <ListPaginator previous={links.previous} next={links.next} setCursor={setCursor}/>
         </RequiresLogin>
     );
 }
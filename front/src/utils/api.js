@@ -1,6 +1,7 @@
 import React from "react";
 
 const API_BASE = 'http://localhost:8000';
+const WEBSOCKET_BASE = 'ws://localhost:8000';
 
 export async function signIn(username, password) {
     // The / at the end is needed for django for some reason
@@ -157,31 +158,67 @@ export async function fetchDataFromGetApi(path) {
     return await response.json();
 }
 
-export function useWebsocketScheduler(targetFunction) {
+export function useWebsocketScheduler(targetFunction, subscription = null) {
     // NOTE: targetFunction likely should be a callback
+    // targetFunction is called with what has changed (see fastci.events in the backend), or with nothing when
+    // everything has to be fetched again - at the start and after reconnecting, since the changes in between are lost
+    // subscription - {pipelines: [ids] or 'all', jobs: [ids] or 'all', tasks: [ids] or 'all'}, null - everything
+    // The socket stays open when the subscription changes, the new one is just sent over it
     let socketRef = React.useRef(null);
     let [socketReset, setSocketReset] = React.useState(0);
+    // So the subscription isn't sent again on each render, since it's usually an object literal
+    const subscriptionJson = JSON.stringify(subscription);
+    let subscriptionJsonRef = React.useRef(subscriptionJson);
+    subscriptionJsonRef.current = subscriptionJson;
 
     React.useEffect(() => {
-        socketRef.current = new WebSocket('ws://localhost:8000/ws/');
+        // The browsers can't set the headers of a websocket, so the token goes in the query
+        const accessToken = encodeURIComponent(window.localStorage.getItem('ACCESS_TOKEN') || '');
+        const socket = new WebSocket(`${WEBSOCKET_BASE}/ws/?token=${accessToken}`);
+        socketRef.current = socket;
         console.log('WebSocket connect');
 
-        socketRef.current.onopen = () => socketRef.current.send('go?');
-        socketRef.current.onmessage = async () => {
-            await targetFunction();
-            socketRef.current.send('go?');
+        socket.onopen = () => {
+            // the latest one, it might have changed while we were connecting
+            if (subscriptionJsonRef.current !== 'null') {
+                socket.send(subscriptionJsonRef.current);
+            }
         };
-        socketRef.current.onclose = (event) => {
+        // The changes are pushed as they happen
+        socket.onmessage = (event) => targetFunction(JSON.parse(event.data));
+        socket.onclose = (event) => {
             if (!event.wasClean) {
-                setSocketReset(socketReset + 1);
+                // The token might have expired in the meantime (it's also rejected that way)
+                refreshAccessToken().finally(() => setSocketReset(socketReset + 1));
             }
         };
 
         // Ignoring for now
         targetFunction();
 
-        return () => socketRef.current.close();
+        return () => socket.close();
     }, [socketRef, socketReset, targetFunction]);
 
+    React.useEffect(() => {
+        const socket = socketRef.current;
+
+        // Otherwise it's sent once the socket is open
+        if (socket === null || socket.readyState !== WebSocket.OPEN || subscriptionJson === 'null') {
+            return;
+        }
+
+        socket.send(subscriptionJson);
+        // Whatever has changed before the server got the new subscription was filtered out by the old one
+        targetFunction();
+    }, [socketRef, subscriptionJson, targetFunction]);
+
     // Could return connection reset function if needed
-}
\ No newline at end of file
+}
+
+export function openJobLogTail(jobId, offset) {
+    // Streams what the job prints after the offset of the stored log, see JobLogTail in the backend
+    // The browsers can't set the headers of a websocket, so the token goes in the query. It has just been refreshed by
+    // fetching the stored log, if it had to be
+    const accessToken = encodeURIComponent(window.localStorage.getItem('ACCESS_TOKEN') || '');
+    return new WebSocket(`${WEBSOCKET_BASE}/ws/job_log/${jobId}/?offset=${offset}&token=${accessToken}`);
+}
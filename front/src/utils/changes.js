@@ -0,0 +1,28 @@
+// Applying what has changed (see fastci.events in the backend) to what has been fetched already
+
+export function indexById(items) {
+    let result = {};
+
+    for (const item of items) {
+        result[item.id] = item;
+    }
+
+    return result;
+}
+
+export function patchJob(job, change) {
+    // Returns a new job, only the fields that can change are taken
+    return {
+        ...job,
+        status: change.status,
+        exit_code: change.exit_code,
+        uptime_secs: change.uptime_secs,
+        container_id: change.container_id
+    };
+}
+
+export function hasNewer(items, changedItems) {
+    // Whether there's something that was created after all of the items - so it's not there yet
+    const maxId = Math.max(0, ...items.map(item => item.id));
+    return changedItems.some(item => item.id > maxId);
+}
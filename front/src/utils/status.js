@@ -3,10 +3,11 @@ const JOB_RUNNING = 1;
 const JOB_TIMED_OUT = 2;
 const JOB_DOCKER_ERROR = 3;
 const JOB_NOT_FOUND = 4;
-const JOB_FINISHED = 5;
+export const JOB_FINISHED = 5;
 const JOB_FAILED_TO_START = 6;
 const JOB_CANCELLED = 7;
 const JOB_DEPENDENCY_FAILED = 8;
+const JOB_QUEUED = 9;
 
 export const JOB_STATUS_DESCRIPTION = [
     'Not started',
@@ -17,7 +18,8 @@ export const JOB_STATUS_DESCRIPTION = [
     'Finished',
     'Failed to start',
     'Cancelled',
-    'Dependency failed'
+    'Dependency failed',
+    'Queued'
 ];
 
 const PIPELINE_NOT_STARTED = 0;
@@ -35,7 +37,7 @@ export const PIPELINE_STATUS_DESCRIPTION = [
 ];
 
 export function getJobStatusClass(job) {
-    if (job.status === JOB_NOT_STARTED) {
+    if (job.status === JOB_NOT_STARTED || job.status === JOB_QUEUED) {
         return 'not_started';
     } else if (job.status === JOB_RUNNING) {
         return 'running';
@@ -78,39 +80,3 @@ export function getPipelineStatusClass(status) {
         return 'cancelled';
     }
 }
-
-export function getStageStatusClass(stage) {
-    // stage = list of jobs
-    let anyFailed = false;
-    let anyCancelled = false;
-    let anyNotStarted = false;
-
-    for (const job of stage) {
-        const jobStatusClass = getJobStatusClass(job);
-
-        if (jobStatusClass === 'running') {
-            return 'running';
-        } else if (jobStatusClass === 'failed') {
-            anyFailed = true;
-        } else if (jobStatusClass === 'cancelled') {
-            anyCancelled = true;
-        } else if (jobStatusClass === 'not_started') {
-            anyNotStarted = true;
-        }
-    }
-
-    if (anyNotStarted) {
-        return 'not_started';
-    }
-
-    if (anyCancelled) {
-        return 'cancelled';
-    }
-
-    if (anyFailed) {
-        return 'failed';
-    }
-
-    return 'succeded';
-}
-
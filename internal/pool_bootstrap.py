@@ -0,0 +1,17 @@
+#!/usr/bin/env python3
+import json
+import os
+
+# @CopyPaste - keep in sync with warm_pool.py
+SLOT_DIR = '/fastci/slot'
+START_FIFO = os.path.join(SLOT_DIR, 'start')
+ARGV_FILE = os.path.join(SLOT_DIR, 'argv.json')
+
+# Blocks until the job is started, the argv is written long before that, when the container is claimed
+with open(START_FIFO) as f:
+    f.read()
+
+with open(ARGV_FILE) as f:
+    target_argv = json.load(f)
+
+os.execvp(target_argv[0], target_argv)